@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from telegram import TelegramClient
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTelegramClient:
+    """An asyncio Telegram Client
+
+    It offers the same API as `TelegramClient`, but every call is a
+    coroutine. The blocking HTTP round trips run in a dedicated thread
+    pool, so a long polling `getUpdates` never stalls the event loop.
+    """
+
+    def __init__(self, token: str, max_workers: int = 8) -> None:
+        """Init the client
+
+        Parameters
+        ----------
+        token : str
+            Token of the client
+        max_workers : int
+            Number of concurrent requests
+        """
+        self._client = TelegramClient(token)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="telegram")
+
+    async def _call(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(method, *args, **kwargs))
+
+    async def get_me(self) -> dict:
+        return await self._call(self._client.get_me)
+
+    async def get_file_info(self, file_id: str) -> dict:
+        return await self._call(self._client.get_file_info, file_id)
+
+    async def get_updates(self, offset, timeout) -> dict:
+        return await self._call(self._client.get_updates, offset, timeout)
+
+    async def send_message(self, text: str, chat_id: int,
+                           thread_id: int = 0) -> dict:
+        return await self._call(self._client.send_message, text, chat_id,
+                                thread_id)
+
+    async def get_member(self, chat_id, user_id):
+        return await self._call(self._client.get_member, chat_id, user_id)
+
+    async def get_administrators(self, chat_id):
+        return await self._call(self._client.get_administrators, chat_id)
+
+    async def set_reaction(self, chat_id, message_id, reaction):
+        return await self._call(self._client.set_reaction, chat_id,
+                                message_id, reaction)
+
+    async def send_question(self, text: str, chat_id: int,
+                            options: list[str], thread_id: int = 0) -> dict:
+        return await self._call(self._client.send_question, text, chat_id,
+                                options, thread_id)
+
+    async def send_chat_action(self, chat_id: int, thread_id: int,
+                               action: str) -> dict:
+        return await self._call(self._client.send_chat_action, chat_id,
+                                thread_id, action)
+
+    async def set_webhook(self, url: str, secret_token: str = "",
+                          max_connections: int = 40) -> dict:
+        return await self._call(self._client.set_webhook, url, secret_token,
+                                max_connections)
+
+    async def delete_webhook(self) -> dict:
+        return await self._call(self._client.delete_webhook)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import metrics
+import numpy as np
+import subprocess
+import tempfile
+import time
+from plumbum import local
+from pydantic import BaseModel
+
+RATE = 16000
+# Loudness is measured in 400 ms blocks overlapped by 75 %, made of four
+# 100 ms steps, the way EBU R128 gates its momentary loudness
+STEP = RATE // 10
+WINDOW = 4
+# Histogram of the block loudness, in 0.1 LU bins, so the gating needs
+# the same memory for a voice note as for a recording of hours
+FLOOR = -70.0
+CEILING = 10.0
+BINS = int((CEILING - FLOOR) * 10)
+CHUNK = STEP * 64
+
+SECONDS = metrics.histogram("analysis_seconds",
+                            "Wall time of the audio analysis")
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisException(Exception):
+    pass
+
+
+class Analysis(BaseModel):
+    duration: float
+    loudness: float | None = None
+    peak: float | None = None
+    trim_start: float = 0.0
+    trim_end: float = 0.0
+    gain: float = 0.0
+    silences: list[tuple[float, float]] = []
+    envelope: list[float] = []
+
+
+class Analyzer:
+    """Measure an audio fed as chunks of mono float samples
+
+    Only aggregates are kept: a loudness histogram, the open silence,
+    and a peak envelope that halves its resolution when it grows beyond
+    `points`, so memory stays bounded whatever the length of the audio.
+    """
+
+    def __init__(self, threshold: float = -50.0, minimum: float = 0.5,
+                 padding: float = 0.25, points: int = 1200):
+        self._threshold = 10 ** (threshold / 10)
+        self._minimum = minimum
+        self._padding = padding
+        self._points = points
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._tail = np.zeros(0, dtype=np.float64)
+        self._histogram = np.zeros(BINS, dtype=np.int64)
+        self._steps = 0
+        self._peak = 0.0
+        self._first = None
+        self._last = None
+        self._silence = 0
+        self._silences = []
+        self._envelope = np.zeros(0, dtype=np.float32)
+        self._spread = 1
+        self._partial = np.zeros(0, dtype=np.float32)
+
+    def feed(self, samples: np.ndarray) -> None:
+        samples = np.concatenate((self._pending, samples))
+        steps = len(samples) // STEP
+        self._pending = samples[steps * STEP:]
+        if steps == 0:
+            return
+        blocks = samples[:steps * STEP].reshape(steps, STEP)
+        squares = np.square(blocks, dtype=np.float64).mean(axis=1)
+        peaks = np.abs(blocks).max(axis=1)
+        self._loudness(squares)
+        self._silent(squares)
+        self._peaks(peaks)
+        self._steps += steps
+
+    def _loudness(self, squares: np.ndarray) -> None:
+        energies = np.concatenate((self._tail, squares))
+        self._tail = energies[-(WINDOW - 1):]
+        if len(energies) < WINDOW:
+            return
+        blocks = np.convolve(energies, np.ones(WINDOW) / WINDOW, "valid")
+        with np.errstate(divide="ignore"):
+            loudness = -0.691 + 10 * np.log10(blocks)
+        loudness = loudness[loudness > FLOOR]
+        bins = np.clip(((loudness - FLOOR) * 10).astype(np.int64), 0,
+                       BINS - 1)
+        self._histogram += np.bincount(bins, minlength=BINS)
+
+    def _silent(self, squares: np.ndarray) -> None:
+        sound = np.flatnonzero(squares >= self._threshold)
+        if len(sound) == 0:
+            self._silence += len(squares)
+            return
+        # Steps of silence before every sound, the first one counting
+        # the silence carried from the previous chunks
+        gaps = np.diff(sound, prepend=-1 - self._silence) - 1
+        longs = np.flatnonzero(gaps * STEP >= self._minimum * RATE)
+        if self._first is None:
+            self._first = self._steps + sound[0]
+            longs = longs[longs > 0]
+        for index in longs:
+            end = self._steps + sound[index]
+            self._silences.append((float((end - gaps[index]) * STEP / RATE),
+                                   float(end * STEP / RATE)))
+        self._last = self._steps + sound[-1]
+        self._silence = len(squares) - sound[-1] - 1
+
+    def _peaks(self, peaks: np.ndarray) -> None:
+        self._peak = max(self._peak, float(peaks.max()))
+        peaks = np.concatenate((self._partial, peaks))
+        whole = len(peaks) // self._spread * self._spread
+        self._partial = peaks[whole:]
+        if whole:
+            buckets = peaks[:whole].reshape(-1, self._spread).max(axis=1)
+            self._envelope = np.concatenate((self._envelope, buckets))
+        while len(self._envelope) > self._points:
+            if len(self._envelope) % 2:
+                self._partial = np.concatenate((
+                    np.repeat(self._envelope[-1:], self._spread),
+                    self._partial))
+                self._envelope = self._envelope[:-1]
+            self._envelope = self._envelope.reshape(-1, 2).max(axis=1)
+            self._spread *= 2
+
+    def integrated(self) -> float | None:
+        """Gated loudness of the audio, in LUFS without K-weighting"""
+        centers = FLOOR + (np.arange(BINS) + 0.5) / 10
+        energies = 10 ** ((centers + 0.691) / 10)
+        if not self._histogram.any():
+            return None
+        mean = np.average(energies, weights=self._histogram)
+        gate = -0.691 + 10 * np.log10(mean) - 10
+        weights = np.where(centers > gate, self._histogram, 0)
+        if not weights.any():
+            return None
+        return float(-0.691 + 10 * np.log10(
+            np.average(energies, weights=weights)))
+
+    def result(self, target: float = -16.0, ceiling: float = -1.0,
+               limit: float = 20.0) -> Analysis:
+        """The measures, trim points and gain to reach `target` LUFS
+
+        The gain never pushes the peak above `ceiling` dBFS nor changes
+        the level by more than `limit` dB.
+        """
+        duration = (self._steps * STEP + len(self._pending)) / RATE
+        loudness = self.integrated()
+        peak = float(20 * np.log10(self._peak)) if self._peak else None
+        analysis = Analysis(duration=duration, trim_end=duration,
+                            loudness=loudness, peak=peak,
+                            silences=list(self._silences))
+        if self._first is not None:
+            analysis.trim_start = max(
+                0.0, float(self._first * STEP / RATE - self._padding))
+            analysis.trim_end = min(
+                duration,
+                float((self._last + 1) * STEP / RATE + self._padding))
+        if loudness is not None and peak is not None:
+            gain = min(target - loudness, ceiling - peak)
+            analysis.gain = round(float(np.clip(gain, -limit, limit)), 2)
+        envelope = self._envelope
+        if len(self._partial):
+            envelope = np.append(envelope, self._partial.max())
+        analysis.envelope = [round(float(value), 4) for value in envelope]
+        return analysis
+
+
+def analyze(file_from: str, target: float = -16.0,
+            threshold: float = -50.0) -> Analysis:
+    """Decode an audio to a pipe and analyze it while it is decoded"""
+    logger.debug("Analyzing %s", file_from)
+    ffmpeg = local["ffmpeg"]
+    command = ffmpeg["-nostdin", "-v", "error", "-i", file_from, "-map",
+                     "0:a", "-ac", "1", "-ar", RATE, "-c:a", "pcm_f32le",
+                     "-f", "f32le", "pipe:1"]
+    analyzer = Analyzer(threshold)
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as errors:
+        process = command.popen(stdout=subprocess.PIPE, stderr=errors)
+        try:
+            remainder = b""
+            while chunk := process.stdout.read(CHUNK * 4):
+                chunk = remainder + chunk
+                whole = len(chunk) // 4 * 4
+                remainder = chunk[whole:]
+                analyzer.feed(np.frombuffer(chunk[:whole], np.float32))
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+        if process.wait() != 0:
+            errors.seek(0)
+            message = errors.read().decode("utf-8", "replace")
+            raise AnalysisException(
+                f"ffmpeg exited with {process.returncode}: {message}")
+    SECONDS.observe(time.perf_counter() - start)
+    analysis = analyzer.result(target)
+    logger.debug("Analysis of %s: loudness %s, peak %s, gain %s, "
+                 "trim %s-%s", file_from, analysis.loudness, analysis.peak,
+                 analysis.gain, analysis.trim_start, analysis.trim_end)
+    return analysis
@@ -22,11 +22,32 @@
 
 import logging
 from datetime import datetime
+from enum import StrEnum
 from pydantic import BaseModel
 
 logger = logging.getLogger(__name__)
 
 
+class State(StrEnum):
+    """Where an audio is on its way to Internet Archive"""
+    DRAFT = "draft"
+    QUEUED = "queued"
+    PUBLISHING = "publishing"
+    PUBLISHED = "published"
+    FAILED = "failed"
+
+
+# The states an audio can go to from each state
+TRANSITIONS = {
+    State.DRAFT: {State.QUEUED},
+    State.QUEUED: {State.QUEUED, State.PUBLISHING},
+    State.PUBLISHING: {State.QUEUED, State.PUBLISHING, State.PUBLISHED,
+                       State.FAILED},
+    State.FAILED: {State.QUEUED},
+    State.PUBLISHED: set(),
+}
+
+
 class Audio(BaseModel):
     id: int = -1
     identifier: str = ""
@@ -42,11 +63,18 @@ class Audio(BaseModel):
     published: bool = False
     created_at: datetime | None = None
     updated_at: datetime | None = None
+    # Checksum of the published encode, computed while it was written
+    md5: str = ""
+    sha1: str = ""
+    encoded_size: int = 0
+    state: State = State.DRAFT
+    # When the upload is scheduled, None to upload right away
+    publish_at: datetime | None = None
 
     @classmethod
     def from_cursor(cls, data: tuple):
-        logger.debug("from_cursor")
-        return cls(**{k: v for k, v in zip(cls.model_fields.keys(), data)})
+        # Rows come from our own schema, so they skip pydantic validation
+        return cls.model_construct(**dict(zip(FIELDS, _convert(data))))
 
     @classmethod
     def from_list(cls, data: list[tuple]):
@@ -55,3 +83,55 @@ class Audio(BaseModel):
         for item in data:
             audios.append(cls.from_cursor(item))
         return audios
+
+
+FIELDS = tuple(Audio.model_fields.keys())
+PUBLISHED = FIELDS.index("published")
+CREATED_AT = FIELDS.index("created_at")
+UPDATED_AT = FIELDS.index("updated_at")
+PUBLISH_AT = FIELDS.index("publish_at")
+
+
+def _timestamp(value) -> datetime | None:
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def _convert(data: tuple) -> list:
+    values = list(data)
+    values[PUBLISHED] = bool(values[PUBLISHED])
+    values[CREATED_AT] = _timestamp(values[CREATED_AT])
+    values[UPDATED_AT] = _timestamp(values[UPDATED_AT])
+    values[PUBLISH_AT] = _timestamp(values[PUBLISH_AT])
+    return values
+
+
+class AudioRecord:
+    """A compact, read-only row of the audios table
+
+    It is meant for sweeps over the whole archive, where building a
+    pydantic model per row is too expensive. Use it as a `sqlite3`
+    row factory and call `to_audio` for the rows that need a model.
+    """
+
+    __slots__ = FIELDS
+
+    def __init__(self, *values):
+        for field, value in zip(FIELDS, _convert(values)):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __repr__(self) -> str:
+        return (f"AudioRecord(id={self.id}, "
+                f"identifier={self.identifier!r}, title={self.title!r})")
+
+    @staticmethod
+    def factory(cursor, row: tuple) -> "AudioRecord":
+        return AudioRecord(*row)
+
+    def to_audio(self) -> Audio:
+        return Audio.model_construct(
+            **{field: getattr(self, field) for field in FIELDS})
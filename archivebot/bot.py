@@ -22,16 +22,37 @@
 # SOFTWARE.
 
 from io import StringIO
+import asyncio
 import json
 import logging
-import log
+import metrics
 import os
+import profiles
+import time
+from urllib.parse import urlparse
 from telegram import TelegramClient
-from register import Register
+from aiotelegram import AsyncTelegramClient
+from register import Register, RegisterExists, RegisterNotExists
 from datetime import datetime
 from context import Context
+from sessions import SessionStore
+from audio import Audio, State
+from iaclient import HOST
 from iauploader import IAUploader
-from converter import Converter
+from s3 import ENDPOINT
+from analysis import Analysis, analyze
+from fingerprint import FingerprintIndex, fingerprint
+from files import FileStore, Rendition, StoredFile
+from storage import StorageManager
+from reconciler import Reconciler
+from scheduler import PublishScheduler
+from sync import MetadataSync
+from transcoder import TranscodePool
+from jobs import Job, JobQueue, WorkerPool
+from webhook import WebhookServer
+from updates import UpdateLedger
+from outbound import OutboundScheduler
+from instrumentation import Payload, traced
 
 
 logger = logging.getLogger(__name__)
@@ -43,158 +64,344 @@ HAND = "👉"
 OK = "👍"
 KO = "👎"
 
+# Failures that processing the update again would repeat
+PERMANENT = (ValueError, KeyError, TypeError, RegisterExists,
+             RegisterNotExists)
+# Times an update that keeps failing is processed before it is dropped
+ATTEMPTS = 5
+# Seconds to wait before processing again an update that failed
+RETRY = 5
+
+UPDATES = metrics.histogram("telegram_updates_batch_size",
+                            "Updates received in every getUpdates batch",
+                            buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+
 
 class BotException(Exception):
     pass
 
 
 class Bot:
-    @log.debug
+    @traced
     def __init__(self, token, chat_id, thread_id, ia_access: str,
                  ia_secret: str, podcast: str, creator: str,
-                 register: Register, pool_time=300):
+                 register: Register, pool_time=300, workers=2,
+                 sessions=128, session_ttl=86400, streaming=False,
+                 segment_threshold=0,
+                 transcoder: TranscodePool | None = None,
+                 profile=profiles.DEFAULT.name, derivatives=[],
+                 waveform=False, analysis=False, loudness=-16.0,
+                 duplicates=True, files_dir="/data/archivebot",
+                 volume="/data", storage_budget=0,
+                 retention=7 * 86400, s3_endpoint=ENDPOINT,
+                 upload_workers=4, upload_rate=0, ia_host=HOST,
+                 sync_interval=300, sync_concurrency=4,
+                 reconcile_interval=60, reconcile_batch=20,
+                 publish_windows=[], publish_threshold=20 * 1024 * 1024):
         self._pool_time = pool_time
+        self._streaming = streaming
+        self._segment_threshold = segment_threshold
+        self._profile = profile
+        self._derivatives = derivatives
+        self._waveform = waveform
+        self._analysis = analysis
+        self._loudness = loudness
+        self._transcoder = transcoder or TranscodePool()
         self._telegram_client = TelegramClient(token)
         self._token = token
         self._chat_id = int(chat_id)
         self._thread_id = int(thread_id)
         self._iauploader = IAUploader(token, ia_access, ia_secret, podcast,
-                                      creator)
+                                      creator, register, s3_endpoint,
+                                      upload_workers, upload_rate,
+                                      host=ia_host)
         self._register = register
-        self._context = Context()
-        self._read_config()
+        self._files = FileStore(register, self._telegram_client, token,
+                                files_dir, volume)
+        self._storage = StorageManager(register, self._files, storage_budget,
+                                       retention)
+        self._sync = MetadataSync(register, self._iauploader.client,
+                                  self._iauploader.metadata, sync_interval,
+                                  concurrency=sync_concurrency)
+        self._sessions = SessionStore(register, sessions, session_ttl)
+        self._jobs = JobQueue(register)
+        self._workers = WorkerPool(self._jobs, {"publish": self.publish},
+                                   workers)
+        self._scheduler = PublishScheduler(register, publish_windows,
+                                           publish_threshold)
+        self._reconciler = Reconciler(
+            register, self._jobs,
+            {"chat_id": self._chat_id, "thread_id": self._thread_id},
+            reconcile_interval, reconcile_batch)
+        self._outbound = OutboundScheduler(self._telegram_client)
+        self._updates = UpdateLedger(register)
+        self._failures = {}
+        self._fingerprints = FingerprintIndex(register) if duplicates \
+            else None
+        self._import_config()
 
-    @log.debug
-    def _read_config(self) -> None:
-        if os.path.exists(CONFIG):
+    @traced
+    def _import_config(self) -> None:
+        """Take the offset of the config.json of previous versions"""
+        if os.path.exists(CONFIG) and self._updates.offset == 0:
             with open(CONFIG, "r") as fr:
                 config = json.load(fr)
-                self._offset = config["offset"]
-        else:
-            self._offset = 0
+                self._updates.set_offset(config["offset"])
 
-    @log.debug
-    def _save_config(self) -> None:
-        with open(CONFIG, "w") as fw:
-            config = {
-                "offset": self._offset
-            }
-            json.dump(config, fw)
+    @property
+    def _offset(self) -> int:
+        return self._updates.offset
 
-    @log.debug
+    @traced
     def get_updates(self):
         response = self._telegram_client.get_updates(self._offset,
                                                      self._pool_time)
-        if response["ok"] and response["result"]:
-            offset = max([item["update_id"] for item in response["result"]])
-            self._offset = offset + 1
-            self._save_config()
-            self._process_response(response)
-
-    @log.debug
-    def process_voice(self, message):
-        logger.debug(f"Message: {message}")
+        if self._accept_updates(response) and \
+                not self._process_response(response):
+            time.sleep(RETRY)
+
+    def _accept_updates(self, response) -> bool:
+        if response["ok"]:
+            UPDATES.observe(len(response["result"]))
+        return bool(response["ok"] and response["result"])
+
+    async def run(self):
+        """Long poll for updates without blocking on heavy work
+
+        Updates are processed one batch at a time in a worker thread,
+        while conversions and uploads run in the job workers, so the
+        bot keeps polling and answering while they are in progress.
+        """
+        client = AsyncTelegramClient(self._token)
+        self._start()
+        try:
+            await client.delete_webhook()
+            while True:
+                try:
+                    response = await client.get_updates(self._offset,
+                                                        self._pool_time)
+                except Exception as exception:
+                    logger.error(exception)
+                    await asyncio.sleep(5)
+                    continue
+                if self._accept_updates(response) and \
+                        not await asyncio.to_thread(self._process_response,
+                                                    response):
+                    await asyncio.sleep(RETRY)
+        finally:
+            client.close()
+            self._stop()
+
+    async def listen(self, url: str, port: int = 8080, host: str = "0.0.0.0",
+                     secret_token: str = ""):
+        """Receive the updates through a webhook instead of long polling
+
+        The webhook is registered with `setWebhook` and the updates go
+        through the same dispatch as the polled ones.
+        """
+        path = urlparse(url).path or "/"
+        server = WebhookServer(self.dispatch, self._updates, host, port,
+                               path, secret_token)
+        client = AsyncTelegramClient(self._token)
+        self._start()
+        server.start()
+        try:
+            response = await client.set_webhook(url, secret_token)
+            logger.info("Webhook %s: %s", url, response)
+            await asyncio.Event().wait()
+        finally:
+            server.stop()
+            client.close()
+            self._stop()
+
+    def _start(self):
+        self._outbound.start()
+        self._transcoder.start()
+        self._workers.start()
+        self._storage.start()
+        self._sync.start()
+        self._reconciler.start()
+
+    def _stop(self):
+        self._reconciler.stop(timeout=5)
+        self._sync.stop(timeout=5)
+        self._storage.stop(timeout=5)
+        self._transcoder.stop(timeout=5)
+        self._workers.stop(timeout=5)
+        self._outbound.stop(timeout=5)
+
+    def dispatch(self, update: dict) -> bool:
+        return self._process_response({"ok": True, "result": [update]})
+
+    def _session(self, message: dict, user: dict) -> Context:
+        chat_id = message["chat"]["id"]
+        thread_id = message.get("message_thread_id", 0)
+        return self._sessions.get(chat_id, thread_id, user["id"])
+
+    def _accepts(self, chat_id: int, thread_id: int) -> bool:
+        if chat_id != self._chat_id:
+            logger.debug("%s <=> %s", chat_id, self._chat_id)
+            return False
+        if self._thread_id and thread_id != self._thread_id:
+            logger.debug("%s <=> %s", thread_id, self._thread_id)
+            return False
+        return True
+
+    def _prepare_voice(self, message) -> dict:
+        """The network and ffmpeg work of a voice note, done beforehand
+
+        Returns the getFile result and the fingerprint of the voice note
+        and the audios it is similar to, so `process_voice` only touches
+        the database.
+        """
         voice = message["message"]["voice"]
-        audio = self._register.new(voice)
-        logger.debug("===========================")
-        logger.debug(type(audio))
-        logger.debug(audio)
-        logger.debug("===========================")
-        file_id = audio.file_id
-        file_info = self._telegram_client.get_file_info(file_id)
+        file_info = self._files.file_info(voice["file_id"],
+                                          voice["file_unique_id"])
         logger.debug(file_info)
-        audio = self._register.set_file_path(file_id, file_info["file_path"])
+        prepared = {"file_info": file_info, "fingerprint": None,
+                    "similar": []}
+        if self._fingerprints is None:
+            return prepared
+        try:
+            note = Audio(file_id=voice["file_id"],
+                         file_unique_id=voice["file_unique_id"],
+                         file_path=file_info["file_path"])
+            values = fingerprint(self._files.fetch(note).path)
+            prepared["similar"] = self._fingerprints.similar(values, "")
+            prepared["fingerprint"] = values
+        except Exception as exception:
+            logger.warning("Can not fingerprint %s: %s",
+                           voice["file_unique_id"], exception)
+        return prepared
+
+    @traced
+    def process_voice(self, message, prepared: dict | None = None):
+        logger.debug("Message: %s", Payload(message))
+        if prepared is None:
+            prepared = self._prepare_voice(message)
+        context = self._session(message["message"],
+                                message["message"]["from"])
+        voice = message["message"]["voice"]
+        try:
+            audio = self._register.new(voice)
+            self._iauploader.client.created(audio.identifier)
+        except RegisterExists:
+            audio = self._register.get_by_file_unique_id(
+                voice["file_unique_id"])
+            if audio.state != State.DRAFT:
+                title = audio.title or audio.identifier
+                self._outbound.send_message(
+                    f"⚠️ Este audio ya está registrado como «{title}»",
+                    context.chat_id, context.thread_id)
+                return
+            # A draft whose session was lost, it is edited again
+            logger.info("Resuming the draft %s", audio.identifier)
+        logger.debug(audio)
+        audio = self._register.set_file_path(
+            audio.file_id, prepared["file_info"]["file_path"])
         logger.debug(audio)
-        self._context.step = 1
-        self._context.audio = audio
+        self._warn_duplicate(audio, context, prepared)
+        context.step = 1
+        context.audio = audio
+        self._sessions.save(context)
         message = ("A continuación, te preguntaré primero por el título,"
                    " luego por la descripción, y por último por las"
                    " etiquetas. En cada paso te preguntaré si quieres"
                    " continuar o modificar")
-        self._telegram_client.send_message(message,
-                                           self._chat_id,
-                                           self._thread_id)
-        self._telegram_client.send_message("Dime el título", self._chat_id,
-                                           self._thread_id)
+        self._outbound.send_message(message, context.chat_id,
+                                    context.thread_id)
+        self._outbound.send_message("Dime el título", context.chat_id,
+                                    context.thread_id)
 
-    @log.debug
+    @traced
     def process_callback_query(self, message):
-        logger.debug(f"Message: {message}")
+        logger.debug("Message: %s", Payload(message))
+        context = self._session(message["callback_query"]["message"],
+                                message["callback_query"]["from"])
+        chat_id = context.chat_id
+        thread_id = context.thread_id
         data = message["callback_query"]["data"]
-        if self._context.step == 2:
+        if context.step == 2:
             if data == "Continuar":
                 message = "Dime la descripción"
             else:
-                self._context.step = 1
+                context.step = 1
                 message = "Dime el título"
-            self._telegram_client.send_message(
-                message, self._chat_id, self._thread_id)
-        elif self._context.step == 3:
+            self._sessions.save(context)
+            self._outbound.send_message(message, chat_id, thread_id)
+        elif context.step == 3:
             if data == "Continuar":
                 message = "Dime las etiquetas separadas por comas"
             else:
                 message = "Dime la descripción"
-                self._context.step = 2
-            self._telegram_client.send_message(
-                message, self._chat_id, self._thread_id)
-        elif self._context.step == 4:
+                context.step = 2
+            self._sessions.save(context)
+            self._outbound.send_message(message, chat_id, thread_id)
+        elif context.step == 4:
             if data == "Continuar":
                 message = ("El audio queda así:\n"
-                           f"Título: {self._context.audio.title}\n"
-                           f"Descripción: {self._context.audio.description}\n"
-                           f"Etiquetas: {self._context.audio.tags}")
-                self._context.step = 5
-                self._telegram_client.send_question(
-                    message, self._chat_id,
-                    ["Enviar", "Borrar"], self._thread_id)
+                           f"Título: {context.audio.title}\n"
+                           f"Descripción: {context.audio.description}\n"
+                           f"Etiquetas: {context.audio.tags}")
+                context.step = 5
+                self._sessions.save(context)
+                self._outbound.send_question(
+                    message, chat_id, ["Enviar", "Borrar"], thread_id)
             else:
                 message = "Dime las etiquetas separadas por comas"
-                self._context.step = 3
-                self._telegram_client.send_message(
-                    message, self._chat_id, self._thread_id)
-        elif self._context.step == 5:
+                context.step = 3
+                self._sessions.save(context)
+                self._outbound.send_message(message, chat_id,
+                                            thread_id)
+        elif context.step == 5:
             if data == "Enviar":
-                self.upload_audio()
+                self.upload_audio(context)
             else:
-                self.delete_audio()
+                self.delete_audio(context)
+            self._sessions.drop(context)
 
-    @log.debug
+    @traced
     def process_text(self, message):
-        logger.debug(f"Message: {message}")
+        logger.debug("Message: %s", Payload(message))
+        context = self._session(message["message"],
+                                message["message"]["from"])
+        chat_id = context.chat_id
+        thread_id = context.thread_id
         text = message["message"]["text"]
-        logger.debug(f"Text: {text}")
-        if self._context.step == 1:
-            audio = self._register.set_title(self._context.audio.identifier,
-                                             text)
-            self._context.audio = audio
-            self._context.step = 2
+        logger.debug("Text: %s", Payload(text))
+        if context.step == 1:
+            audio = self._register.set_title(context.audio.identifier, text)
+            context.audio = audio
+            context.step = 2
+            self._sessions.save(context)
             message_id = message["message"]["message_id"]
-            self._telegram_client.set_reaction(self._chat_id, message_id, OK)
-            self._telegram_client.send_question(
-                f"Título: {text}", self._chat_id,
-                ["Continuar", "Modificar"], self._thread_id)
-        elif self._context.step == 2:
+            self._outbound.set_reaction(chat_id, message_id, OK)
+            self._outbound.send_question(
+                f"Título: {text}", chat_id,
+                ["Continuar", "Modificar"], thread_id)
+        elif context.step == 2:
             audio = self._register.set_description(
-                self._context.audio.identifier, text)
-            self._context.audio = audio
-            self._context.step = 3
+                context.audio.identifier, text)
+            context.audio = audio
+            context.step = 3
+            self._sessions.save(context)
             message_id = message["message"]["message_id"]
-            self._telegram_client.set_reaction(self._chat_id, message_id, OK)
-            self._telegram_client.send_question(
-                f"Descripción: {text}", self._chat_id,
-                ["Continuar", "Modificar"], self._thread_id)
-        elif self._context.step == 3:
+            self._outbound.set_reaction(chat_id, message_id, OK)
+            self._outbound.send_question(
+                f"Descripción: {text}", chat_id,
+                ["Continuar", "Modificar"], thread_id)
+        elif context.step == 3:
             tags = ",".join([tag.strip() for tag in text.split(",")])
-            audio = self._register.set_tags(
-                self._context.audio.identifier, tags)
-            self._context.audio = audio
-            self._context.step = 4
+            audio = self._register.set_tags(context.audio.identifier, tags)
+            context.audio = audio
+            context.step = 4
+            self._sessions.save(context)
             message_id = message["message"]["message_id"]
-            self._telegram_client.set_reaction(self._chat_id, message_id, OK)
-            self._telegram_client.send_question(
-                f"Etiquetas: {text}", self._chat_id,
-                ["Continuar", "Modificar"], self._thread_id)
-        elif self._context.step == 4:
+            self._outbound.set_reaction(chat_id, message_id, OK)
+            self._outbound.send_question(
+                f"Etiquetas: {text}", chat_id,
+                ["Continuar", "Modificar"], thread_id)
+        elif context.step == 4:
             pass
 
         if text.startswith("/help") or text.startswith("/ayuda"):
@@ -204,89 +411,315 @@ class Bot:
             msg = f"The command {command} is not implemented"
             raise BotException(msg)
 
-    @log.debug
-    def _process_response(self, response):
-        chat_id = None
-        thread_id = 0
-        for index, message in enumerate(response["result"]):
-            logger.debug(f"Number: {index}. Message: {message}")
+    @staticmethod
+    def _origin(update: dict) -> tuple[int | None, int]:
+        if "message" in update:
+            message = update["message"]
+        elif "callback_query" in update:
+            message = update["callback_query"]["message"]
+        else:
+            return None, 0
+        return message["chat"]["id"], message.get("message_thread_id", 0)
+
+    @traced
+    def _process_response(self, response) -> bool:
+        """Process a batch of updates in order
+
+        An update is recorded as processed when it succeeds, when it
+        fails in a way that would fail again, or after `ATTEMPTS` tries.
+        Any other failure stops the batch, so the offset is not moved
+        past the update, and returns False to retry it later.
+        """
+        for index, update in enumerate(response["result"]):
+            logger.debug("Number: %s. Message: %s", index, Payload(update))
+            update_id = update["update_id"]
             try:
-                if "message" in message:
-                    logger.debug("Es una respuesta message")
-                    chat_id = message["message"]["chat"]["id"]
-                    thread_id = message["message"]["message_thread_id"] if \
-                        "message_thread_id" in message["message"] else 0
-                    if chat_id != self._chat_id or \
-                            thread_id != self._thread_id:
-                        logger.debug(f"{chat_id} <=> {self._chat_id}")
-                        logger.debug(f"{thread_id} <=> {self._thread_id}")
-                        logger.debug("Me salgo")
-                        return
-                    if "voice" in message["message"]:
-                        logger.debug("Es un mensaje de voz")
-                        self.process_voice(message)
-                    elif "text" in message["message"]:
-                        logger.debug("Es un mensaje de texto")
-                        self.process_text(message)
-                    else:
-                        logger.debug("No es nada?")
-                elif "callback_query" in message:
-                    logger.debug("Es una respuesta callback")
-                    chat_id = \
-                        message["callback_query"]["message"]["chat"]["id"]
-                    if chat_id != self._chat_id:
-                        logger.debug(f"{chat_id} <=> {self._chat_id}")
-                        logger.debug("Me salgo")
-                        return
-                    self.process_callback_query(message)
-                else:
-                    logger.debug("No es nada?")
+                if self._updates.is_processed(update_id):
+                    logger.debug("Ya procesado: %s", update_id)
+                    continue
+                # Network and ffmpeg work stays out of the transaction,
+                # which holds the only writer, and messages are sent only
+                # once it commits
+                prepared = self._prepare(update)
+                with self._outbound.deferred(), \
+                        self._register.transaction():
+                    if self._updates.is_processed(update_id):
+                        logger.debug("Ya procesado: %s", update_id)
+                        continue
+                    self._process_update(update, prepared)
+                    self._updates.processed(update_id)
             except Exception as exception:
+                # The changes were rolled back, so are the cached sessions
+                self._sessions.invalidate()
+                attempts = self._failures.get(update_id, 0) + 1
+                if not isinstance(exception, PERMANENT) and \
+                        attempts < ATTEMPTS:
+                    logger.warning("Update %s failed, it will be retried:"
+                                   " %s", update_id, exception)
+                    self._failures[update_id] = attempts
+                    return False
+                logger.error("Update %s failed: %s", update_id, exception)
+                try:
+                    self._updates.processed(update_id)
+                except Exception as error:
+                    logger.error("Can not record update %s: %s", update_id,
+                                 error)
+                    return False
+                self._failures.pop(update_id, None)
+                chat_id, thread_id = self._origin(update)
                 if chat_id:
-                    logger.error(exception)
-                    self._telegram_client.send_message(str(exception), chat_id,
-                                                       thread_id)
+                    self._outbound.send_message(str(exception), chat_id,
+                                                thread_id)
+                continue
+            self._failures.pop(update_id, None)
+        return True
+
+    def _prepare(self, update: dict) -> dict | None:
+        chat_id, thread_id = self._origin(update)
+        if chat_id is None or not self._accepts(chat_id, thread_id) or \
+                "voice" not in update.get("message", {}):
+            return None
+        return self._prepare_voice(update)
+
+    def _process_update(self, update: dict, prepared: dict | None = None):
+        chat_id, thread_id = self._origin(update)
+        if chat_id is None:
+            logger.debug("No es nada?")
+        elif not self._accepts(chat_id, thread_id):
+            logger.debug("Me salto el mensaje")
+        elif "callback_query" in update:
+            logger.debug("Es una respuesta callback")
+            self.process_callback_query(update)
+        elif "voice" in update["message"]:
+            logger.debug("Es un mensaje de voz")
+            self.process_voice(update, prepared)
+        elif "text" in update["message"]:
+            logger.debug("Es un mensaje de texto")
+            self.process_text(update)
+        else:
+            logger.debug("No es nada?")
 
-    @log.debug
+    @traced
     def process_help(self, message):
         chat_id = message["message"]["chat"]["id"]
         thread_id = message["message"]["message_thread_id"] if \
             "message_thread_id" in message["message"] else 0
         strbuf = StringIO()
         strbuf.write(f"`/ayuda` {HAND} muestra esta ayuda\n")
-        self._telegram_client.send_message(strbuf.getvalue(), chat_id,
-                                           thread_id)
-
-    @log.debug
-    def delete_audio(self):
-        audio = self._context.audio
-        file_path = audio.file_path.split("/")
-        filename = f"/data/{self._token}/voice/{file_path[-1]}"
-        logger.debug(filename)
-        os.remove(filename)
-        self._telegram_client.send_message("Archivo borrado",
-                                           self._chat_id,
-                                           self._thread_id)
+        self._outbound.send_message(strbuf.getvalue(), chat_id,
+                                    thread_id)
+
+    def _warn_duplicate(self, audio: Audio, context: Context,
+                        prepared: dict) -> None:
+        """Index the fingerprint of a new audio, warn if it was already sent"""
+        if self._fingerprints is None or prepared["fingerprint"] is None:
+            return
+        self._fingerprints.add(audio.identifier, prepared["fingerprint"])
+        for identifier, _ in prepared["similar"]:
+            if identifier == audio.identifier:
+                continue
+            original = self._register.get(identifier)
+            title = original.title or original.identifier
+            self._outbound.send_message(
+                f"⚠️ Este audio parece una copia de «{title}», que ya"
+                " está registrado", context.chat_id, context.thread_id)
+
+    @traced
+    def delete_audio(self, context: Context):
+        audio = context.audio
+        self._files.forget(audio)
+        self._outbound.send_message("Archivo borrado",
+                                    context.chat_id,
+                                    context.thread_id)
         self._register.delete(audio.identifier)
-        self._telegram_client.send_message("Audio borrado",
-                                           self._chat_id,
-                                           self._thread_id)
-
-    @log.debug
-    def upload_audio(self):
-        audio = self._context.audio
-        file_path = audio.file_path.split("/")
-        filename = f"/data/{self._token}/voice/{file_path[-1]}"
+        self._sync.forget(audio.identifier)
+        if self._fingerprints is not None:
+            self._fingerprints.remove(audio.identifier)
+        self._outbound.send_message("Audio borrado",
+                                    context.chat_id,
+                                    context.thread_id)
+
+    @traced
+    def upload_audio(self, context: Context):
+        payload = {
+            "identifier": context.audio.identifier,
+            "chat_id": context.chat_id,
+            "thread_id": context.thread_id,
+        }
+        audio = self._register.get(context.audio.identifier)
+        now = datetime.now()
+        publish_at = self._scheduler.schedule(self._estimate(audio), now)
+        delay = (publish_at - now).total_seconds()
+        self._register.set_publish_at(audio.identifier,
+                                      publish_at if delay else None)
+        self._register.set_state(audio.identifier, State.QUEUED)
+        job = self._jobs.enqueue("publish", payload, delay)
+        logger.debug(job)
+        if delay:
+            message = ("Audio en cola para publicar el"
+                       f" {publish_at:%d/%m a las %H:%M}")
+        else:
+            message = "Audio en cola para publicar"
+        self._outbound.send_message(message, context.chat_id,
+                                    context.thread_id)
+
+    def _estimate(self, audio: Audio) -> int:
+        """Bytes the publication of an audio uploads, roughly"""
+        names = self._derivatives or [self._profile]
+        return sum(profiles.select(audio.mime_type, name).size(
+            audio.duration, audio.file_size) for name in names)
+
+    @staticmethod
+    def _output_path(filename: str, profile: profiles.Profile) -> str:
+        base, extension = os.path.splitext(filename)
+        if extension == f".{profile.extension}":
+            base = f"{base}-{profile.name}"
+        return f"{base}.{profile.extension}"
+
+    def _variant(self, name: str) -> str:
+        """Name of the encode settings, for the cache of encodes"""
+        if self._analysis:
+            return f"{name}-{self._loudness:g}lufs"
+        return name
+
+    @traced
+    def publish(self, job: Job):
+        """Publish an audio, moving it through the states of publication
+
+        The audio fails when its job runs out of attempts, and it is
+        published when the upload finishes.
+        """
+        identifier = job.payload["identifier"]
+        if self._register.get(identifier).state == State.PUBLISHED:
+            return
+        self._register.set_state(identifier, State.PUBLISHING)
+        try:
+            self._publish(job)
+        except Exception:
+            if job.attempts >= job.max_attempts:
+                self._register.set_state(identifier, State.FAILED)
+            raise
+        self._register.set_state(identifier, State.PUBLISHED)
+
+    def _publish(self, job: Job):
+        chat_id = job.payload["chat_id"]
+        thread_id = job.payload["thread_id"]
+        audio = self._register.get(job.payload["identifier"])
+        if job.stage == "uploaded":
+            return
+        # The checksum is only kept right before the first upload, an
+        # audio without one has nothing in Internet Archive yet
+        new = not audio.md5
+        stored = self._files.fetch(audio)
+        filename = stored.path
         logger.debug(filename)
-        outputfile = f"{os.path.splitext(filename)[0]}.mp3"
-        logger.debug(outputfile)
-        Converter.convert(filename, outputfile)
-        self._telegram_client.send_message("Convertido a mp3",
-                                           self._chat_id,
-                                           self._thread_id)
-        self._telegram_client.send_chat_action(self._chat_id, self._thread_id,
-                                               "upload_voice")
-        self._iauploader.upload(audio, outputfile)
-        self._telegram_client.send_message("Subido a Internet Archive!",
-                                           self._chat_id,
-                                           self._thread_id)
+        profile = profiles.select(audio.mime_type, self._profile)
+        # Files keep the name Telegram gave them in Internet Archive
+        name = self._output_path(os.path.basename(audio.file_path), profile)
+        # Seekable profiles can not be written to a pipe
+        if self._streaming and not profile.seekable:
+            self._outbound.send_chat_action(chat_id, thread_id,
+                                            "upload_voice")
+            analysis = self._analyze(filename)
+            with self._transcoder.stream(filename, profile, audio.duration,
+                                         analysis) as stream:
+                digest = self._iauploader.upload_stream(audio, stream, name,
+                                                        stream.result)
+            self._register.set_checksum(audio.identifier, digest.checksum())
+            self._sync.uploaded(audio)
+            job = self._jobs.set_stage(job, "uploaded")
+            self._outbound.send_message("Subido a Internet Archive!",
+                                        chat_id, thread_id)
+            return
+        if self._derivatives:
+            files = self._encode_derivatives(job, audio, stored)
+        else:
+            variant = self._variant(profile.name)
+            rendition = self._files.rendition(stored, variant)
+            if rendition is None:
+                outputfile = self._files.rendition_path(stored, variant,
+                                                        profile.extension)
+                analysis = self._analyze(filename)
+                if self._segment_threshold and not profile.passthrough and \
+                        audio.duration >= self._segment_threshold:
+                    digest = self._transcoder.convert_segmented(
+                        filename, outputfile, audio.duration,
+                        profile=profile, analysis=analysis)
+                else:
+                    digest = self._transcoder.convert(filename, outputfile,
+                                                      audio.duration,
+                                                      profile, analysis)
+                rendition = self._files.keep(stored, variant, outputfile,
+                                             digest)
+                job = self._jobs.set_stage(job, "converted")
+                self._outbound.send_message(
+                    f"Convertido a {profile.extension}", chat_id, thread_id)
+            files = {name: rendition}
+        # The first file is the main one, its checksum goes in the register
+        main = next(iter(files.values()))
+        audio = self._register.set_checksum(audio.identifier, main.checksum)
+        self._outbound.send_chat_action(chat_id, thread_id, "upload_voice")
+        self._iauploader.upload(
+            audio, {name: item.path for name, item in files.items()},
+            {name: item.checksum for name, item in files.items()}, new)
+        self._sync.uploaded(audio)
+        job = self._jobs.set_stage(job, "uploaded")
+        self._outbound.send_message("Subido a Internet Archive!",
+                                    chat_id, thread_id)
+
+    def _analyze(self, filename: str) -> Analysis | None:
+        """Trim points and gain for the encode, if the analysis is on"""
+        if not self._analysis:
+            return None
+        try:
+            return analyze(filename, self._loudness)
+        except Exception as exception:
+            logger.warning("Can not analyze %s: %s", filename, exception)
+            return None
+
+    def _encode_derivatives(self, job: Job, audio: Audio,
+                            stored: StoredFile) -> dict[str, Rendition]:
+        """Encode every derivative format decoding the voice note once
+
+        Returns the encodes by the name they get in Internet Archive.
+        """
+        base, extension = os.path.splitext(os.path.basename(audio.file_path))
+        names = []
+        outputs = []
+        cached = []
+        extensions = {extension}
+        for name in self._derivatives:
+            profile = profiles.select(audio.mime_type, name)
+            extension = f".{profile.extension}"
+            suffix = f"-{profile.name}" if extension in extensions else ""
+            extensions.add(extension)
+            names.append(f"{base}{suffix}{extension}")
+            variant = self._variant(profile.name)
+            cached.append(self._files.rendition(stored, variant))
+            outputs.append((self._files.rendition_path(stored, variant,
+                                                       profile.extension),
+                            profile))
+        waveform = ""
+        if self._waveform:
+            names.append(f"{base}.png")
+            variant = self._variant("waveform")
+            cached.append(self._files.rendition(stored, variant))
+            waveform = self._files.rendition_path(stored, variant, "png")
+        if all(cached):
+            return dict(zip(names, cached))
+        checksums = self._transcoder.derivatives(stored.path, outputs,
+                                                 waveform, audio.duration,
+                                                 self._analyze(stored.path))
+        renditions = [self._files.keep(stored, self._variant(profile.name),
+                                       file_to, checksums[file_to])
+                      for file_to, profile in outputs]
+        if waveform:
+            renditions.append(self._files.keep(
+                stored, self._variant("waveform"), waveform,
+                checksums[waveform]))
+        self._jobs.set_stage(job, "converted")
+        formats = ", ".join(profile.extension for _, profile in outputs)
+        self._outbound.send_message(f"Convertido a {formats}",
+                                    job.payload["chat_id"],
+                                    job.payload["thread_id"])
+        return dict(zip(names, renditions))
@@ -30,5 +30,12 @@ logger = logging.getLogger(__name__)
 
 
 class Context(BaseModel):
+    chat_id: int = 0
+    thread_id: int = 0
+    user_id: int = 0
     step: int = 0
     audio: Audio = Audio()
+
+    @property
+    def key(self) -> tuple[int, int, int]:
+        return (self.chat_id, self.thread_id, self.user_id)
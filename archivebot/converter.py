@@ -22,16 +22,285 @@
 # SOFTWARE.
 
 import logging
+import metrics
+import os
+import subprocess
+import tempfile
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from plumbum import local
+from analysis import Analysis
+from instrumentation import Payload
+from profiles import DEFAULT, Profile
+
+WAVEFORM = ("aformat=channel_layouts=mono,"
+            "showwavespic=s=1200x240:colors=#1f77b4[waveform]")
 
 logger = logging.getLogger(__name__)
 
+SECONDS = metrics.histogram("ffmpeg_seconds", "Wall time of ffmpeg runs")
+REALTIME = metrics.histogram(
+    "ffmpeg_realtime_factor",
+    "Seconds of audio converted per second of ffmpeg wall time",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+
+class ConverterException(Exception):
+    pass
+
+
+class EncodedStream:
+    """The encoded audio ffmpeg writes to a pipe, read as a file
+
+    `result` waits for ffmpeg and raises if the encode failed, so the
+    consumer can tell a complete stream from a truncated one.
+    """
+
+    def __init__(self, pipe, result: Callable[[], None]):
+        self._pipe = pipe
+        self._result = result
+
+    def read(self, size: int = -1) -> bytes:
+        return self._pipe.read(size)
+
+    def result(self) -> None:
+        self._result()
+
 
 class Converter:
 
     @staticmethod
-    def convert(file_from: str, file_to: str):
-        logger.debug(f"From: {file_from} to: {file_to}")
+    def edit(analysis: Analysis | None,
+             profile: Profile = DEFAULT) -> list[str]:
+        """The output options that apply the trim and gain of an analysis
+
+        A passthrough profile is only trimmed, as the gain needs to
+        decode the audio.
+        """
+        if analysis is None:
+            return []
+        arguments = []
+        if analysis.trim_start > 0:
+            arguments += ["-ss", f"{analysis.trim_start:.3f}"]
+        if analysis.trim_end < analysis.duration:
+            length = analysis.trim_end - analysis.trim_start
+            arguments += ["-t", f"{length:.3f}"]
+        if analysis.gain and not profile.passthrough:
+            arguments += ["-af", f"volume={analysis.gain:.2f}dB"]
+        return arguments
+
+    @staticmethod
+    def arguments(file_from: str, file_to: str, profile: Profile = DEFAULT,
+                  muxer: bool = False,
+                  analysis: Analysis | None = None) -> list[str]:
+        """The ffmpeg arguments that convert a file into another
+
+        A passthrough profile copies the audio stream into the new
+        container without decoding it. Set `muxer` when the container
+        cannot be guessed from `file_to`, such as for a pipe.
+        """
+        container = ["-f", profile.format] if muxer else []
+        return ["-nostdin", "-y", "-i", file_from, "-map", "0:a",
+                *Converter.edit(analysis, profile), *profile.arguments,
+                *container, file_to]
+
+    @staticmethod
+    def derivatives_arguments(file_from: str,
+                              outputs: list[tuple[str, Profile]],
+                              waveform: str = "",
+                              analysis: Analysis | None = None) -> list[str]:
+        """The ffmpeg arguments that write several encodes in one run
+
+        The input is decoded once and every output maps the same decoded
+        stream, optionally with a waveform picture of the whole audio.
+        """
+        arguments = ["-nostdin", "-y", "-i", file_from]
+        for file_to, profile in outputs:
+            arguments += ["-map", "0:a", *Converter.edit(analysis, profile),
+                          *profile.arguments, "-f", profile.format, file_to]
+        if waveform:
+            trim = ""
+            if analysis is not None:
+                trim = (f"atrim={analysis.trim_start:.3f}:"
+                        f"{analysis.trim_end:.3f},")
+            arguments += ["-filter_complex", f"[0:a]{trim}{WAVEFORM}",
+                          "-map", "[waveform]", "-frames:v", "1", waveform]
+        return arguments
+
+    @staticmethod
+    def derivatives(file_from: str, outputs: list[tuple[str, Profile]],
+                    waveform: str = "", duration: int = 0,
+                    analysis: Analysis | None = None):
+        logger.debug("From: %s to: %s", file_from, outputs)
+        ffmpeg = local["ffmpeg"]
+        start = time.perf_counter()
+        ffmpeg[Converter.derivatives_arguments(file_from, outputs,
+                                               waveform, analysis)]()
+        elapsed = time.perf_counter() - start
+        SECONDS.observe(elapsed)
+        if duration and elapsed:
+            REALTIME.observe(duration / elapsed)
+
+    @staticmethod
+    def convert(file_from: str, file_to: str, duration: int = 0,
+                profile: Profile = DEFAULT,
+                analysis: Analysis | None = None):
+        logger.debug("From: %s to: %s (%s)", file_from, file_to,
+                     profile.name)
+        ffmpeg = local["ffmpeg"]
+        start = time.perf_counter()
+        result = ffmpeg[Converter.arguments(file_from, file_to, profile,
+                                            analysis=analysis)]()
+        elapsed = time.perf_counter() - start
+        SECONDS.observe(elapsed)
+        if duration and elapsed:
+            REALTIME.observe(duration / elapsed)
+        logger.debug("%s", Payload(result))
+
+    @staticmethod
+    @contextmanager
+    def stream(file_from: str, profile: Profile = DEFAULT,
+               duration: int = 0, analysis: Analysis | None = None):
+        """Convert to a pipe instead of a file
+
+        Yields an `EncodedStream` of the pipe where ffmpeg writes the
+        encoded audio, so it can be consumed while it is produced.
+        """
+        logger.debug("From: %s to a %s pipe", file_from, profile.name)
+        ffmpeg = local["ffmpeg"]
+        command = ffmpeg["-v", "error",
+                         Converter.arguments(file_from, "pipe:1", profile,
+                                             muxer=True,
+                                             analysis=analysis)]
+        start = time.perf_counter()
+        with tempfile.TemporaryFile() as errors:
+            process = command.popen(stdout=subprocess.PIPE, stderr=errors)
+
+            def result() -> None:
+                if process.wait() != 0:
+                    errors.seek(0)
+                    message = errors.read().decode("utf-8", "replace")
+                    raise ConverterException(
+                        f"ffmpeg exited with {process.returncode}:"
+                        f" {message}")
+            try:
+                yield EncodedStream(process.stdout, result)
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+            finally:
+                process.stdout.close()
+            result()
+        elapsed = time.perf_counter() - start
+        SECONDS.observe(elapsed)
+        if duration and elapsed:
+            REALTIME.observe(duration / elapsed)
+
+    @staticmethod
+    def boundaries(duration: float, segment: float,
+                   silences: list[float] = []) -> list[float]:
+        """Cut points every `segment` seconds, moved to a near silence"""
+        points = []
+        tolerance = segment / 4
+        target = segment
+        while target < duration - tolerance:
+            near = [point for point in silences
+                    if abs(point - target) <= tolerance and
+                    (not points or point > points[-1])]
+            points.append(min(near, key=lambda point: abs(point - target))
+                          if near else target)
+            target = points[-1] + segment
+        return points
+
+    @staticmethod
+    def segments(file_from: str, directory: str, duration: int,
+                 segment: int = 300,
+                 analysis: Analysis | None = None) -> list[list[str]]:
+        """The ffmpeg arguments that cut an audio into decoded segments
+
+        The input is cut every `segment` seconds and every segment is
+        written to `directory` as FLAC, numbered in order. With an
+        analysis, the cuts move to its silences and only the trimmed part
+        of the audio is kept, with its gain applied.
+        """
+        trim_start, trim_end = 0, duration
+        silences = []
+        if analysis is not None:
+            trim_start, trim_end = analysis.trim_start, analysis.trim_end
+            silences = [(first + last) / 2
+                        for first, last in analysis.silences]
+        points = [trim_start] + [
+            trim_start + point for point in Converter.boundaries(
+                trim_end - trim_start, segment,
+                [point - trim_start for point in silences])]
+        edit = []
+        if analysis is not None and analysis.gain:
+            edit = ["-af", f"volume={analysis.gain:.2f}dB"]
+        segments = []
+        for index, begin in enumerate(points):
+            arguments = ["-nostdin", "-y", "-ss", f"{begin:.3f}",
+                         "-i", file_from]
+            if index + 1 < len(points):
+                arguments += ["-t", f"{points[index + 1] - begin:.3f}"]
+            elif analysis is not None:
+                arguments += ["-t", f"{trim_end - begin:.3f}"]
+            arguments += ["-map", "0:a", *edit, "-c:a", "flac",
+                          os.path.join(directory, f"{index:04d}.flac")]
+            segments.append(arguments)
+        return segments
+
+    @staticmethod
+    def join_arguments(directory: str, segments: int, file_to: str,
+                       profile: Profile = DEFAULT,
+                       muxer: bool = False) -> list[str]:
+        """The ffmpeg arguments that encode the joined segments
+
+        Writes the concat playlist of the segments in `directory`.
+        """
+        playlist = os.path.join(directory, "segments.txt")
+        with open(playlist, "w") as fw:
+            for index in range(segments):
+                fw.write(f"file '{index:04d}.flac'\n")
+        arguments = ["-nostdin", "-y", "-f", "concat", "-safe", "0",
+                     "-i", playlist, "-map", "0:a", *profile.arguments]
+        if muxer:
+            arguments += ["-f", profile.format]
+        return arguments + [file_to]
+
+    @staticmethod
+    def convert_segmented(file_from: str, file_to: str, duration: int,
+                          segment: int = 300, workers: int = 0,
+                          profile: Profile = DEFAULT,
+                          analysis: Analysis | None = None):
+        """Convert a long audio decoding its segments in parallel
+
+        The segments are decoded, trimmed and leveled by concurrent
+        ffmpeg processes, one per CPU by default, into lossless FLAC,
+        and then joined and encoded in a single run. Lossy segments
+        joined without re-encoding would carry the encoder delay and
+        padding of every segment to the joins, so the result would not
+        be gapless; the price is that only the decoding and filtering
+        run in parallel, the final encode uses one CPU. That is only
+        worth the temporary FLAC copy and the extra pass when decoding
+        and filtering cost more than the encode.
+        """
+        logger.debug("From: %s to: %s in segments", file_from, file_to)
         ffmpeg = local["ffmpeg"]
-        result = ffmpeg["-i", file_from, file_to]()
-        logger.debug(result)
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as directory:
+            segments = Converter.segments(file_from, directory, duration,
+                                          segment, analysis)
+            with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+                list(executor.map(
+                    lambda arguments: ffmpeg["-v", "error", arguments](),
+                    segments))
+            ffmpeg["-v", "error",
+                   Converter.join_arguments(directory, len(segments),
+                                            file_to, profile)]()
+        elapsed = time.perf_counter() - start
+        SECONDS.observe(elapsed)
+        if duration and elapsed:
+            REALTIME.observe(duration / elapsed)
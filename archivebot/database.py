@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+MIGRATIONS = """
+    CREATE TABLE IF NOT EXISTS schema_migrations(
+        component TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    )
+"""
+PRAGMAS = {
+    "synchronous": "NORMAL",
+    "mmap_size": 268435456,
+    "cache_size": -16384,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseException(Exception):
+    pass
+
+
+class ConnectionPool:
+    """A thread-safe pool of SQLite connections over a WAL database
+
+    There is a single writer connection, serialized by a reentrant lock,
+    and a set of reader connections that can run concurrently with it.
+    Transactions nest: only the outermost one commits or rolls back.
+    A thread that is inside a transaction reads through the writer, so
+    it always sees its own uncommitted changes.
+    """
+
+    def __init__(self, db: str, readers: int = 4,
+                 cached_statements: int = 256):
+        self._db = db
+        self._cached_statements = cached_statements
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        self._readers = queue.Queue()
+        self._size = readers
+        self._opened = 0
+        # Every connection to :memory: is a different database
+        self._pooled = db != ":memory:" and readers > 0
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self._db, check_same_thread=False,
+            cached_statements=self._cached_statements)
+        for pragma, value in PRAGMAS.items():
+            connection.execute(f"PRAGMA {pragma} = {value}")
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """Borrow the writer connection and commit on success"""
+        with self._lock:
+            depth = getattr(self._local, "depth", 0)
+            self._local.depth = depth + 1
+            try:
+                yield self._writer
+                if depth == 0:
+                    self._writer.commit()
+            except Exception:
+                if depth == 0:
+                    self._writer.rollback()
+                raise
+            finally:
+                self._local.depth = depth
+
+    @contextmanager
+    def reader(self):
+        """Borrow a read-only connection"""
+        if not self._pooled or getattr(self._local, "depth", 0) > 0:
+            with self.transaction() as connection:
+                yield connection
+            return
+        connection = self._borrow()
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+            self._readers.put(connection)
+
+    def _borrow(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self._size:
+                self._opened += 1
+                return self._connect()
+        return self._readers.get()
+
+    def migrate(self, component: str, migrations: list[list[str]]) -> int:
+        """Apply the pending migrations of a component
+
+        `migrations` is the ordered list of schema versions, each one a
+        list of statements, or of callables that receive the connection
+        for the steps that SQL alone can not do. The version reached by
+        every component is stored in the `schema_migrations` table.
+        Every version is applied in its own explicit transaction along
+        with its version number, as sqlite3 would run DDL outside of
+        one, so a failed step leaves nothing half applied.
+        """
+        with self._lock:
+            connection = self._writer
+            connection.execute(MIGRATIONS)
+            row = connection.execute(
+                "SELECT version FROM schema_migrations WHERE component = ?",
+                (component,)).fetchone()
+            version = row[0] if row else 0
+            isolation_level = connection.isolation_level
+            connection.isolation_level = None
+            try:
+                for index, statements in enumerate(migrations[version:],
+                                                   start=version + 1):
+                    logger.info("Migrating %s to version %s", component,
+                                index)
+                    connection.execute("BEGIN IMMEDIATE")
+                    try:
+                        for statement in statements:
+                            if callable(statement):
+                                statement(connection)
+                            else:
+                                connection.execute(statement)
+                        connection.execute(
+                            "INSERT INTO schema_migrations (component,"
+                            " version) VALUES (?, ?) ON CONFLICT (component)"
+                            " DO UPDATE SET version = excluded.version",
+                            (component, index))
+                        connection.execute("COMMIT")
+                    except Exception:
+                        connection.execute("ROLLBACK")
+                        raise
+            finally:
+                connection.isolation_level = isolation_level
+        return len(migrations)
+
+    def close(self) -> None:
+        while not self._readers.empty():
+            self._readers.get().close()
+        self._writer.close()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import logging
+import metrics
+import os
+import requests
+import shutil
+import tempfile
+import time
+from pydantic import BaseModel
+from audio import Audio
+from register import Register
+from s3 import Checksum, checksum
+from telegram import TelegramClient
+
+FILES = """
+    CREATE TABLE IF NOT EXISTS files(
+        file_unique_id TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        file_path TEXT DEFAULT "",
+        file_size INTEGER DEFAULT 0,
+        sha256 TEXT DEFAULT "",
+        updated_at REAL NOT NULL
+    )
+"""
+BLOBS = """
+    CREATE TABLE IF NOT EXISTS blobs(
+        sha256 TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        used_at REAL NOT NULL
+    )
+"""
+RENDITIONS = """
+    CREATE TABLE IF NOT EXISTS renditions(
+        sha256 TEXT NOT NULL,
+        variant TEXT NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        used_at REAL NOT NULL,
+        PRIMARY KEY (sha256, variant)
+    )
+"""
+MIGRATIONS = [
+    [
+        FILES,
+        BLOBS,
+        RENDITIONS,
+        "CREATE INDEX IF NOT EXISTS files_sha256 ON files(sha256)",
+    ],
+    [
+        "ALTER TABLE renditions ADD COLUMN md5 TEXT DEFAULT ''",
+        "ALTER TABLE renditions ADD COLUMN sha1 TEXT DEFAULT ''",
+    ],
+]
+CHUNK = 1024 * 1024
+
+CACHE = metrics.counter("file_cache_total",
+                        "Lookups in the file cache", ("kind", "result"))
+DOWNLOADED = metrics.counter("file_download_bytes_total",
+                             "Bytes downloaded from the Bot API",
+                             ("source",))
+
+logger = logging.getLogger(__name__)
+
+
+class FileStoreException(Exception):
+    pass
+
+
+class StoredFile(BaseModel):
+    sha256: str
+    path: str
+    size: int
+
+
+class Rendition(BaseModel):
+    path: str
+    checksum: Checksum
+
+
+class FileStore:
+    """Voice notes and their encodes, stored by content
+
+    Every voice note is copied once into `root`, named after the SHA-256
+    of its content, and found again by its `file_unique_id`. The result
+    of getFile is cached too. The file is taken from the volume shared
+    with the Bot API server when it is mounted, or else downloaded over
+    HTTP. Encodes are kept by the hash of their input and a variant
+    naming the encode settings, so a retry or a copy of an audio is not
+    converted again.
+    """
+
+    def __init__(self, register: Register, client: TelegramClient,
+                 token: str, root: str = "/data/archivebot",
+                 volume: str = "/data",
+                 url: str = "http://telegram-bot-api:8081"):
+        self._register = register
+        self._client = client
+        self._token = token
+        self._root = root
+        self._volume = volume
+        self._url = f"{url}/file/bot{token}"
+        self._session = requests.Session()
+        try:
+            self._register.migrate("files", MIGRATIONS)
+            os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+        except Exception as e:
+            raise FileStoreException(e)
+
+    def file_info(self, file_id: str, file_unique_id: str,
+                  refresh: bool = False) -> dict:
+        """The getFile result of a file, asking Telegram only once"""
+        if not refresh:
+            sql = ("SELECT file_id, file_unique_id, file_path, file_size"
+                   " FROM files WHERE file_unique_id = ? AND file_path != ''")
+            try:
+                with self._register.reader() as connection:
+                    row = connection.execute(sql,
+                                             (file_unique_id,)).fetchone()
+            except Exception as e:
+                raise FileStoreException(e)
+            if row is not None:
+                CACHE.inc(kind="getfile", result="hit")
+                return dict(zip(("file_id", "file_unique_id", "file_path",
+                                 "file_size"), row))
+        CACHE.inc(kind="getfile", result="miss")
+        info = self._client.get_file_info(file_id)
+        sql = ("INSERT INTO files (file_unique_id, file_id, file_path,"
+               " file_size, updated_at) VALUES (?, ?, ?, ?, ?)"
+               " ON CONFLICT (file_unique_id) DO UPDATE SET"
+               " file_id = excluded.file_id,"
+               " file_path = excluded.file_path,"
+               " file_size = excluded.file_size,"
+               " updated_at = excluded.updated_at")
+        data = (file_unique_id, file_id, info.get("file_path", ""),
+                info.get("file_size", 0), time.time())
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(sql, data)
+        except Exception as e:
+            raise FileStoreException(e)
+        return info
+
+    def _relative(self, file_path: str) -> str:
+        """The path of a file below the directory of the bot
+
+        The local Bot API server answers absolute paths of its own
+        filesystem, that directory is the part from the token onwards.
+        """
+        marker = f"/{self._token}/"
+        if marker in file_path:
+            file_path = file_path.split(marker, 1)[1]
+        return file_path.lstrip("/")
+
+    def volume_path(self, file_path: str) -> str:
+        """Where a file of the Bot API server is in the shared volume"""
+        return os.path.join(self._volume, self._token,
+                            self._relative(file_path))
+
+    def fetch(self, audio: Audio) -> StoredFile:
+        """The stored copy of a voice note, acquiring it if needed"""
+        stored = self._stored(audio.file_unique_id)
+        if stored is not None:
+            CACHE.inc(kind="blob", result="hit")
+            try:
+                with self._register.transaction() as connection:
+                    connection.execute(
+                        "UPDATE blobs SET used_at = ? WHERE sha256 = ?",
+                        (time.time(), stored.sha256))
+            except Exception as e:
+                raise FileStoreException(e)
+            return stored
+        CACHE.inc(kind="blob", result="miss")
+        info = self.file_info(audio.file_id, audio.file_unique_id)
+        source = self.volume_path(info["file_path"])
+        extension = os.path.splitext(info["file_path"])[1]
+        if os.path.exists(source):
+            stored = self._import(source, extension)
+        else:
+            try:
+                stored = self._download(info["file_path"], extension)
+            except FileStoreException:
+                # The path of a getFile result expires in the Bot API
+                info = self.file_info(audio.file_id, audio.file_unique_id,
+                                      refresh=True)
+                stored = self._download(info["file_path"], extension)
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(
+                    "UPDATE files SET sha256 = ? WHERE file_unique_id = ?",
+                    (stored.sha256, audio.file_unique_id))
+                connection.execute(
+                    "INSERT OR REPLACE INTO blobs (sha256, path, size,"
+                    " used_at) VALUES (?, ?, ?, ?)",
+                    (stored.sha256, stored.path, stored.size, time.time()))
+        except Exception as e:
+            raise FileStoreException(e)
+        return stored
+
+    def rendition_path(self, stored: StoredFile, variant: str,
+                       extension: str) -> str:
+        """Where to write an encode of a stored file"""
+        directory = os.path.join(self._root, "renditions", stored.sha256[:2])
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory,
+                            f"{stored.sha256}-{variant}.{extension}")
+
+    def rendition(self, stored: StoredFile,
+                  variant: str) -> Rendition | None:
+        """A cached encode of a stored file and its checksum, if any"""
+        sql = ("SELECT path, md5, sha1, size FROM renditions"
+               " WHERE sha256 = ? AND variant = ?")
+        try:
+            with self._register.reader() as connection:
+                row = connection.execute(sql,
+                                         (stored.sha256, variant)).fetchone()
+            if row is None or not os.path.exists(row[0]):
+                CACHE.inc(kind="rendition", result="miss")
+                return None
+            with self._register.transaction() as connection:
+                connection.execute(
+                    "UPDATE renditions SET used_at = ? WHERE sha256 = ?"
+                    " AND variant = ?", (time.time(), stored.sha256, variant))
+        except Exception as e:
+            raise FileStoreException(e)
+        CACHE.inc(kind="rendition", result="hit")
+        path, md5, sha1, size = row
+        if not md5:
+            # Kept before checksums were saved
+            return Rendition(path=path, checksum=checksum(path))
+        return Rendition(path=path, checksum=Checksum(md5=md5, sha1=sha1,
+                                                      size=size))
+
+    def keep(self, stored: StoredFile, variant: str, path: str,
+             checksum: Checksum) -> Rendition:
+        """Remember an encode written at `rendition_path`"""
+        sql = ("INSERT OR REPLACE INTO renditions (sha256, variant, path,"
+               " size, md5, sha1, used_at) VALUES (?, ?, ?, ?, ?, ?, ?)")
+        try:
+            data = (stored.sha256, variant, path, checksum.size,
+                    checksum.md5, checksum.sha1, time.time())
+            with self._register.transaction() as connection:
+                connection.execute(sql, data)
+        except Exception as e:
+            raise FileStoreException(e)
+        return Rendition(path=path, checksum=checksum)
+
+    @property
+    def root(self) -> str:
+        return self._root
+
+    def forget(self, audio: Audio) -> None:
+        """Drop a voice note, and its content once no audio refers to it"""
+        self.forget_file(audio.file_unique_id)
+
+    def forget_file(self, file_unique_id: str) -> int:
+        """Drop a file by its `file_unique_id`, returns the bytes freed"""
+        stored = self._stored(file_unique_id)
+        try:
+            with self._register.transaction() as connection:
+                row = connection.execute(
+                    "DELETE FROM files WHERE file_unique_id = ?"
+                    " RETURNING file_path, sha256",
+                    (file_unique_id,)).fetchone()
+                paths = []
+                if row is not None and row[1] and connection.execute(
+                        "SELECT 1 FROM files WHERE sha256 = ?",
+                        (row[1],)).fetchone() is None:
+                    paths = [path for path, in connection.execute(
+                        "DELETE FROM renditions WHERE sha256 = ?"
+                        " RETURNING path", (row[1],))]
+                    connection.execute("DELETE FROM blobs WHERE sha256 = ?",
+                                       (row[1],))
+                    if stored is not None:
+                        paths.append(stored.path)
+            if row is not None and row[0]:
+                paths.append(self.volume_path(row[0]))
+            return sum(self.remove_path(path) for path in paths)
+        except Exception as e:
+            raise FileStoreException(e)
+
+    def remove_blob(self, sha256: str) -> int:
+        """Remove a stored voice note, it is acquired again if needed"""
+        try:
+            with self._register.transaction() as connection:
+                row = connection.execute(
+                    "DELETE FROM blobs WHERE sha256 = ? RETURNING path",
+                    (sha256,)).fetchone()
+            return self.remove_path(row[0]) if row is not None else 0
+        except Exception as e:
+            raise FileStoreException(e)
+
+    def remove_rendition(self, sha256: str, variant: str) -> int:
+        """Remove a cached encode, it is converted again if needed"""
+        try:
+            with self._register.transaction() as connection:
+                row = connection.execute(
+                    "DELETE FROM renditions WHERE sha256 = ? AND variant = ?"
+                    " RETURNING path", (sha256, variant)).fetchone()
+            return self.remove_path(row[0]) if row is not None else 0
+        except Exception as e:
+            raise FileStoreException(e)
+
+    def remove_originals(self, sha256: str) -> int:
+        """Remove the files of the shared volume with this content"""
+        sql = "SELECT file_path FROM files WHERE sha256 = ?"
+        try:
+            with self._register.reader() as connection:
+                rows = connection.execute(sql, (sha256,)).fetchall()
+            return sum(self.remove_path(self.volume_path(file_path))
+                       for file_path, in rows if file_path)
+        except Exception as e:
+            raise FileStoreException(e)
+
+    @staticmethod
+    def remove_path(path: str) -> int:
+        """Remove a file if it exists, returns its size"""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except FileNotFoundError:
+            return 0
+
+    def _stored(self, file_unique_id: str) -> StoredFile | None:
+        sql = ("SELECT b.sha256, b.path, b.size FROM files f JOIN blobs b"
+               " ON b.sha256 = f.sha256 WHERE f.file_unique_id = ?")
+        try:
+            with self._register.reader() as connection:
+                row = connection.execute(sql, (file_unique_id,)).fetchone()
+        except Exception as e:
+            raise FileStoreException(e)
+        if row is None or not os.path.exists(row[1]):
+            return None
+        return StoredFile(sha256=row[0], path=row[1], size=row[2])
+
+    def _blob_path(self, sha256: str, extension: str) -> str:
+        return os.path.join(self._root, "blobs", sha256[:2],
+                            f"{sha256}{extension}")
+
+    def _import(self, source: str, extension: str) -> StoredFile:
+        """Hash a file of the shared volume and store it by its hash"""
+        digest = hashlib.sha256()
+        size = 0
+        with open(source, "rb") as fr:
+            while chunk := fr.read(CHUNK):
+                digest.update(chunk)
+                size += len(chunk)
+        path = self._blob_path(digest.hexdigest(), extension)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = os.path.join(self._root, "tmp",
+                                     os.path.basename(path))
+            try:
+                os.link(source, temporary)
+            except OSError:
+                shutil.copyfile(source, temporary)
+            os.replace(temporary, path)
+        DOWNLOADED.inc(size, source="volume")
+        return StoredFile(sha256=digest.hexdigest(), path=path, size=size)
+
+    def _download(self, file_path: str, extension: str) -> StoredFile:
+        """Stream a file from the Bot API, hashing it on the way"""
+        url = f"{self._url}/{self._relative(file_path)}"
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=os.path.join(self._root, "tmp"),
+                                         delete=False) as fw:
+            try:
+                with self._session.get(url, stream=True,
+                                       timeout=60) as response:
+                    if response.status_code != 200:
+                        raise FileStoreException(
+                            f"Error HTTP {response.status_code} downloading"
+                            f" {file_path}")
+                    for chunk in response.iter_content(CHUNK):
+                        digest.update(chunk)
+                        size += len(chunk)
+                        fw.write(chunk)
+            except requests.RequestException as e:
+                os.remove(fw.name)
+                raise FileStoreException(e)
+            except BaseException:
+                os.remove(fw.name)
+                raise
+        path = self._blob_path(digest.hexdigest(), extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(fw.name, path)
+        DOWNLOADED.inc(size, source="http")
+        return StoredFile(sha256=digest.hexdigest(), path=path, size=size)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import numpy as np
+import subprocess
+import tempfile
+from collections import Counter
+from plumbum import local
+from register import Register
+
+FINGERPRINTS = """
+    CREATE TABLE IF NOT EXISTS fingerprints(
+        identifier TEXT PRIMARY KEY,
+        fingerprint BLOB NOT NULL
+    )
+"""
+KEYS = """
+    CREATE TABLE IF NOT EXISTS fingerprint_keys(
+        key INTEGER NOT NULL,
+        identifier TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        PRIMARY KEY (key, identifier, position)
+    ) WITHOUT ROWID
+"""
+MIGRATIONS = [
+    [
+        FINGERPRINTS,
+        KEYS,
+        "CREATE INDEX IF NOT EXISTS fingerprint_keys_identifier"
+        " ON fingerprint_keys(identifier)",
+    ],
+]
+
+RATE = 8000
+# Frames of half a second every 32 ms, overlapped enough that copies
+# cut at any sample give almost the same values
+FRAME = 4096
+HOP = 256
+# 33 bands between 300 and 2000 Hz give the 32 bits of every frame
+EDGES = np.geomspace(300, 2000, 34)
+SECONDS = 180
+# The keys of the index are the 20 bits of the lower bands, which are
+# the most robust. Only the frames whose key hashes to one of 4 buckets
+# are indexed, a choice that depends on the content so every copy of an
+# audio indexes the same frames
+MASK = (1 << 20) - 1
+SAMPLING = 2
+BATCH = 500
+
+logger = logging.getLogger(__name__)
+
+
+class FingerprintException(Exception):
+    pass
+
+
+def _bands() -> np.ndarray:
+    frequencies = np.fft.rfftfreq(FRAME, 1 / RATE)
+    band = np.digitize(frequencies, EDGES) - 1
+    matrix = np.zeros((len(frequencies), len(EDGES) - 1), np.float32)
+    inside = (band >= 0) & (band < len(EDGES) - 1)
+    matrix[inside, band[inside]] = 1
+    return matrix
+
+
+BANDS = _bands()
+WINDOW = np.hanning(FRAME).astype(np.float32)
+WEIGHTS = (1 << np.arange(32, dtype=np.uint64)).astype(np.uint64)
+
+
+class Fingerprinter:
+    """Compute the fingerprint of an audio fed as chunks of samples
+
+    Every frame gives 32 bits, one per pair of neighbour bands between
+    300 and 2000 Hz: whether the energy difference between the bands
+    grew since the previous frame. Those bits survive re-encoding and
+    changes of volume.
+    """
+
+    def __init__(self):
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._previous = None
+        self._values = []
+
+    def feed(self, samples: np.ndarray) -> None:
+        samples = np.concatenate((self._pending, samples))
+        if len(samples) < FRAME:
+            self._pending = samples
+            return
+        frames = np.lib.stride_tricks.sliding_window_view(
+            samples, FRAME)[::HOP]
+        self._pending = samples[len(frames) * HOP:]
+        spectrum = np.abs(np.fft.rfft(frames * WINDOW, axis=1)) ** 2
+        differences = -np.diff(spectrum @ BANDS, axis=1)
+        if self._previous is not None:
+            differences = np.vstack((self._previous, differences))
+        self._previous = differences[-1:]
+        bits = np.diff(differences, axis=0) > 0
+        if len(bits):
+            self._values.append(
+                (bits.astype(np.uint64) @ WEIGHTS).astype(np.uint32))
+
+    def result(self) -> np.ndarray:
+        if not self._values:
+            return np.zeros(0, dtype=np.uint32)
+        return np.concatenate(self._values)
+
+
+def fingerprint(file_from: str, seconds: int = SECONDS) -> np.ndarray:
+    """Decode the beginning of an audio to a pipe and fingerprint it"""
+    ffmpeg = local["ffmpeg"]
+    command = ffmpeg["-nostdin", "-v", "error", "-i", file_from, "-t",
+                     seconds, "-map", "0:a", "-ac", "1", "-ar", RATE,
+                     "-c:a", "pcm_f32le", "-f", "f32le", "pipe:1"]
+    fingerprinter = Fingerprinter()
+    with tempfile.TemporaryFile() as errors:
+        process = command.popen(stdout=subprocess.PIPE, stderr=errors)
+        try:
+            remainder = b""
+            while chunk := process.stdout.read(FRAME * 64 * 4):
+                chunk = remainder + chunk
+                whole = len(chunk) // 4 * 4
+                remainder = chunk[whole:]
+                fingerprinter.feed(np.frombuffer(chunk[:whole], np.float32))
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+        if process.wait() != 0:
+            errors.seek(0)
+            message = errors.read().decode("utf-8", "replace")
+            raise FingerprintException(
+                f"ffmpeg exited with {process.returncode}: {message}")
+    return fingerprinter.result()
+
+
+def keys(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """The keys of a fingerprint that appear once, with their positions"""
+    keys, positions, counts = np.unique(values & MASK, return_index=True,
+                                        return_counts=True)
+    return keys[counts == 1], positions[counts == 1]
+
+
+def sample(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """The keys of a fingerprint that are stored in the index"""
+    keys_, positions = keys(values)
+    mixed = (keys_.astype(np.uint64) * 2654435761) & 0xFFFFFFFF
+    chosen = (mixed >> (32 - SAMPLING)) == 0
+    return keys_[chosen], positions[chosen]
+
+
+def distance(first: np.ndarray, second: np.ndarray,
+             overlap: int = 80) -> float:
+    """Bit error rate of two fingerprints at their best alignment
+
+    The alignment is the most common offset between equal keys, so a
+    copy with a different leading silence still matches. Returns 1.0
+    when they share less than `overlap` frames.
+    """
+    first_keys, first_positions = keys(first)
+    second_keys, second_positions = keys(second)
+    _, firsts, seconds = np.intersect1d(first_keys, second_keys,
+                                        assume_unique=True,
+                                        return_indices=True)
+    if len(firsts) == 0:
+        return 1.0
+    offsets, counts = np.unique(first_positions[firsts] -
+                                second_positions[seconds],
+                                return_counts=True)
+    offset = int(offsets[counts.argmax()])
+    if offset >= 0:
+        first = first[offset:]
+    else:
+        second = second[-offset:]
+    length = min(len(first), len(second))
+    if length < overlap:
+        return 1.0
+    different = np.bitwise_xor(first[:length], second[:length])
+    return float(np.unpackbits(different.view(np.uint8)).mean())
+
+
+class FingerprintIndex:
+    """Fingerprints of the audios with an index to find similar ones
+
+    A sample of the frames is stored as keys with their positions. A
+    lookup counts the keys shared with every audio at the same offset,
+    as copies match at one alignment while chance matches scatter, and
+    only compares the fingerprints of the audios with the most hits
+    instead of every audio of the register.
+    """
+
+    def __init__(self, register: Register, threshold: float = 0.35,
+                 candidates: int = 5, hits: int = 3):
+        self._register = register
+        self._threshold = threshold
+        self._candidates = candidates
+        self._hits = hits
+        try:
+            self._register.migrate("fingerprints", MIGRATIONS)
+        except Exception as e:
+            raise FingerprintException(e)
+
+    def add(self, identifier: str, values: np.ndarray) -> None:
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO fingerprints (identifier,"
+                    " fingerprint) VALUES (?, ?)",
+                    (identifier, values.astype("<u4").tobytes()))
+                connection.execute(
+                    "DELETE FROM fingerprint_keys WHERE identifier = ?",
+                    (identifier,))
+                connection.executemany(
+                    "INSERT INTO fingerprint_keys (key, identifier,"
+                    " position) VALUES (?, ?, ?)",
+                    [(int(key), identifier, int(position))
+                     for key, position in zip(*sample(values))])
+        except Exception as e:
+            raise FingerprintException(e)
+
+    def remove(self, identifier: str) -> None:
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(
+                    "DELETE FROM fingerprints WHERE identifier = ?",
+                    (identifier,))
+                connection.execute(
+                    "DELETE FROM fingerprint_keys WHERE identifier = ?",
+                    (identifier,))
+        except Exception as e:
+            raise FingerprintException(e)
+
+    def similar(self, values: np.ndarray,
+                exclude: str = "") -> list[tuple[str, float]]:
+        """Registered audios similar to a fingerprint, best first
+
+        Returns pairs of identifier and bit error rate, only for the
+        audios below the threshold.
+        """
+        try:
+            hits = Counter()
+            queried = dict(zip(*(array.tolist()
+                                 for array in sample(values))))
+            keys_ = list(queried)
+            with self._register.reader() as connection:
+                for index in range(0, len(keys_), BATCH):
+                    batch = keys_[index:index + BATCH]
+                    sql = ("SELECT key, identifier, position FROM"
+                           " fingerprint_keys WHERE key IN"
+                           f" ({', '.join('?' * len(batch))})")
+                    for key, identifier, position in connection.execute(
+                            sql, batch):
+                        hits[identifier, queried[key] - position] += 1
+                best = Counter()
+                for (identifier, _), count in hits.items():
+                    if identifier != exclude:
+                        best[identifier] = max(best[identifier], count)
+                candidates = [identifier for identifier, count
+                              in best.most_common(self._candidates)
+                              if count >= self._hits]
+                rows = connection.execute(
+                    "SELECT f.identifier, f.fingerprint FROM fingerprints f"
+                    " JOIN audios a ON a.identifier = f.identifier"
+                    " WHERE f.identifier IN"
+                    f" ({', '.join('?' * len(candidates))})",
+                    candidates).fetchall()
+        except Exception as e:
+            raise FingerprintException(e)
+        similar = []
+        for identifier, blob in rows:
+            rate = distance(values, np.frombuffer(blob, "<u4"))
+            logger.debug("Bit error rate to %s: %s", identifier, rate)
+            if rate <= self._threshold:
+                similar.append((identifier, rate))
+        return sorted(similar, key=lambda pair: pair[1])
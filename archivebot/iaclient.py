@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import logging
+import metrics
+import requests
+import threading
+import time
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+HOST = "https://archive.org"
+# Identifiers in every advancedsearch query
+BATCH = 100
+
+CACHE = metrics.counter("ia_metadata_cache_total",
+                        "Lookups in the Internet Archive metadata cache",
+                        ("result",))
+REQUESTS = metrics.counter("ia_metadata_requests_total",
+                           "Requests to the Internet Archive read API",
+                           ("kind",))
+
+logger = logging.getLogger(__name__)
+
+
+class IAClientException(Exception):
+    pass
+
+
+class IAClient:
+    """Metadata of the Internet Archive items, cached
+
+    All the requests share a session with a pool of kept-alive
+    connections. The metadata of an item is kept for `ttl` seconds, and
+    an identifier without item for `missing_ttl`, as it is usually
+    uploaded soon. Identifiers created by the bot are known to be new,
+    so `created` caches them as missing without asking. `host` can be a
+    local fake of the API.
+    """
+
+    def __init__(self, access: str = "", secret: str = "", host: str = HOST,
+                 pool: int = 10, retries: int = 3, ttl: float = 300,
+                 missing_ttl: float = 60, capacity: int = 1024,
+                 session: requests.Session | None = None):
+        self._host = host.rstrip("/")
+        self._access = access
+        self._secret = secret
+        self._ttl = ttl
+        self._missing_ttl = missing_ttl
+        self._capacity = capacity
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        if session is None:
+            session = requests.Session()
+            retry = Retry(total=retries, backoff_factor=0.5,
+                          status_forcelist=(429, 500, 502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=pool, pool_maxsize=pool,
+                                  max_retries=retry)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        if access:
+            session.headers.update(
+                {"authorization": f"LOW {access}:{secret}"})
+        self._session = session
+
+    @property
+    def session(self) -> requests.Session:
+        return self._session
+
+    @property
+    def host(self) -> str:
+        return self._host
+
+    def item(self, identifier: str, refresh: bool = False) -> dict | None:
+        """The metadata of an item, or None if it does not exist"""
+        now = time.monotonic()
+        if not refresh:
+            with self._lock:
+                entry = self._cache.get(identifier)
+                if entry is not None and entry[0] > now:
+                    self._cache.move_to_end(identifier)
+                    CACHE.inc(result="hit")
+                    return entry[1]
+        CACHE.inc(result="miss")
+        REQUESTS.inc(kind="metadata")
+        try:
+            response = self._session.get(
+                f"{self._host}/metadata/{identifier}")
+            response.raise_for_status()
+            item = response.json() or None
+        except Exception as e:
+            raise IAClientException(e)
+        self._remember(identifier, item, now)
+        return item
+
+    def files(self, identifier: str) -> dict[str, str]:
+        """The MD5 of every file of an item, by name"""
+        item = self.item(identifier)
+        if item is None:
+            return {}
+        return {file["name"]: file.get("md5", "")
+                for file in item.get("files", [])}
+
+    def exists(self, identifiers: list[str]) -> set[str]:
+        """Which of the identifiers have an item
+
+        Cached identifiers are answered from the cache, the others are
+        asked in batches to the search API. The search index lags behind
+        the uploads, so what it does not find is not cached as missing.
+        """
+        now = time.monotonic()
+        found = set()
+        unknown = []
+        with self._lock:
+            for identifier in dict.fromkeys(identifiers):
+                entry = self._cache.get(identifier)
+                if entry is not None and entry[0] > now:
+                    CACHE.inc(result="hit")
+                    if entry[1] is not None:
+                        found.add(identifier)
+                else:
+                    unknown.append(identifier)
+        for start in range(0, len(unknown), BATCH):
+            batch = unknown[start:start + BATCH]
+            REQUESTS.inc(kind="search")
+            try:
+                response = self._session.get(
+                    f"{self._host}/advancedsearch.php",
+                    params={"q": f"identifier:({' OR '.join(batch)})",
+                            "fl[]": "identifier", "rows": len(batch),
+                            "output": "json"})
+                response.raise_for_status()
+                docs = response.json()["response"]["docs"]
+            except Exception as e:
+                raise IAClientException(e)
+            found.update(doc["identifier"] for doc in docs)
+        return found
+
+    def patch(self, identifier: str, patch: list[dict]) -> bool:
+        """Apply a JSON patch to the metadata of an item
+
+        Returns False when the item already had that metadata.
+        """
+        REQUESTS.inc(kind="write")
+        data = {"-target": "metadata", "-patch": json.dumps(patch),
+                "access": self._access, "secret": self._secret}
+        try:
+            response = self._session.post(
+                f"{self._host}/metadata/{identifier}", data=data)
+            result = response.json()
+        except Exception as e:
+            raise IAClientException(e)
+        self.invalidate(identifier)
+        if result.get("success"):
+            return True
+        if "no changes" in result.get("error", ""):
+            return False
+        raise IAClientException(
+            f"Error HTTP {response.status_code}. {result.get('error')}")
+
+    def created(self, identifier: str) -> None:
+        """Remember an identifier just created, it has no item yet"""
+        self._remember(identifier, None, time.monotonic())
+
+    def invalidate(self, identifier: str) -> None:
+        """Forget the cached metadata of an item that has changed"""
+        with self._lock:
+            self._cache.pop(identifier, None)
+
+    def _remember(self, identifier: str, item: dict | None,
+                  now: float) -> None:
+        ttl = self._ttl if item is not None else self._missing_ttl
+        with self._lock:
+            self._cache[identifier] = (now + ttl, item)
+            self._cache.move_to_end(identifier)
+            while len(self._cache) > self._capacity:
+                self._cache.popitem(last=False)
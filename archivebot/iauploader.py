@@ -22,30 +22,59 @@
 # SOFTWARE.
 
 import logging
-import log
+import metrics
+import os
+import time
 from datetime import datetime
 from audio import Audio
-from internetarchive import get_session
+from iaclient import HOST, IAClient
+from register import Register
+from s3 import ENDPOINT, PART_SIZE, Checksum, Digest, S3Client
+from uploads import Bandwidth, MultipartUploader
+from instrumentation import traced
 
 logger = logging.getLogger(__name__)
 
+BYTES = metrics.counter("ia_upload_bytes_total",
+                        "Bytes uploaded to Internet Archive")
+SECONDS = metrics.histogram("ia_upload_seconds",
+                            "Duration of the Internet Archive uploads")
+THROUGHPUT = metrics.histogram(
+    "ia_upload_bytes_per_second",
+    "Throughput of the Internet Archive uploads",
+    buckets=(16e3, 64e3, 256e3, 1e6, 4e6, 16e6, 64e6))
+SKIPPED = metrics.counter("ia_upload_skipped_total",
+                          "Files already in Internet Archive with the same"
+                          " MD5")
+
 
 class IAUploader:
 
-    @log.debug
+    @traced
     def __init__(self, token: str, ia_access: str, ia_secret: str,
-                 podcast: str, creator: str):
+                 podcast: str, creator: str,
+                 register: Register | None = None, endpoint: str = ENDPOINT,
+                 workers: int = 4, rate: float = 0,
+                 threshold: int = 4 * PART_SIZE, host: str = HOST):
         self._token = token
         self._podcast = podcast
         self._creator = creator
-        self._ia_session = get_session(config={
-            "s3": {"access": ia_access, "secret": ia_secret}
-        })
+        self._client = IAClient(ia_access, ia_secret, host, pool=workers)
+        self._s3 = S3Client(ia_access, ia_secret, endpoint, pool=workers)
+        self._threshold = threshold
+        # One limit for every upload, whatever the way it is sent
+        self._bandwidth = Bandwidth(rate) if rate else None
+        self._multipart = MultipartUploader(
+            register, self._s3, workers,
+            bandwidth=self._bandwidth) if register else None
+
+    @property
+    def client(self) -> IAClient:
+        return self._client
 
-    @log.debug
-    def upload(self, audio: Audio, filename: str):
+    def metadata(self, audio: Audio) -> dict:
         now = datetime.now()
-        metadata = {
+        return {
             "title": audio.title,
             "mediatype": "audio",
             "collection": "opensource_audio",
@@ -55,6 +84,81 @@ class IAUploader:
             "subject": audio.tags.split(","),
             "creator": self._creator,
         }
-        ia_episode = self._ia_session.get_item(audio.identifier)
-        response = ia_episode.upload(filename, metadata=metadata, verbose=True)
-        logger.debug(f"Response: {response}")
+
+    @traced
+    def upload(self, audio: Audio,
+               filename: str | list[str] | dict[str, str],
+               checksums: dict[str, Checksum] = {}, new: bool = False):
+        """Upload one file, or several files to the same item
+
+        A dict maps the name of every file in the item to its local path.
+        Files from `threshold` bytes are sent as resumable multipart
+        uploads, the rest in one request each. `checksums`, by name, are
+        those computed when the files were written: they are sent as
+        Content-MD5 and files already in the item with the same MD5 are
+        skipped, so no file is read again to hash it. The files of the
+        item come from the metadata cache, and are not looked up for a
+        `new` item, one that was never uploaded to.
+        """
+        metadata = self.metadata(audio)
+        if isinstance(filename, str):
+            filename = [filename]
+        if not isinstance(filename, dict):
+            filename = {os.path.basename(item): item for item in filename}
+        sizes = {name: checksums[name].size if name in checksums
+                 else os.path.getsize(path)
+                 for name, path in filename.items()}
+        start = time.perf_counter()
+        if checksums and not new:
+            existing = self._client.files(audio.identifier)
+            same = {name for name, checksum in checksums.items()
+                    if existing.get(name) == checksum.md5} & set(filename)
+            for name in same:
+                logger.debug("%s is already uploaded", name)
+                SKIPPED.inc()
+                del sizes[name]
+            filename = {name: path for name, path in filename.items()
+                        if name not in same}
+        small = {}
+        for name, path in filename.items():
+            if self._multipart is not None and \
+                    sizes[name] >= self._threshold:
+                self._multipart.upload(audio.identifier, name, path,
+                                       metadata)
+            else:
+                small[name] = path
+        for index, (name, path) in enumerate(small.items()):
+            # The item is derived once, after the last file
+            self._s3.put(audio.identifier, name, path, metadata,
+                         checksums.get(name), derive=index == len(small) - 1,
+                         limit=self._bandwidth)
+        if filename:
+            self._client.invalidate(audio.identifier)
+        size = sum(sizes.values())
+        elapsed = time.perf_counter() - start
+        BYTES.inc(size)
+        SECONDS.observe(elapsed)
+        if elapsed:
+            THROUGHPUT.observe(size / elapsed)
+        logger.debug("Uploaded %s files, %s bytes", len(filename), size)
+
+    @traced
+    def upload_stream(self, audio: Audio, stream, filename: str,
+                      check=None) -> Digest:
+        """Upload a stream in bounded parts as it is produced
+
+        `check` is called when the stream ends and aborts the upload if
+        it raises.
+        """
+        start = time.perf_counter()
+        digest = self._s3.upload_stream(audio.identifier, filename, stream,
+                                        self.metadata(audio),
+                                        limit=self._bandwidth, check=check)
+        self._client.invalidate(audio.identifier)
+        elapsed = time.perf_counter() - start
+        BYTES.inc(digest.size)
+        SECONDS.observe(elapsed)
+        if elapsed:
+            THROUGHPUT.observe(digest.size / elapsed)
+        logger.debug("Uploaded %s bytes, md5 %s", digest.size, digest.md5)
+        return digest
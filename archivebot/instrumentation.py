@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import functools
+import logging
+import os
+import reprlib
+import sys
+import time
+
+FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+_repr = reprlib.Repr()
+_repr.maxstring = int(os.getenv("LOG_MAX_PAYLOAD", "200"))
+_repr.maxother = _repr.maxstring
+_repr.maxlist = _repr.maxtuple = _repr.maxdict = 10
+_repr.maxlevel = 4
+
+
+class Payload:
+    """Defer the formatting of a value until a record is emitted
+
+    The text is truncated to `LOG_MAX_PAYLOAD` characters, and nested
+    containers are shortened, so a large `getUpdates` response never
+    floods the log.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self) -> str:
+        return _repr.repr(self.value)
+
+
+def traced(function):
+    """Log the calls, results and elapsed time of a function at DEBUG
+
+    When DEBUG is disabled for the module of the function, the wrapper
+    only costs one level check and calls the function straight away.
+    """
+    logger = logging.getLogger(function.__module__)
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrap(*args, **kwargs):
+        if not logger.isEnabledFor(logging.DEBUG):
+            return function(*args, **kwargs)
+        logger.debug("Start: %s. Args: %s. Kwargs: %s", name,
+                     Payload(args), Payload(kwargs))
+        start = time.perf_counter_ns()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            elapsed = (time.perf_counter_ns() - start) / 1e6
+            logger.debug("Error: %s (%.3f ms)", name, elapsed)
+            raise
+        elapsed = (time.perf_counter_ns() - start) / 1e6
+        logger.debug("End: %s (%.3f ms). Result: %s", name, elapsed,
+                     Payload(result))
+        return result
+    return wrap
+
+
+def configure(stream=sys.stdout) -> None:
+    """Configure logging from the environment
+
+    `LOG_LEVEL` sets the root level, INFO by default. `LOG_LEVELS` sets
+    the level of single modules, for example
+    `LOG_LEVELS=register=DEBUG,telegram=WARNING`.
+    """
+    level = os.getenv("LOG_LEVEL", "INFO").upper()
+    logging.basicConfig(stream=stream, level=level, format=FORMAT)
+    for item in os.getenv("LOG_LEVELS", "").split(","):
+        if "=" in item:
+            module, module_level = item.split("=", 1)
+            logging.getLogger(module.strip()).setLevel(
+                module_level.strip().upper())
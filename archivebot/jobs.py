@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime
+from pydantic import BaseModel
+from register import Register
+
+JOBS = """
+    CREATE TABLE IF NOT EXISTS jobs(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL DEFAULT "{}",
+        status TEXT NOT NULL DEFAULT "pending",
+        stage TEXT DEFAULT "",
+        attempts INTEGER DEFAULT 0,
+        max_attempts INTEGER DEFAULT 5,
+        available_at REAL NOT NULL,
+        lease_owner TEXT DEFAULT "",
+        lease_expires_at REAL DEFAULT 0,
+        last_error TEXT DEFAULT "",
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+JOBS_INDEX = """
+    CREATE INDEX IF NOT EXISTS jobs_status_available
+    ON jobs(status, available_at)
+"""
+# The audio of a job, out of the payload so it can be indexed
+IDENTIFIER = [
+    "ALTER TABLE jobs ADD COLUMN identifier TEXT DEFAULT ''",
+    "UPDATE jobs SET identifier ="
+    " COALESCE(json_extract(payload, '$.identifier'), '')",
+    "CREATE INDEX IF NOT EXISTS jobs_identifier"
+    " ON jobs(identifier, kind, status)",
+]
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+logger = logging.getLogger(__name__)
+
+
+class JobException(Exception):
+    pass
+
+
+class Job(BaseModel):
+    id: int = -1
+    kind: str = ""
+    payload: dict = {}
+    status: str = PENDING
+    stage: str = ""
+    attempts: int = 0
+    max_attempts: int = 5
+    available_at: float = 0
+    lease_owner: str = ""
+    lease_expires_at: float = 0
+    last_error: str = ""
+    created_at: datetime | None = None
+    updated_at: datetime | None = None
+    identifier: str = ""
+
+    @classmethod
+    def from_cursor(cls, data: tuple):
+        job = {k: v for k, v in zip(cls.model_fields.keys(), data)}
+        job["payload"] = json.loads(job["payload"])
+        return cls(**job)
+
+
+class JobQueue:
+    """A durable job queue stored in the Register database
+
+    Workers claim jobs with a lease. A job whose lease expires, because
+    its worker died, becomes claimable again, and a failed job is retried
+    with exponential backoff until it runs out of attempts.
+    """
+
+    def __init__(self, register: Register, lease: int = 300,
+                 backoff: int = 30, max_backoff: int = 3600):
+        self._register = register
+        self._lease = lease
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        try:
+            self._register.migrate("jobs", [[JOBS, JOBS_INDEX], IDENTIFIER])
+        except Exception as e:
+            raise JobException(e)
+
+    @property
+    def lease(self) -> int:
+        return self._lease
+
+    def _one(self, sql: str, data: tuple) -> Job | None:
+        try:
+            with self._register.transaction() as connection:
+                row = connection.execute(sql, data).fetchone()
+        except Exception as e:
+            raise JobException(e)
+        return Job.from_cursor(row) if row else None
+
+    def enqueue(self, kind: str, payload: dict, delay: float = 0,
+                max_attempts: int = 5) -> Job:
+        sql = ("INSERT INTO jobs (kind, payload, available_at, max_attempts,"
+               " identifier) VALUES (?, ?, ?, ?, ?) RETURNING *")
+        data = (kind, json.dumps(payload), time.time() + delay,
+                max_attempts, payload.get("identifier", ""))
+        return self._one(sql, data)
+
+    def claim(self, owner: str, kinds: list[str]) -> Job | None:
+        now = time.time()
+        marks = ", ".join("?" for _ in kinds)
+        sql = ("UPDATE jobs SET status = ?, lease_owner = ?,"
+               " lease_expires_at = ?, attempts = attempts + 1,"
+               " updated_at = ? WHERE id = (SELECT id FROM jobs"
+               f" WHERE kind IN ({marks}) AND"
+               " ((status = ? AND available_at <= ?) OR"
+               " (status = ? AND lease_expires_at < ?))"
+               " ORDER BY available_at, id LIMIT 1) RETURNING *")
+        data = (RUNNING, owner, now + self._lease, datetime.now(), *kinds,
+                PENDING, now, RUNNING, now)
+        return self._one(sql, data)
+
+    def heartbeat(self, job: Job) -> bool:
+        sql = ("UPDATE jobs SET lease_expires_at = ? WHERE id = ?"
+               " AND status = ? AND lease_owner = ? RETURNING *")
+        data = (time.time() + self._lease, job.id, RUNNING, job.lease_owner)
+        return self._one(sql, data) is not None
+
+    def set_stage(self, job: Job, stage: str,
+                  payload: dict | None = None) -> Job:
+        payload = job.payload if payload is None else payload
+        sql = ("UPDATE jobs SET stage = ?, payload = ?, updated_at = ?"
+               " WHERE id = ? RETURNING *")
+        data = (stage, json.dumps(payload), datetime.now(), job.id)
+        return self._one(sql, data)
+
+    def complete(self, job: Job) -> Job:
+        sql = ("UPDATE jobs SET status = ?, lease_owner = '',"
+               " lease_expires_at = 0, last_error = '', updated_at = ?"
+               " WHERE id = ? RETURNING *")
+        data = (DONE, datetime.now(), job.id)
+        return self._one(sql, data)
+
+    def fail(self, job: Job, error: str) -> Job:
+        if job.attempts >= job.max_attempts:
+            status = FAILED
+            available_at = job.available_at
+        else:
+            status = PENDING
+            delay = min(self._backoff * 2 ** (job.attempts - 1),
+                        self._max_backoff)
+            available_at = time.time() + delay * random.uniform(0.5, 1.0)
+        sql = ("UPDATE jobs SET status = ?, available_at = ?,"
+               " lease_owner = '', lease_expires_at = 0, last_error = ?,"
+               " updated_at = ? WHERE id = ? RETURNING *")
+        data = (status, available_at, error, datetime.now(), job.id)
+        return self._one(sql, data)
+
+    def prune(self, age: float) -> int:
+        """Remove the jobs done more than `age` seconds ago"""
+        sql = "DELETE FROM jobs WHERE status = ? AND updated_at < ?"
+        data = (DONE, datetime.fromtimestamp(time.time() - age))
+        try:
+            with self._register.transaction() as connection:
+                return connection.execute(sql, data).rowcount
+        except Exception as e:
+            raise JobException(e)
+
+    def get(self, id: int) -> Job:
+        job = self._one("SELECT * FROM jobs WHERE id = ?", (id,))
+        if job is None:
+            raise JobException(f"Job {id} not exists")
+        return job
+
+    def status(self) -> dict:
+        sql = "SELECT status, count(1) FROM jobs GROUP BY status"
+        try:
+            with self._register.reader() as connection:
+                return dict(connection.execute(sql).fetchall())
+        except Exception as e:
+            raise JobException(e)
+
+
+class WorkerPool:
+    """Threads that take jobs from a `JobQueue` and run their handlers
+
+    `handlers` maps a job kind to a callable receiving the `Job`. The
+    handler may record its progress with `JobQueue.set_stage`, so a
+    retried job can skip the stages it already finished.
+    """
+
+    def __init__(self, queue: JobQueue, handlers: dict, workers: int = 2,
+                 poll: float = 1.0):
+        self._queue = queue
+        self._handlers = handlers
+        self._workers = workers
+        self._poll = poll
+        self._stop = threading.Event()
+        self._threads = []
+        self._prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self) -> None:
+        self._stop.clear()
+        for index in range(self._workers):
+            thread = threading.Thread(target=self._work,
+                                      args=(f"{self._prefix}:{index}",),
+                                      name=f"worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _work(self, owner: str) -> None:
+        kinds = list(self._handlers.keys())
+        while not self._stop.is_set():
+            try:
+                job = self._queue.claim(owner, kinds)
+            except JobException as exception:
+                logger.error(exception)
+                job = None
+            if job is None:
+                self._stop.wait(self._poll)
+                continue
+            self._run(job)
+
+    def _run(self, job: Job) -> None:
+        logger.debug("Running job %s (%s), attempt %s", job.id, job.kind,
+                     job.attempts)
+        done = threading.Event()
+        beat = threading.Thread(target=self._heartbeat, args=(job, done),
+                                daemon=True)
+        beat.start()
+        try:
+            self._handlers[job.kind](job)
+            self._queue.complete(job)
+        except Exception as exception:
+            logger.error("Job %s failed: %s", job.id, exception)
+            job = self._queue.fail(job, str(exception))
+            if job.status == FAILED:
+                logger.error("Job %s gave up after %s attempts", job.id,
+                             job.attempts)
+        finally:
+            done.set()
+            beat.join()
+
+    def _heartbeat(self, job: Job, done: threading.Event) -> None:
+        while not done.wait(self._queue.lease / 3):
+            try:
+                if not self._queue.heartbeat(job):
+                    logger.warning("Lost the lease of job %s", job.id)
+                    return
+            except JobException as exception:
+                logger.error(exception)
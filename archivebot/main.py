@@ -21,23 +21,24 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
+import instrumentation
 import logging
+import metrics
 import os
-import sys
 from bot import Bot
 from dotenv import load_dotenv
 from register import Register
+from scheduler import parse_windows
+from storage import parse_size
+from transcoder import TranscodePool
 
-logging.basicConfig(
-        stream=sys.stdout,
-        level=logging.DEBUG,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-        )
 logger = logging.getLogger(__name__)
 
 
 def main():
     load_dotenv()
+    instrumentation.configure()
     token = os.getenv("TOKEN", "")
     chat_id = os.getenv("CHAT_ID", "")
     thread_id = os.getenv("THREAD_ID", "")
@@ -46,12 +47,74 @@ def main():
     podcast = os.getenv("PODCAST_NAME", "")
     creator = os.getenv("CREATOR_NAME", "")
     database = os.getenv("DATABASE", "database.db")
-    register = Register(database)
+    workers = int(os.getenv("WORKERS", "2"))
+    sessions = int(os.getenv("SESSIONS", "128"))
+    session_ttl = int(os.getenv("SESSION_TTL", "86400"))
+    streaming = os.getenv("STREAMING", "false").lower() == "true"
+    # Off by default: only the decoding runs in parallel, the encode of
+    # the joined audio does not, so it is rarely faster than a plain one
+    segment_threshold = int(os.getenv("SEGMENT_THRESHOLD", "0"))
+    profile = os.getenv("ENCODING_PROFILE", "mp3-cbr-128")
+    derivatives = [name.strip() for name in
+                   os.getenv("DERIVATIVES", "").split(",") if name.strip()]
+    waveform = os.getenv("WAVEFORM", "false").lower() == "true"
+    analysis = os.getenv("ANALYSIS", "false").lower() == "true"
+    loudness = float(os.getenv("LOUDNESS_TARGET", "-16"))
+    duplicates = os.getenv("DUPLICATES", "true").lower() == "true"
+    files_dir = os.getenv("FILES_DIR", "/data/archivebot")
+    volume = os.getenv("BOT_API_VOLUME", "/data")
+    storage_budget = parse_size(os.getenv("STORAGE_BUDGET", "0"))
+    retention = float(os.getenv("RETENTION_DAYS", "7")) * 86400
+    s3_endpoint = os.getenv("S3_ENDPOINT", "https://s3.us.archive.org")
+    upload_workers = int(os.getenv("UPLOAD_WORKERS", "4"))
+    upload_rate = parse_size(os.getenv("UPLOAD_RATE", "0"))
+    ia_host = os.getenv("IA_HOST", "https://archive.org")
+    sync_interval = float(os.getenv("METADATA_SYNC_INTERVAL", "300"))
+    sync_concurrency = int(os.getenv("METADATA_SYNC_CONCURRENCY", "4"))
+    reconcile_interval = float(os.getenv("RECONCILE_INTERVAL", "60"))
+    reconcile_batch = int(os.getenv("RECONCILE_BATCH", "20"))
+    publish_windows = parse_windows(os.getenv("PUBLISH_WINDOWS", ""))
+    publish_threshold = parse_size(os.getenv("PUBLISH_THRESHOLD", "20M"))
+    readers = int(os.getenv("DATABASE_READERS", "4"))
+    register = Register(database, readers)
+    transcoder = TranscodePool(
+        int(os.getenv("TRANSCODE_BUDGET", "0")),
+        float(os.getenv("TRANSCODE_TIMEOUT", "600")),
+        nice=int(os.getenv("TRANSCODE_NICE", "10")),
+        ionice=os.getenv("TRANSCODE_IONICE", "true").lower() == "true")
+    metrics_port = os.getenv("METRICS_PORT", "")
+    metrics_file = os.getenv("METRICS_FILE", "")
+    if metrics_port:
+        metrics.serve(int(metrics_port),
+                      os.getenv("METRICS_HOST", "127.0.0.1"))
+    if metrics_file:
+        metrics.dump_every(metrics_file,
+                           float(os.getenv("METRICS_INTERVAL", "60")))
     bot = Bot(token, chat_id, thread_id, ia_access, ia_secret, podcast,
-              creator, register)
+              creator, register, workers=workers, sessions=sessions,
+              session_ttl=session_ttl, streaming=streaming,
+              segment_threshold=segment_threshold, transcoder=transcoder,
+              profile=profile, derivatives=derivatives, waveform=waveform,
+              analysis=analysis, loudness=loudness, duplicates=duplicates,
+              files_dir=files_dir, volume=volume,
+              storage_budget=storage_budget, retention=retention,
+              s3_endpoint=s3_endpoint, upload_workers=upload_workers,
+              upload_rate=upload_rate, ia_host=ia_host,
+              sync_interval=sync_interval,
+              sync_concurrency=sync_concurrency,
+              reconcile_interval=reconcile_interval,
+              reconcile_batch=reconcile_batch,
+              publish_windows=publish_windows,
+              publish_threshold=publish_threshold)
     logger.debug("main")
-    while True:
-        bot.get_updates()
+    webhook_url = os.getenv("WEBHOOK_URL", "")
+    if webhook_url:
+        asyncio.run(bot.listen(webhook_url,
+                               int(os.getenv("WEBHOOK_PORT", "8080")),
+                               os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+                               os.getenv("WEBHOOK_SECRET", "")))
+    else:
+        asyncio.run(bot.run())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import itertools
+import logging
+import metrics
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from telegram import TelegramClient
+
+MAX_LENGTH = 4096
+# Only new messages count against the limits of a chat, reactions and
+# chat actions only against the global one
+MESSAGES = ("send_message", "send_question")
+
+QUEUED = metrics.counter("telegram_outbound_total",
+                         "Messages queued for delivery to Telegram",
+                         ("method",))
+MERGED = metrics.counter("telegram_outbound_merged_total",
+                         "Text messages merged into a previous one")
+DELAY = metrics.histogram("telegram_outbound_delay_seconds",
+                          "Time from queueing a message to sending it")
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allow `rate` operations per second with bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+        self._updated = now
+
+    def ready_in(self, now: float, amount: float = 1) -> float:
+        """Seconds to wait until `amount` tokens are available"""
+        self._refill(now)
+        if self._tokens >= amount:
+            return 0
+        return (amount - self._tokens) / self._rate
+
+    def consume(self, now: float, amount: float = 1) -> None:
+        self._refill(now)
+        self._tokens -= amount
+
+
+class _Message:
+    __slots__ = ("method", "args", "queued_at", "sequence")
+
+    def __init__(self, method: str, args: tuple, sequence: int):
+        self.method = method
+        self.args = args
+        self.queued_at = time.monotonic()
+        self.sequence = sequence
+
+
+class OutboundScheduler:
+    """Send the messages of the bot without breaking the Telegram limits
+
+    Messages are queued per chat and delivered from a single thread,
+    respecting a global token bucket and one bucket per chat, which is
+    slower for groups but allows them a burst of messages. Consecutive
+    texts to the same chat and topic are merged into one message.
+    Throttling answers are retried by the `TelegramClient` after the
+    `retry_after` Telegram asks for.
+    """
+
+    def __init__(self, client: TelegramClient, global_rate: float = 30,
+                 chat_rate: float = 1, group_rate: float = 20 / 60,
+                 group_burst: float = 20):
+        self._client = client
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate
+        self._group_burst = group_burst
+        self._buckets = {}
+        self._queues = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        self._deferred = threading.local()
+
+    @contextmanager
+    def deferred(self):
+        """Hold the messages queued by this thread until the block ends
+
+        They are queued when the block finishes and dropped if it raises,
+        so nothing is said about changes that were rolled back.
+        """
+        held = getattr(self._deferred, "messages", None)
+        if held is not None:
+            yield
+            return
+        self._deferred.messages = []
+        try:
+            yield
+            messages = self._deferred.messages
+        finally:
+            self._deferred.messages = None
+        for chat_id, method, args in messages:
+            self._put(chat_id, method, args)
+
+    def send_message(self, text: str, chat_id: int,
+                     thread_id: int = 0) -> None:
+        self._put(chat_id, "send_message", (text, chat_id, thread_id))
+
+    def send_question(self, text: str, chat_id: int, options: list[str],
+                      thread_id: int = 0) -> None:
+        self._put(chat_id, "send_question",
+                  (text, chat_id, options, thread_id))
+
+    def set_reaction(self, chat_id, message_id, reaction) -> None:
+        self._put(chat_id, "set_reaction", (chat_id, message_id, reaction))
+
+    def send_chat_action(self, chat_id: int, thread_id: int,
+                         action: str) -> None:
+        self._put(chat_id, "send_chat_action", (chat_id, thread_id, action))
+
+    def _put(self, chat_id: int, method: str, args: tuple) -> None:
+        held = getattr(self._deferred, "messages", None)
+        if held is not None:
+            held.append((chat_id, method, args))
+            return
+        QUEUED.inc(method=method)
+        with self._condition:
+            message = _Message(method, args, next(self._sequence))
+            self._queues.setdefault(chat_id, deque()).append(message)
+            self._condition.notify()
+
+    def start(self) -> None:
+        self._stopping = False
+        self._thread = threading.Thread(target=self._work, name="outbound",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Deliver the queued messages and stop"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self._group_rate, self._group_burst)
+            else:
+                bucket = TokenBucket(self._chat_rate)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _next(self, now: float) -> tuple[int | None, float]:
+        """The chat whose first message can be sent soonest"""
+        best, best_wait, best_sequence = None, 0, 0
+        for chat_id, messages in self._queues.items():
+            wait = self._global.ready_in(now)
+            if messages[0].method in MESSAGES:
+                wait = max(wait, self._bucket(chat_id).ready_in(now))
+            sequence = messages[0].sequence
+            if best is None or (wait, sequence) < (best_wait, best_sequence):
+                best, best_wait, best_sequence = chat_id, wait, sequence
+        return best, best_wait
+
+    def _pop(self, chat_id: int) -> _Message:
+        messages = self._queues[chat_id]
+        message = messages.popleft()
+        if message.method == "send_message":
+            text, _, thread_id = message.args
+            while messages and messages[0].method == "send_message":
+                following, _, following_thread = messages[0].args
+                merged = f"{text}\n\n{following}"
+                if following_thread != thread_id or \
+                        len(merged) > MAX_LENGTH:
+                    break
+                messages.popleft()
+                MERGED.inc()
+                text = merged
+            message.args = (text, chat_id, thread_id)
+        if not messages:
+            del self._queues[chat_id]
+        return message
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queues and not self._stopping:
+                    self._condition.wait()
+                if not self._queues:
+                    return
+                now = time.monotonic()
+                chat_id, wait = self._next(now)
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                self._global.consume(now)
+                message = self._pop(chat_id)
+                if message.method in MESSAGES:
+                    self._bucket(chat_id).consume(now)
+            DELAY.observe(time.monotonic() - message.queued_at)
+            try:
+                getattr(self._client, message.method)(*message.args)
+            except Exception as exception:
+                logger.error("%s to %s failed: %s", message.method, chat_id,
+                             exception)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+class Profile(BaseModel):
+    name: str
+    format: str
+    extension: str
+    arguments: list[str] = []
+    passthrough: bool = False
+    # The muxer goes back to the start of the file to finish its header,
+    # like the Xing header of a VBR mp3, so it can not write to a pipe
+    seekable: bool = False
+    # Nominal bits per second of the encode, 0 when it keeps the source
+    bitrate: int = 0
+
+    def size(self, duration: int, source: int) -> int:
+        """Estimated bytes of the encode of an audio"""
+        if not self.bitrate:
+            return source
+        return self.bitrate * duration // 8
+
+
+PROFILES = {profile.name: profile for profile in [
+    Profile(name="mp3-cbr-128", format="mp3", extension="mp3",
+            arguments=["-c:a", "libmp3lame", "-b:a", "128k"],
+            bitrate=128000),
+    Profile(name="mp3-cbr-64", format="mp3", extension="mp3",
+            arguments=["-c:a", "libmp3lame", "-b:a", "64k"],
+            bitrate=64000),
+    Profile(name="mp3-vbr", format="mp3", extension="mp3",
+            arguments=["-c:a", "libmp3lame", "-q:a", "5"], seekable=True,
+            bitrate=130000),
+    Profile(name="mp3-voice", format="mp3", extension="mp3",
+            arguments=["-c:a", "libmp3lame", "-ac", "1", "-ar", "22050",
+                       "-b:a", "48k"], bitrate=48000),
+    Profile(name="opus-voice", format="ogg", extension="ogg",
+            arguments=["-c:a", "libopus", "-ac", "1", "-b:a", "32k",
+                       "-application", "voip"], bitrate=32000),
+    Profile(name="opus-passthrough", format="ogg", extension="ogg",
+            arguments=["-c:a", "copy"], passthrough=True),
+    Profile(name="mp3-passthrough", format="mp3", extension="mp3",
+            arguments=["-c:a", "copy"], passthrough=True, seekable=True),
+]}
+DEFAULT = PROFILES["mp3-cbr-128"]
+# With the "auto" profile, audios already in a publishable codec are only
+# remuxed, and everything else is encoded as mp3
+AUTO = {
+    "audio/ogg": "opus-passthrough",
+    "audio/opus": "opus-passthrough",
+    "audio/mpeg": "mp3-passthrough",
+}
+
+
+class ProfileException(Exception):
+    pass
+
+
+def select(mime_type: str, name: str = DEFAULT.name) -> Profile:
+    """The encoding profile for an audio of the given MIME type"""
+    if name == "auto":
+        name = AUTO.get(mime_type, "mp3-vbr")
+    try:
+        profile = PROFILES[name]
+    except KeyError:
+        raise ProfileException(f"Encoding profile {name} not exists")
+    logger.debug("Profile for %s: %s", mime_type, profile.name)
+    return profile
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import logging
+import metrics
+import time
+from datetime import datetime, timedelta
+from audio import Audio, State
+from jobs import JobQueue
+from periodic import PeriodicWorker
+from register import Register
+
+# Audios that have or had a publish job take the state of their last one
+BACKFILL = """
+    UPDATE audios SET state = CASE (
+        SELECT j.status FROM jobs j WHERE j.identifier = audios.identifier
+        AND j.kind = 'publish' ORDER BY j.id DESC LIMIT 1)
+        WHEN 'done' THEN 'published'
+        WHEN 'failed' THEN 'failed'
+        ELSE 'queued' END,
+    published = EXISTS (
+        SELECT 1 FROM jobs j WHERE j.identifier = audios.identifier
+        AND j.kind = 'publish' AND j.status = 'done')
+    WHERE NOT published AND EXISTS (
+        SELECT 1 FROM jobs j WHERE j.identifier = audios.identifier
+        AND j.kind = 'publish')
+"""
+ACTIVE = """
+    SELECT 1 FROM jobs j WHERE j.identifier = a.identifier
+    AND j.kind = 'publish' AND j.status IN ('pending', 'running')
+"""
+FAILURES = """
+    SELECT COUNT(1) FROM jobs j WHERE j.identifier = a.identifier
+    AND j.kind = 'publish' AND j.status = 'failed'
+"""
+LAST_PAYLOAD = """
+    SELECT j.payload FROM jobs j WHERE j.identifier = a.identifier
+    AND j.kind = 'publish' ORDER BY j.id DESC LIMIT 1
+"""
+
+RECONCILED = metrics.counter("publish_reconciled_total",
+                             "Audios queued again by the reconciler",
+                             ("state",))
+
+logger = logging.getLogger(__name__)
+
+
+class ReconcilerException(Exception):
+    pass
+
+
+class Reconciler(PeriodicWorker):
+    """Queue again the audios whose publication stopped halfway
+
+    An audio is picked up when it is queued or publishing without a
+    publish job pending or running for `stuck` seconds, or when it
+    failed `retry` seconds ago and has failed fewer than `rounds` times.
+    Every pass queues at most as many audios as leave `batch` publish
+    jobs pending or running, oldest first, so the workers catch up after
+    an outage without flooding the queue. Drafts are never published,
+    they still wait for the editor. Every pass also removes the jobs
+    done more than `history` seconds ago.
+    """
+
+    def __init__(self, register: Register, jobs: JobQueue, payload: dict,
+                 interval: float = 60, batch: int = 20, stuck: float = 900,
+                 retry: float = 3600, rounds: int = 5,
+                 history: float = 7 * 86400):
+        super().__init__("reconciler", interval)
+        self._register = register
+        self._jobs = jobs
+        self._payload = payload
+        self._batch = batch
+        self._stuck = stuck
+        self._retry = retry
+        self._rounds = rounds
+        self._history = history
+        try:
+            self._register.migrate("reconciler", [[BACKFILL]])
+        except Exception as e:
+            raise ReconcilerException(e)
+
+    def _pass(self) -> bool:
+        """The queue filled up, more audios may be stuck"""
+        queued, room = self.reconcile()
+        return bool(queued) and queued == room
+
+    def reconcile(self) -> tuple[int, int]:
+        """Run one pass, returns the audios queued and the room there was"""
+        self._jobs.prune(self._history)
+        now = datetime.now()
+        sql = ("SELECT a.*, (" + LAST_PAYLOAD + ") FROM audios a"
+               " WHERE NOT published AND ((a.state IN (?, ?)"
+               " AND a.updated_at < ? AND NOT EXISTS (" + ACTIVE + "))"
+               " OR (a.state = ? AND a.updated_at < ?"
+               " AND (" + FAILURES + ") < ?))"
+               " ORDER BY a.updated_at LIMIT ?")
+        try:
+            with self._register.reader() as connection:
+                active = connection.execute(
+                    "SELECT COUNT(1) FROM jobs WHERE kind = 'publish'"
+                    " AND status IN ('pending', 'running')").fetchone()[0]
+                room = max(self._batch - active, 0)
+                if not room:
+                    return 0, 0
+                data = (State.QUEUED, State.PUBLISHING,
+                        now - timedelta(seconds=self._stuck), State.FAILED,
+                        now - timedelta(seconds=self._retry), self._rounds,
+                        room)
+                rows = connection.execute(sql, data).fetchall()
+        except Exception as e:
+            raise ReconcilerException(e)
+        for row in rows:
+            audio = Audio.from_cursor(row[:-1])
+            payload = json.loads(row[-1]) if row[-1] else self._payload
+            self.queue(audio, payload)
+        if rows:
+            logger.info("Reconciler queued %s audios", len(rows))
+        return len(rows), room
+
+    def queue(self, audio: Audio, payload: dict) -> None:
+        """Queue the publication of an audio, at its `publish_at` if due"""
+        state = audio.state
+        delay = 0
+        if audio.publish_at is not None:
+            delay = max(audio.publish_at.timestamp() - time.time(), 0)
+        self._register.set_state(audio.identifier, State.QUEUED)
+        self._jobs.enqueue("publish", {**payload,
+                                       "identifier": audio.identifier},
+                           delay)
+        RECONCILED.inc(state=state)
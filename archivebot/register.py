@@ -21,12 +21,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import log
 import logging
+import metrics
 import sqlite3
 import uuid
 from datetime import datetime
-from audio import Audio
+from collections.abc import Iterator
+from audio import TRANSITIONS, Audio, AudioRecord, State
+from database import ConnectionPool
+from instrumentation import traced
+from s3 import Checksum
 
 
 AUDIOS = """
@@ -47,9 +51,65 @@ AUDIOS = """
         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
 """
+# Rows that share a file with a published row or a more recent one
+DUPLICATES = """
+    SELECT id, identifier, file_unique_id FROM (
+        SELECT id, identifier, file_unique_id, ROW_NUMBER() OVER (
+            PARTITION BY file_unique_id
+            ORDER BY published DESC, id DESC) AS position
+        FROM audios)
+    WHERE position > 1
+"""
+
+
+def _deduplicate(connection) -> None:
+    """Before the unique index, give the duplicates of a file their own key
+
+    No row is removed: every row but one per file gets its id appended to
+    its file_unique_id, so it is kept and can be told apart.
+    """
+    for id, identifier, file_unique_id in connection.execute(
+            DUPLICATES).fetchall():
+        logger.warning("Audio %s duplicates the file %s, renamed to %s#%s",
+                       identifier, file_unique_id, file_unique_id, id)
+        connection.execute(
+            "UPDATE audios SET file_unique_id = file_unique_id || '#' || id"
+            " WHERE id = ?", (id,))
+
+
+MIGRATIONS = [
+    [AUDIOS],
+    [
+        _deduplicate,
+        "CREATE UNIQUE INDEX IF NOT EXISTS audios_identifier"
+        " ON audios(identifier)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS audios_file_unique_id"
+        " ON audios(file_unique_id)",
+        "CREATE INDEX IF NOT EXISTS audios_file_id ON audios(file_id)",
+    ],
+    [
+        "ALTER TABLE audios ADD COLUMN md5 TEXT DEFAULT ''",
+        "ALTER TABLE audios ADD COLUMN sha1 TEXT DEFAULT ''",
+        "ALTER TABLE audios ADD COLUMN encoded_size INTEGER DEFAULT 0",
+    ],
+    [
+        "ALTER TABLE audios ADD COLUMN state TEXT DEFAULT 'draft'",
+        "UPDATE audios SET state = 'published' WHERE published",
+        "CREATE INDEX IF NOT EXISTS audios_unpublished"
+        " ON audios(state, updated_at) WHERE NOT published",
+    ],
+    ["ALTER TABLE audios ADD COLUMN publish_at TIMESTAMP"],
+    # The first state migration quoted "published" as an identifier and
+    # set the state of the published audios to the column value, 1
+    ["UPDATE audios SET state = 'published' WHERE state = '1'"],
+]
 
 logger = logging.getLogger(__name__)
 
+STATEMENTS = metrics.histogram("sqlite_statement_seconds",
+                               "Latency of the Register operations",
+                               ("operation",))
+
 
 class RegisterException(Exception):
     pass
@@ -65,17 +125,30 @@ class RegisterNotExists(Exception):
 
 class Register:
 
-    @log.debug
-    def __init__(self, db):
-        self._connection = sqlite3.connect(db)
+    @traced
+    def __init__(self, db, readers=4):
         try:
-            cursor = self._connection.cursor()
-            cursor.execute(AUDIOS)
-            self._connection.commit()
+            self._pool = ConnectionPool(db, readers)
+            self._pool.migrate("audios", MIGRATIONS)
         except Exception as e:
             raise RegisterException(e)
 
-    @log.debug
+    def transaction(self):
+        """Borrow the writer connection and commit on success"""
+        return self._pool.transaction()
+
+    def reader(self):
+        """Borrow a reader connection"""
+        return self._pool.reader()
+
+    def migrate(self, component: str, migrations: list[list[str]]) -> int:
+        return self._pool.migrate(component, migrations)
+
+    def close(self) -> None:
+        self._pool.close()
+
+    @traced
+    @metrics.timed(STATEMENTS)
     def new(self, voice: dict) -> Audio:
         try:
             sql = ("INSERT INTO audios (identifier, duration, mime_type,"
@@ -85,110 +158,255 @@ class Register:
             data = (identifier, voice["duration"], voice["mime_type"],
                     voice["file_id"], voice["file_unique_id"],
                     voice["file_size"])
-            cursor = self._connection.execute(sql, data)
-            audio = Audio.from_cursor(cursor.fetchone())
-            self._connection.commit()
+            with self.transaction() as connection:
+                cursor = connection.execute(sql, data)
+                audio = Audio.from_cursor(cursor.fetchone())
             return audio
+        except sqlite3.IntegrityError:
+            raise RegisterExists(
+                f"Audio {voice['file_unique_id']} already exists")
+        except Exception as e:
+            raise RegisterException(e)
+
+    @traced
+    @metrics.timed(STATEMENTS)
+    def get(self, identifier: str) -> Audio:
+        try:
+            sql = "SELECT * FROM audios WHERE identifier = ?"
+            data = (identifier,)
+            with self.reader() as connection:
+                cursor = connection.execute(sql, data)
+                row = cursor.fetchone()
+        except Exception as e:
+            raise RegisterException(e)
+        if row is None:
+            raise RegisterNotExists(f"Audio {identifier} not exists")
+        return Audio.from_cursor(row)
+
+    @traced
+    @metrics.timed(STATEMENTS)
+    def get_by_file_unique_id(self, file_unique_id: str) -> Audio:
+        try:
+            sql = "SELECT * FROM audios WHERE file_unique_id = ?"
+            data = (file_unique_id,)
+            with self.reader() as connection:
+                cursor = connection.execute(sql, data)
+                row = cursor.fetchone()
         except Exception as e:
             raise RegisterException(e)
+        if row is None:
+            raise RegisterNotExists(f"Audio {file_unique_id} not exists")
+        return Audio.from_cursor(row)
 
-    @log.debug
+    @traced
+    @metrics.timed(STATEMENTS)
     def set_file_path(self, file_id: str, file_path: str) -> Audio:
         try:
             sql = ("UPDATE audios SET file_path = ?, updated_at = ?"
                    " WHERE file_id = ? RETURNING *")
             updated_at = datetime.now()
             data = (file_path, updated_at, file_id)
-            cursor = self._connection.execute(sql, data)
-            audio = Audio.from_cursor(cursor.fetchone())
-            self._connection.commit()
+            with self.transaction() as connection:
+                cursor = connection.execute(sql, data)
+                audio = Audio.from_cursor(cursor.fetchone())
             return audio
         except Exception as e:
             raise RegisterException(e)
 
-    @log.debug
+    @traced
+    @metrics.timed(STATEMENTS)
     def set_title(self, identifier: str, title: str) -> Audio:
         try:
             sql = ("UPDATE audios SET title = ?, updated_at = ?"
                    " WHERE identifier = ? RETURNING *")
             updated_at = datetime.now()
             data = (title, updated_at, identifier)
-            cursor = self._connection.execute(sql, data)
-            audio = Audio.from_cursor(cursor.fetchone())
-            self._connection.commit()
+            with self.transaction() as connection:
+                cursor = connection.execute(sql, data)
+                audio = Audio.from_cursor(cursor.fetchone())
             return audio
         except Exception as e:
             raise RegisterException(e)
 
-    @log.debug
+    @traced
+    @metrics.timed(STATEMENTS)
     def set_description(self, identifier: str, description: str) -> Audio:
         try:
             sql = ("UPDATE audios SET description = ?, updated_at = ?"
                    " WHERE identifier = ? RETURNING *")
             updated_at = datetime.now()
             data = (description, updated_at, identifier)
-            cursor = self._connection.execute(sql, data)
-            audio = Audio.from_cursor(cursor.fetchone())
-            self._connection.commit()
+            with self.transaction() as connection:
+                cursor = connection.execute(sql, data)
+                audio = Audio.from_cursor(cursor.fetchone())
             return audio
         except Exception as e:
             raise RegisterException(e)
 
-    @log.debug
+    @traced
+    @metrics.timed(STATEMENTS)
     def set_tags(self, identifier: str, tags: str) -> Audio:
         try:
             sql = ("UPDATE audios SET tags = ?, updated_at = ?"
                    " WHERE identifier = ? RETURNING *")
             updated_at = datetime.now()
             data = (tags, updated_at, identifier)
-            cursor = self._connection.execute(sql, data)
-            audio = Audio.from_cursor(cursor.fetchone())
-            self._connection.commit()
+            with self.transaction() as connection:
+                cursor = connection.execute(sql, data)
+                audio = Audio.from_cursor(cursor.fetchone())
             return audio
         except Exception as e:
             raise RegisterException(e)
 
-    @log.debug
+    @traced
+    @metrics.timed(STATEMENTS)
+    def set_checksum(self, identifier: str, checksum: Checksum) -> Audio:
+        try:
+            sql = ("UPDATE audios SET md5 = ?, sha1 = ?, encoded_size = ?,"
+                   " updated_at = ? WHERE identifier = ? RETURNING *")
+            updated_at = datetime.now()
+            data = (checksum.md5, checksum.sha1, checksum.size, updated_at,
+                    identifier)
+            with self.transaction() as connection:
+                cursor = connection.execute(sql, data)
+                audio = Audio.from_cursor(cursor.fetchone())
+            return audio
+        except Exception as e:
+            raise RegisterException(e)
+
+    @traced
+    @metrics.timed(STATEMENTS)
+    def set_publish_at(self, identifier: str,
+                       publish_at: datetime | None) -> Audio:
+        try:
+            sql = ("UPDATE audios SET publish_at = ?, updated_at = ?"
+                   " WHERE identifier = ? RETURNING *")
+            data = (publish_at, datetime.now(), identifier)
+            with self.transaction() as connection:
+                cursor = connection.execute(sql, data)
+                audio = Audio.from_cursor(cursor.fetchone())
+            return audio
+        except Exception as e:
+            raise RegisterException(e)
+
+    @traced
+    @metrics.timed(STATEMENTS)
+    def set_state(self, identifier: str, state: State) -> Audio:
+        """Move an audio to another state of its publication
+
+        Reaching State.PUBLISHED sets `published` too. A move that
+        TRANSITIONS does not allow raises RegisterException.
+        """
+        sources = [source for source, targets in TRANSITIONS.items()
+                   if state in targets]
+        marks = ", ".join("?" for _ in sources)
+        try:
+            sql = ("UPDATE audios SET state = ?, published = ?,"
+                   " updated_at = ? WHERE identifier = ?"
+                   f" AND state IN ({marks}) RETURNING *")
+            data = (state, state == State.PUBLISHED, datetime.now(),
+                    identifier, *sources)
+            with self.transaction() as connection:
+                row = connection.execute(sql, data).fetchone()
+                if row is None:
+                    row = connection.execute(
+                        "SELECT state FROM audios WHERE identifier = ?",
+                        (identifier,)).fetchone()
+        except Exception as e:
+            raise RegisterException(e)
+        if row is None:
+            raise RegisterNotExists(f"Audio {identifier} not exists")
+        if len(row) == 1:
+            raise RegisterException(
+                f"Audio {identifier} can not go from {row[0]} to {state}")
+        return Audio.from_cursor(row)
+
+    @traced
+    @metrics.timed(STATEMENTS)
     def delete(self, identifier: str) -> Audio:
         try:
             sql = ("DELETE FROM audios WHERE identifier = ? RETURNING *")
             data = (identifier,)
-            cursor = self._connection.execute(sql, data)
-            audio = Audio.from_cursor(cursor.fetchone())
-            self._connection.commit()
+            with self.transaction() as connection:
+                cursor = connection.execute(sql, data)
+                audio = Audio.from_cursor(cursor.fetchone())
             return audio
         except Exception as e:
             raise RegisterException(e)
 
-    @log.debug
-    def get_unpublished(self) -> list[Audio]:
+    @traced
+    @metrics.timed(STATEMENTS)
+    def get_unpublished(self, states: list[State] = [],
+                        limit: int = -1) -> list[Audio]:
+        """The audios not published yet, in any of `states` if given"""
         try:
-            sql = "SELECT * WHERE published = ?"
-            data = (False,)
-            cursor = self._connection.execute(sql, data)
-            audios = Audio.from_list(cursor.fetchall())
-            self._connection.commit()
+            # NOT published matches the partial index
+            sql = "SELECT * FROM audios WHERE NOT published"
+            if states:
+                marks = ", ".join("?" for _ in states)
+                sql += f" AND state IN ({marks})"
+            sql += " ORDER BY updated_at LIMIT ?"
+            data = (*states, limit)
+            with self.reader() as connection:
+                cursor = connection.execute(sql, data)
+                audios = Audio.from_list(cursor.fetchall())
             return audios
         except Exception as e:
             raise RegisterException(e)
 
-    @log.debug
-    def list(self) -> list[Audio]:
+    @traced
+    @metrics.timed(STATEMENTS)
+    def list(self, after_id: int = 0, limit: int = -1) -> list[Audio]:
+        """List the audios with an id greater than `after_id`
+
+        Use the id of the last audio of a page as the `after_id` of the
+        next one. A negative `limit` returns every remaining audio.
+        """
         try:
-            sql = "SELECT * FROM audios"
-            cursor = self._connection.execute(sql)
-            audios = Audio.from_list(cursor.fetchall())
-            self._connection.commit()
+            sql = "SELECT * FROM audios WHERE id > ? ORDER BY id LIMIT ?"
+            data = (after_id, limit)
+            with self.reader() as connection:
+                cursor = connection.execute(sql, data)
+                audios = Audio.from_list(cursor.fetchall())
             return audios
         except Exception as e:
             raise RegisterException(e)
 
-    @log.debug
+    def iter_audios(self, batch_size: int = 500, after_id: int = 0,
+                    limit: int = -1) -> Iterator[AudioRecord]:
+        """Stream the audios in id order as `AudioRecord`
+
+        Rows are read in batches of `batch_size` with keyset pagination,
+        so memory use stays constant and no read transaction is held
+        between batches.
+        """
+        sql = "SELECT * FROM audios WHERE id > ? ORDER BY id LIMIT ?"
+        remaining = limit
+        while remaining != 0:
+            size = batch_size if remaining < 0 else min(batch_size,
+                                                        remaining)
+            try:
+                with STATEMENTS.time(operation="iter_audios"), \
+                        self.reader() as connection:
+                    cursor = connection.cursor()
+                    cursor.row_factory = AudioRecord.factory
+                    records = cursor.execute(sql, (after_id, size)).fetchall()
+            except Exception as e:
+                raise RegisterException(e)
+            yield from records
+            if len(records) < size:
+                return
+            after_id = records[-1].id
+            if remaining > 0:
+                remaining -= len(records)
+
+    @traced
+    @metrics.timed(STATEMENTS)
     def count(self) -> int:
         try:
             sql = "SELECT count(1) FROM audios"
-            cursor = self._connection.cursor()
-            res = cursor.execute(sql)
-            return res.fetchone()
+            with self.reader() as connection:
+                res = connection.execute(sql)
+                return res.fetchone()
         except Exception as e:
             raise RegisterException(e)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import base64
+import hashlib
+import logging
+import os
+import requests
+from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote
+from xml.etree import ElementTree
+
+ENDPOINT = "https://s3.us.archive.org"
+PART_SIZE = 16 * 1024 * 1024
+CHUNK = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class S3Exception(Exception):
+    def __init__(self, message: str, status_code: int = 0):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _Body:
+    """A part sent in small chunks, waiting for `limit` before each one"""
+
+    def __init__(self, chunk: bytes, limit):
+        self._chunk = memoryview(chunk)
+        self._limit = limit
+
+    def __len__(self) -> int:
+        return len(self._chunk)
+
+    def __iter__(self):
+        for start in range(0, len(self._chunk), CHUNK):
+            piece = self._chunk[start:start + CHUNK]
+            self._limit(len(piece))
+            yield piece.tobytes()
+
+
+class _File:
+    """A file sent in small chunks, waiting for `limit` before each one"""
+
+    def __init__(self, file, size: int, limit):
+        self._file = file
+        self._size = size
+        self._limit = limit
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self):
+        while chunk := self._file.read(CHUNK):
+            self._limit(len(chunk))
+            yield chunk
+
+
+class Checksum(BaseModel):
+    md5: str
+    sha1: str
+    size: int
+
+
+class Digest:
+    """MD5, SHA1 and size of a stream, computed while it is read"""
+
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._sha1 = hashlib.sha1()
+        self.size = 0
+
+    def update(self, chunk: bytes) -> None:
+        self._md5.update(chunk)
+        self._sha1.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def md5(self) -> str:
+        return self._md5.hexdigest()
+
+    @property
+    def sha1(self) -> str:
+        return self._sha1.hexdigest()
+
+    def checksum(self) -> Checksum:
+        return Checksum(md5=self.md5, sha1=self.sha1, size=self.size)
+
+
+def checksum(path: str) -> Checksum:
+    """Checksum of a file, reading it"""
+    digest = Digest()
+    with open(path, "rb") as fr:
+        while chunk := fr.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.checksum()
+
+
+def _header(value) -> str:
+    value = str(value).replace("\n", " ")
+    if value.isascii():
+        return value
+    return f"uri({quote(value)})"
+
+
+def metadata_headers(metadata: dict) -> dict:
+    """Internet Archive metadata as x-archive-meta headers"""
+    headers = {}
+    for key, value in metadata.items():
+        if isinstance(value, list):
+            for index, item in enumerate(value, start=1):
+                headers[f"x-archive-meta{index:02d}-{key}"] = _header(item)
+        else:
+            headers[f"x-archive-meta-{key}"] = _header(value)
+    return headers
+
+
+class S3Client:
+    """A client for the S3-compatible API of Internet Archive"""
+
+    def __init__(self, access: str, secret: str, endpoint: str = ENDPOINT,
+                 session: requests.Session | None = None, pool: int = 10):
+        self._endpoint = endpoint.rstrip("/")
+        if session is None:
+            # Enough kept-alive connections for the parallel parts
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool, pool_maxsize=pool)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self._session = session
+        self._session.headers.update(
+            {"authorization": f"LOW {access}:{secret}"})
+
+    def _url(self, identifier: str, filename: str) -> str:
+        return f"{self._endpoint}/{identifier}/{quote(filename)}"
+
+    def _check(self, response: requests.Response) -> requests.Response:
+        if response.status_code >= 300:
+            msg = f"Error HTTP {response.status_code}. {response.text}"
+            raise S3Exception(msg, response.status_code)
+        return response
+
+    def initiate(self, identifier: str, filename: str,
+                 metadata: dict) -> str:
+        headers = {"x-archive-auto-make-bucket": "1"}
+        headers.update(metadata_headers(metadata))
+        response = self._check(self._session.post(
+            self._url(identifier, filename), params={"uploads": ""},
+            headers=headers))
+        root = ElementTree.fromstring(response.content)
+        for element in root.iter():
+            if element.tag.endswith("UploadId"):
+                return element.text
+        raise S3Exception("No UploadId in the response")
+
+    def put(self, identifier: str, filename: str, path: str,
+            metadata: dict, checksum: Checksum | None = None,
+            derive: bool = True, limit=None) -> None:
+        """Upload a file in one request, streaming it from disk
+
+        With the `checksum` of the file it is sent as Content-MD5, so the
+        file is not read to hash it. `limit` is called with the bytes of
+        every write.
+        """
+        headers = {"x-archive-auto-make-bucket": "1",
+                   "x-archive-queue-derive": "1" if derive else "0"}
+        headers.update(metadata_headers(metadata))
+        if checksum is not None:
+            headers["Content-MD5"] = base64.b64encode(
+                bytes.fromhex(checksum.md5)).decode()
+            headers["x-archive-size-hint"] = str(checksum.size)
+        with open(path, "rb") as fr:
+            data = fr if limit is None else \
+                _File(fr, os.fstat(fr.fileno()).st_size, limit)
+            self._check(self._session.put(self._url(identifier, filename),
+                                          headers=headers, data=data))
+
+    def upload_part(self, identifier: str, filename: str, upload_id: str,
+                    number: int, chunk: bytes, limit=None) -> str:
+        """Upload a part, calling `limit` with the bytes of every write"""
+        md5 = base64.b64encode(hashlib.md5(chunk).digest()).decode()
+        response = self._check(self._session.put(
+            self._url(identifier, filename),
+            params={"partNumber": number, "uploadId": upload_id},
+            headers={"Content-MD5": md5},
+            data=chunk if limit is None else _Body(chunk, limit)))
+        return response.headers.get("ETag", "")
+
+    def list_parts(self, identifier: str, filename: str,
+                   upload_id: str) -> dict[int, str]:
+        """The ETag of every part the server has, by part number"""
+        parts = {}
+        marker = 0
+        while True:
+            response = self._check(self._session.get(
+                self._url(identifier, filename),
+                params={"uploadId": upload_id,
+                        "part-number-marker": marker}))
+            root = ElementTree.fromstring(response.content)
+            truncated = False
+            for element in root.iter():
+                if element.tag.endswith("}Part") or element.tag == "Part":
+                    fields = {child.tag.rsplit("}", 1)[-1]: child.text
+                              for child in element}
+                    parts[int(fields["PartNumber"])] = fields["ETag"]
+                elif element.tag.endswith("IsTruncated"):
+                    truncated = element.text == "true"
+                elif element.tag.endswith("NextPartNumberMarker"):
+                    marker = int(element.text)
+            if not truncated:
+                return parts
+
+    def complete(self, identifier: str, filename: str, upload_id: str,
+                 etags: list[str]) -> None:
+        parts = "".join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag>"
+            "</Part>" for number, etag in enumerate(etags, start=1))
+        body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>"
+        self._check(self._session.post(
+            self._url(identifier, filename), params={"uploadId": upload_id},
+            data=body.encode("utf-8")))
+
+    def abort(self, identifier: str, filename: str, upload_id: str) -> None:
+        self._check(self._session.delete(
+            self._url(identifier, filename), params={"uploadId": upload_id}))
+
+    def upload_stream(self, identifier: str, filename: str, stream,
+                      metadata: dict, part_size: int = PART_SIZE,
+                      limit=None, check=None) -> Digest:
+        """Upload a stream of unknown length as a multipart upload
+
+        The stream is read in parts of `part_size` bytes, so memory use
+        is bounded, and the digest of the whole file is computed on the
+        fly. `check` is called when the stream ends, before the upload
+        is completed. If it raises, or the stream was empty, the upload
+        is aborted.
+        """
+        digest = Digest()
+        upload_id = self.initiate(identifier, filename, metadata)
+        etags = []
+        try:
+            while True:
+                chunk = _read(stream, part_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                etags.append(self.upload_part(identifier, filename,
+                                              upload_id, len(etags) + 1,
+                                              chunk, limit))
+                if len(chunk) < part_size:
+                    break
+            if not etags:
+                raise S3Exception(f"Nothing to upload to {filename}")
+            if check is not None:
+                check()
+            self.complete(identifier, filename, upload_id, etags)
+        except Exception:
+            try:
+                self.abort(identifier, filename, upload_id)
+            except Exception as exception:
+                logger.error("Abort of %s failed: %s", upload_id, exception)
+            raise
+        return digest
+
+
+def _read(stream, size: int) -> bytes:
+    """Read exactly `size` bytes unless the stream ends before"""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import metrics
+import re
+from datetime import date, datetime, time, timedelta
+from pydantic import BaseModel
+from register import Register
+from storage import parse_size
+
+WINDOWS = """
+    CREATE TABLE IF NOT EXISTS publish_windows(
+        start TIMESTAMP PRIMARY KEY,
+        bytes INTEGER NOT NULL DEFAULT 0
+    )
+"""
+# Days ahead to look for a window with room
+HORIZON = 7
+
+SCHEDULED = metrics.counter("publish_scheduled_total",
+                            "Uploads scheduled by the publish scheduler",
+                            ("when",))
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerException(Exception):
+    pass
+
+
+class Window(BaseModel):
+    start: time
+    end: time
+    # Bytes that can be uploaded in every occurrence, 0 for no limit
+    budget: int = 0
+
+    def occurrence(self, day: date) -> tuple[datetime, datetime]:
+        """The start and end of the window that starts on `day`"""
+        start = datetime.combine(day, self.start)
+        end = datetime.combine(day, self.end)
+        if end <= start:
+            end += timedelta(days=1)
+        return start, end
+
+
+def parse_windows(text: str) -> list[Window]:
+    """Windows such as 22:00-07:00=20G,13:00-15:00, the budget optional"""
+    windows = []
+    for item in filter(None, (item.strip() for item in text.split(","))):
+        match = re.fullmatch(r"(\d{1,2}:\d{2})\s*-\s*(\d{1,2}:\d{2})"
+                             r"(?:\s*=\s*(.+))?", item)
+        if match is None:
+            raise SchedulerException(f"Invalid window {item}")
+        try:
+            windows.append(Window(
+                start=time.fromisoformat(match.group(1).zfill(5)),
+                end=time.fromisoformat(match.group(2).zfill(5)),
+                budget=parse_size(match.group(3) or "0")))
+        except Exception as e:
+            raise SchedulerException(e)
+    return windows
+
+
+class PublishScheduler:
+    """Decide when every upload starts
+
+    Uploads under `threshold` bytes start right away. Bigger ones wait
+    for the next of the off-peak `windows` with room left in its byte
+    budget, or start right away if one is open. The bytes of every
+    upload are reserved in the occurrence of its window, in the register,
+    so the budgets hold across restarts. An upload bigger than a whole
+    budget gets an occurrence of its own. Without windows, every upload
+    starts right away.
+    """
+
+    def __init__(self, register: Register, windows: list[Window] = [],
+                 threshold: int = 20 * 1024 * 1024):
+        self._register = register
+        self._windows = windows
+        self._threshold = threshold
+        try:
+            self._register.migrate("scheduler", [[WINDOWS]])
+        except Exception as e:
+            raise SchedulerException(e)
+
+    def schedule(self, size: int, now: datetime | None = None) -> datetime:
+        """When an upload of `size` bytes starts"""
+        now = now or datetime.now()
+        if not self._windows or size < self._threshold:
+            SCHEDULED.inc(when="now")
+            return now
+        occurrences = sorted(
+            [(start, end, window) for window in self._windows
+             for offset in range(-1, HORIZON)
+             for start, end in [window.occurrence(
+                 now.date() + timedelta(days=offset))]
+             if end > now], key=lambda occurrence: occurrence[0])
+        sql = ("INSERT INTO publish_windows (start, bytes) VALUES (?, ?)"
+               " ON CONFLICT (start) DO UPDATE SET bytes = bytes + ?"
+               " WHERE ? = 0 OR bytes = 0 OR bytes + ? <= ?"
+               " RETURNING bytes")
+        try:
+            with self._register.transaction() as connection:
+                connection.execute("DELETE FROM publish_windows"
+                                   " WHERE start < ?",
+                                   (now - timedelta(days=HORIZON),))
+                for start, end, window in occurrences:
+                    if connection.execute(sql, (
+                            start, size, size, window.budget, size,
+                            window.budget)).fetchone() is not None:
+                        break
+                else:
+                    start = occurrences[0][0]
+        except Exception as e:
+            raise SchedulerException(e)
+        start = max(start, now)
+        SCHEDULED.inc(when="now" if start == now else "later")
+        logger.debug("Upload of %s bytes scheduled at %s", size, start)
+        return start
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from context import Context
+from register import Register, RegisterNotExists
+
+SESSIONS = """
+    CREATE TABLE IF NOT EXISTS sessions(
+        chat_id INTEGER NOT NULL,
+        thread_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        step INTEGER NOT NULL,
+        identifier TEXT DEFAULT "",
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (chat_id, thread_id, user_id)
+    )
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class SessionException(Exception):
+    pass
+
+
+class SessionStore:
+    """Conversation contexts keyed by (chat_id, thread_id, user_id)
+
+    The most recently used sessions are kept in a bounded in-memory LRU.
+    Every change is also written to the Register database, so evicted
+    sessions are reloaded from there and survive a restart. Sessions
+    untouched for longer than `ttl` seconds are forgotten.
+    """
+
+    def __init__(self, register: Register, capacity: int = 128,
+                 ttl: int = 86400):
+        self._register = register
+        self._capacity = capacity
+        self._ttl = ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+        try:
+            self._register.migrate("sessions", [[SESSIONS]])
+        except Exception as e:
+            raise SessionException(e)
+
+    def get(self, chat_id: int, thread_id: int, user_id: int) -> Context:
+        key = (chat_id, thread_id, user_id)
+        now = time.time()
+        self._sweep(now)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                context, touched = entry
+                if now - touched <= self._ttl:
+                    self._cache.move_to_end(key)
+                    return context.model_copy()
+                del self._cache[key]
+        context = self._load(key, now)
+        if context is None:
+            context = Context(chat_id=chat_id, thread_id=thread_id,
+                              user_id=user_id)
+        self._remember(context, now)
+        return context.model_copy()
+
+    def save(self, context: Context) -> None:
+        now = time.time()
+        sql = ("INSERT INTO sessions (chat_id, thread_id, user_id, step,"
+               " identifier, updated_at) VALUES (?, ?, ?, ?, ?, ?)"
+               " ON CONFLICT (chat_id, thread_id, user_id) DO UPDATE SET"
+               " step = excluded.step, identifier = excluded.identifier,"
+               " updated_at = excluded.updated_at")
+        data = (*context.key, context.step, context.audio.identifier, now)
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(sql, data)
+        except Exception as e:
+            raise SessionException(e)
+        self._remember(context.model_copy(), now)
+
+    def drop(self, context: Context) -> None:
+        sql = ("DELETE FROM sessions WHERE chat_id = ? AND thread_id = ?"
+               " AND user_id = ?")
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(sql, context.key)
+        except Exception as e:
+            raise SessionException(e)
+        with self._lock:
+            self._cache.pop(context.key, None)
+
+    def invalidate(self) -> None:
+        """Forget the cached sessions, they are reloaded from the database"""
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _remember(self, context: Context, now: float) -> None:
+        with self._lock:
+            self._cache[context.key] = (context, now)
+            self._cache.move_to_end(context.key)
+            while len(self._cache) > self._capacity:
+                self._cache.popitem(last=False)
+
+    def _load(self, key: tuple, now: float) -> Context | None:
+        sql = ("SELECT step, identifier FROM sessions WHERE chat_id = ?"
+               " AND thread_id = ? AND user_id = ? AND updated_at >= ?")
+        try:
+            with self._register.reader() as connection:
+                row = connection.execute(sql,
+                                         (*key, now - self._ttl)).fetchone()
+        except Exception as e:
+            raise SessionException(e)
+        if row is None:
+            return None
+        step, identifier = row
+        chat_id, thread_id, user_id = key
+        context = Context(chat_id=chat_id, thread_id=thread_id,
+                          user_id=user_id, step=step)
+        if identifier:
+            try:
+                context.audio = self._register.get(identifier)
+            except RegisterNotExists:
+                logger.debug("Audio %s of session %s is gone",
+                             identifier, key)
+                return None
+        return context
+
+    def _sweep(self, now: float) -> None:
+        if now - self._last_sweep < self._ttl / 10:
+            return
+        self._last_sweep = now
+        sql = "DELETE FROM sessions WHERE updated_at < ?"
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(sql, (now - self._ttl,))
+        except Exception as e:
+            raise SessionException(e)
+        with self._lock:
+            expired = [key for key, (_, touched) in self._cache.items()
+                       if now - touched > self._ttl]
+            for key in expired:
+                del self._cache[key]
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import metrics
+import os
+import re
+import time
+from datetime import datetime
+from files import FileStore
+from periodic import PeriodicWorker
+from register import Register
+
+ACTIVE = """
+    SELECT f.sha256 FROM jobs j
+    JOIN audios a ON a.identifier = j.identifier
+    JOIN files f ON f.file_unique_id = a.file_unique_id
+    WHERE j.kind = 'publish' AND j.status IN ('pending', 'running')
+"""
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+REMOVED = metrics.counter("storage_removed_total",
+                          "Files removed by the storage manager",
+                          ("reason",))
+FREED = metrics.counter("storage_freed_bytes_total",
+                        "Bytes freed by the storage manager", ("reason",))
+
+logger = logging.getLogger(__name__)
+
+
+class StorageException(Exception):
+    pass
+
+
+def parse_size(size: str) -> int:
+    """Bytes of a size such as 512M or 20G"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)I?B?\s*",
+                         size.upper())
+    if match is None:
+        raise StorageException(f"Invalid size {size}")
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+class StorageManager(PeriodicWorker):
+    """Keep the voice notes and their encodes within a disk budget
+
+    Every pass removes at most `batch` files, cheapest first:
+
+    - files of audios that are no longer in the register
+    - files of audios published more than `retention` seconds ago,
+      including the originals in the volume of the Bot API server
+    - while over `budget` bytes, the least recently used files: encodes
+      first, then voice notes of published audios, then the rest
+
+    Files of an audio with a publish job pending or running are never
+    removed. Files on disk that the store does not know are removed
+    after `grace` seconds, one directory per pass.
+    """
+
+    def __init__(self, register: Register, files: FileStore,
+                 budget: int = 0, retention: float = 7 * 86400,
+                 interval: float = 600, batch: int = 100,
+                 grace: float = 3600):
+        super().__init__("storage", interval)
+        self._register = register
+        self._files = files
+        self._budget = budget
+        self._retention = retention
+        self._batch = batch
+        self._grace = grace
+        self._directories = []
+
+    def _pass(self) -> bool:
+        """A full batch removed, there may be more over the budget"""
+        return self.collect() >= self._batch
+
+    def usage(self) -> int:
+        """Bytes used by the stored voice notes and encodes"""
+        sql = ("SELECT (SELECT COALESCE(SUM(size), 0) FROM blobs) +"
+               " (SELECT COALESCE(SUM(size), 0) FROM renditions)")
+        try:
+            with self._register.reader() as connection:
+                return connection.execute(sql).fetchone()[0]
+        except Exception as e:
+            raise StorageException(e)
+
+    def collect(self) -> int:
+        """Run one pass, returns the number of files removed"""
+        removed = 0
+        for step in (self._orphans, self._expired, self._over_budget,
+                     self._strays):
+            if removed >= self._batch:
+                break
+            removed += step(self._batch - removed)
+        logger.debug("Storage pass removed %s files", removed)
+        return removed
+
+    def _count(self, reason: str, size: int) -> int:
+        REMOVED.inc(reason=reason)
+        FREED.inc(size, reason=reason)
+        return 1
+
+    def _select(self, sql: str, data: tuple = ()) -> list[tuple]:
+        try:
+            with self._register.reader() as connection:
+                return connection.execute(sql, data).fetchall()
+        except Exception as e:
+            raise StorageException(e)
+
+    def _orphans(self, limit: int) -> int:
+        """Files of deleted audios, and content no file refers to"""
+        removed = 0
+        for file_unique_id, in self._select(
+                "SELECT f.file_unique_id FROM files f WHERE NOT EXISTS ("
+                " SELECT 1 FROM audios a"
+                " WHERE a.file_unique_id = f.file_unique_id) LIMIT ?",
+                (limit,)):
+            removed += self._count(
+                "orphan", self._files.forget_file(file_unique_id))
+        for sha256, variant in self._select(
+                "SELECT sha256, NULL FROM blobs b WHERE NOT EXISTS ("
+                " SELECT 1 FROM files f WHERE f.sha256 = b.sha256)"
+                " UNION ALL"
+                " SELECT sha256, variant FROM renditions r WHERE NOT EXISTS"
+                " (SELECT 1 FROM files f WHERE f.sha256 = r.sha256)"
+                " LIMIT ?", (limit - removed,)):
+            size = self._files.remove_blob(sha256) if variant is None \
+                else self._files.remove_rendition(sha256, variant)
+            removed += self._count("orphan", size)
+        return removed
+
+    def _expired(self, limit: int) -> int:
+        """Content whose audios were all published before the retention"""
+        if not self._retention:
+            return 0
+        cutoff = datetime.fromtimestamp(time.time() - self._retention)
+        removed = 0
+        # An audio is published when it reaches that state, and it is
+        # last updated then unless it was edited later
+        rows = self._select("""
+            SELECT DISTINCT f.sha256 FROM files f
+            WHERE f.sha256 != '' AND (
+                EXISTS (SELECT 1 FROM blobs b WHERE b.sha256 = f.sha256) OR
+                EXISTS (SELECT 1 FROM renditions r
+                        WHERE r.sha256 = f.sha256))
+            AND NOT EXISTS (
+                SELECT 1 FROM files g
+                LEFT JOIN audios a ON a.file_unique_id = g.file_unique_id
+                WHERE g.sha256 = f.sha256
+                AND (a.id IS NULL OR NOT a.published OR a.updated_at > ?))
+            LIMIT ?""", (cutoff, limit))
+        for sha256, in rows:
+            size = self._files.remove_originals(sha256)
+            for variant, in self._select(
+                    "SELECT variant FROM renditions WHERE sha256 = ?",
+                    (sha256,)):
+                size += self._files.remove_rendition(sha256, variant)
+            size += self._files.remove_blob(sha256)
+            removed += self._count("retention", size)
+        return removed
+
+    def _over_budget(self, limit: int) -> int:
+        """The least recently used files while over the budget"""
+        if not self._budget:
+            return 0
+        usage = self.usage()
+        if usage <= self._budget:
+            return 0
+        removed = 0
+        rows = self._select(f"""
+            SELECT sha256, variant FROM (
+                SELECT 0 AS priority, sha256, variant, used_at
+                FROM renditions
+                UNION ALL
+                SELECT CASE WHEN EXISTS (
+                    SELECT 1 FROM files f JOIN audios a
+                    ON a.file_unique_id = f.file_unique_id
+                    WHERE f.sha256 = b.sha256 AND a.published)
+                    THEN 1 ELSE 2 END,
+                    sha256, NULL, used_at
+                FROM blobs b)
+            WHERE sha256 NOT IN ({ACTIVE})
+            ORDER BY priority, used_at LIMIT ?""", (limit,))
+        for sha256, variant in rows:
+            if usage <= self._budget:
+                break
+            size = self._files.remove_blob(sha256) if variant is None \
+                else self._files.remove_rendition(sha256, variant)
+            usage -= size
+            removed += self._count("budget", size)
+        if usage > self._budget:
+            logger.warning("Storage over budget: %s of %s bytes", usage,
+                           self._budget)
+        return removed
+
+    def _strays(self, limit: int) -> int:
+        """Files in one directory of the store that it does not know"""
+        if not self._directories:
+            self._directories = [os.path.join(self._files.root, "tmp")]
+            for kind in ("blobs", "renditions"):
+                top = os.path.join(self._files.root, kind)
+                if os.path.isdir(top):
+                    self._directories += sorted(
+                        entry.path for entry in os.scandir(top)
+                        if entry.is_dir())
+        directory = self._directories.pop()
+        known = {path for path, in self._select(
+            "SELECT path FROM blobs WHERE path >= ? AND path < ?"
+            " UNION ALL"
+            " SELECT path FROM renditions WHERE path >= ? AND path < ?",
+            (f"{directory}/", f"{directory}0") * 2)}
+        removed = 0
+        now = time.time()
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            if removed >= limit:
+                break
+            if entry.is_file() and entry.path not in known and \
+                    now - entry.stat().st_mtime > self._grace:
+                removed += self._count("stray",
+                                       self._files.remove_path(entry.path))
+        return removed
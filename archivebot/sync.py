@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import logging
+import metrics
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from audio import Audio
+from iaclient import IAClient
+from periodic import PeriodicWorker
+from register import Register
+
+SNAPSHOTS = """
+    CREATE TABLE IF NOT EXISTS metadata_snapshots(
+        identifier TEXT PRIMARY KEY,
+        snapshot TEXT NOT NULL,
+        updated_at TIMESTAMP,
+        synced_at REAL NOT NULL
+    )
+"""
+# The metadata of an item that can be edited after it is uploaded
+FIELDS = ("title", "description", "subject")
+
+SYNCS = metrics.counter("ia_metadata_sync_total",
+                        "Items handled by the metadata sync", ("result",))
+PATCH_BYTES = metrics.counter("ia_metadata_patch_bytes_total",
+                              "Bytes of the metadata patches sent")
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataSyncException(Exception):
+    pass
+
+
+def _normal(value):
+    """Compare a value as Internet Archive stores it"""
+    if isinstance(value, list):
+        value = [item for item in value if item]
+        if len(value) == 1:
+            return value[0]
+        return value or ""
+    return "" if value is None else value
+
+
+def diff(old: dict, new: dict) -> list[dict]:
+    """The JSON patch that turns the `old` metadata into the `new` one"""
+    patch = []
+    for key in FIELDS:
+        before = _normal(old.get(key))
+        after = _normal(new.get(key))
+        if before == after:
+            continue
+        if after == "":
+            patch.append({"op": "remove", "path": f"/{key}"})
+        elif before == "":
+            patch.append({"op": "add", "path": f"/{key}", "value": after})
+        else:
+            patch.append({"op": "replace", "path": f"/{key}",
+                          "value": after})
+    return patch
+
+
+class MetadataSync(PeriodicWorker):
+    """Send the metadata edits of uploaded audios to Internet Archive
+
+    When an audio is uploaded, the metadata sent is kept as a snapshot
+    along with the `updated_at` of the audio. An audio updated after its
+    snapshot is diffed against it and only the fields that changed are
+    written, as a JSON patch, through the metadata API. Audios uploaded
+    before the snapshots existed are looked up in batches in the search
+    API and diffed against the metadata of their item, those without an
+    item only get a snapshot. Every pass syncs up to `batch` audios,
+    `concurrency` at a time.
+    """
+
+    def __init__(self, register: Register, client: IAClient,
+                 metadata: Callable[[Audio], dict], interval: float = 300,
+                 batch: int = 100, concurrency: int = 4):
+        super().__init__("metadata-sync", interval)
+        self._register = register
+        self._client = client
+        self._metadata = metadata
+        self._batch = batch
+        self._concurrency = concurrency
+        try:
+            self._register.migrate("metadata_sync", [[SNAPSHOTS]])
+        except Exception as e:
+            raise MetadataSyncException(e)
+
+    def _pass(self) -> bool:
+        """A full batch synced, more audios may be waiting"""
+        return self.sync() >= self._batch
+
+    def uploaded(self, audio: Audio) -> None:
+        """Keep the metadata an audio was uploaded with"""
+        self._save(audio, self._metadata(audio))
+
+    def forget(self, identifier: str) -> None:
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(
+                    "DELETE FROM metadata_snapshots WHERE identifier = ?",
+                    (identifier,))
+        except Exception as e:
+            raise MetadataSyncException(e)
+
+    def sync(self) -> int:
+        """Run one pass, returns the number of audios synced"""
+        pending = self._pending()
+        if not pending:
+            return 0
+        found = self._client.exists([audio.identifier
+                                     for audio, snapshot in pending
+                                     if snapshot is None])
+        pending = [(audio, snapshot,
+                    snapshot is not None or audio.identifier in found)
+                   for audio, snapshot in pending]
+        with ThreadPoolExecutor(self._concurrency,
+                                thread_name_prefix="metadata-sync") as pool:
+            synced = sum(pool.map(lambda item: self._sync(*item), pending))
+        logger.debug("Metadata sync handled %s of %s items", synced,
+                     len(pending))
+        return synced
+
+    def _pending(self) -> list[tuple[Audio, dict | None]]:
+        """Audios edited since their snapshot, then those without one"""
+        edited = ("SELECT a.*, s.snapshot FROM audios a"
+                  " JOIN metadata_snapshots s ON s.identifier = a.identifier"
+                  " WHERE a.updated_at > s.updated_at LIMIT ?")
+        unknown = ("SELECT a.*, NULL FROM audios a WHERE a.published"
+                   " AND NOT EXISTS (SELECT 1 FROM metadata_snapshots s"
+                   " WHERE s.identifier = a.identifier) LIMIT ?")
+        try:
+            with self._register.reader() as connection:
+                rows = connection.execute(edited, (self._batch,)).fetchall()
+                if len(rows) < self._batch:
+                    rows += connection.execute(
+                        unknown, (self._batch - len(rows),)).fetchall()
+        except Exception as e:
+            raise MetadataSyncException(e)
+        return [(Audio.from_cursor(row[:-1]),
+                 json.loads(row[-1]) if row[-1] is not None else None)
+                for row in rows]
+
+    def _sync(self, audio: Audio, snapshot: dict | None,
+              exists: bool = True) -> bool:
+        """Patch the fields changed since the snapshot, False on error"""
+        metadata = self._metadata(audio)
+        try:
+            if not exists:
+                logger.warning("%s has no item in Internet Archive",
+                               audio.identifier)
+                self._save(audio, metadata)
+                SYNCS.inc(result="missing")
+                return True
+            if snapshot is None:
+                item = self._client.item(audio.identifier)
+                snapshot = item.get("metadata", {}) if item else metadata
+            patch = diff(snapshot, metadata)
+            patched = False
+            if patch:
+                body = json.dumps(patch)
+                patched = self._client.patch(audio.identifier, patch)
+                PATCH_BYTES.inc(len(body))
+            self._save(audio, metadata)
+        except Exception as exception:
+            SYNCS.inc(result="failed")
+            logger.warning("Can not sync the metadata of %s: %s",
+                           audio.identifier, exception)
+            return False
+        SYNCS.inc(result="patched" if patched else "unchanged")
+        return True
+
+    def _save(self, audio: Audio, metadata: dict) -> None:
+        sql = ("INSERT OR REPLACE INTO metadata_snapshots (identifier,"
+               " snapshot, updated_at, synced_at) VALUES (?, ?, ?, ?)")
+        snapshot = json.dumps({key: metadata.get(key) for key in FIELDS})
+        data = (audio.identifier, snapshot, audio.updated_at, time.time())
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(sql, data)
+        except Exception as e:
+            raise MetadataSyncException(e)
@@ -21,25 +21,42 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import log
+import logging
+import metrics
+import random
 import requests
+import time
+from instrumentation import traced
+
+REQUESTS = metrics.counter("telegram_requests_total",
+                           "Requests to the Telegram Bot API",
+                           ("endpoint", "status"))
+LATENCY = metrics.histogram("telegram_request_seconds",
+                            "Latency of the Telegram Bot API requests",
+                            ("endpoint",))
+
+logger = logging.getLogger(__name__)
 
 
 class ExceptionTelegram(Exception):
-    pass
+    def __init__(self, message: str, retry_after: int = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
 
 
 class TelegramClient:
     """A Telegram Client"""
 
-    @log.debug
-    def __init__(self, token: str) -> None:
+    @traced
+    def __init__(self, token: str, retries: int = 3) -> None:
         """Init the client
 
         Parameters
         ----------
         token : str
             Token of the client
+        retries : int
+            Retries of a throttled or failed request
         update_offset : int
             First uptate to get
         update_timeout : int
@@ -48,8 +65,9 @@ class TelegramClient:
         # self._url = f"https://api.telegram.org/bot{token}"
         self._url = f"http://telegram-bot-api:8081/bot{token}"
         self._session = requests.Session()
+        self._retries = retries
 
-    @log.debug
+    @traced
     def get_me(self) -> dict:
         """Get info about the client
 
@@ -60,7 +78,7 @@ class TelegramClient:
         """
         return self._get("getMe")
 
-    @log.debug
+    @traced
     def get_file_info(self, file_id: str) -> dict:
         """Get info about the client
 
@@ -77,7 +95,7 @@ class TelegramClient:
             return result["result"]
         raise ExceptionTelegram("Result not ok")
 
-    @log.debug
+    @traced
     def get_updates(self, offset, timeout) -> dict:
         """Get updates
 
@@ -93,7 +111,7 @@ class TelegramClient:
         response = self._get("getUpdates", params)
         return response
 
-    @log.debug
+    @traced
     def send_message(self, text: str, chat_id: int,
                      thread_id: int = 0) -> dict:
         """Send a message
@@ -165,8 +183,84 @@ class TelegramClient:
             data.update({"message_thread_id": thread_id})
         return self._post("sendChatAction", data)
 
+    @traced
+    def set_webhook(self, url: str, secret_token: str = "",
+                    max_connections: int = 40) -> dict:
+        """Deliver the updates to an HTTPS or local URL
+
+        Parameters
+        ----------
+        url : str
+            The URL that receives the updates
+        secret_token : str
+            Sent back in the X-Telegram-Bot-Api-Secret-Token header
+        max_connections : int
+            Simultaneous connections used to deliver the updates
+
+        Returns
+        -------
+        dict
+            The response
+        """
+        data = {
+            "url": url,
+            "max_connections": max_connections,
+            "allowed_updates": ["message", "callback_query"],
+        }
+        if secret_token:
+            data.update({"secret_token": secret_token})
+        return self._post("setWebhook", data)
+
+    @traced
+    def delete_webhook(self) -> dict:
+        """Stop delivering the updates to a webhook, so getUpdates works"""
+        return self._post("deleteWebhook")
 
-    @log.debug
+    def _request(self, endpoint: str, **kwargs) -> dict:
+        """Send a request, retrying throttled and failed ones
+
+        A 429 answer is retried after the `retry_after` that Telegram
+        asks for, server and connection errors after a jittered
+        exponential backoff. Other errors are raised at once.
+        """
+        url = f"{self._url}/{endpoint}"
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                with LATENCY.time(endpoint=endpoint):
+                    response = self._session.get(url, **kwargs)
+            except requests.ConnectionError as exception:
+                REQUESTS.inc(endpoint=endpoint, status="error")
+                if attempt > self._retries:
+                    raise ExceptionTelegram(str(exception))
+                time.sleep(self._backoff(attempt))
+                continue
+            REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+            if response.status_code == 200:
+                return response.json()
+            msg = f"Error HTTP {response.status_code}. {response.text}"
+            retry_after = 0
+            if response.status_code == 429:
+                try:
+                    retry_after = response.json()["parameters"]["retry_after"]
+                except (ValueError, KeyError, TypeError):
+                    retry_after = 1
+                delay = retry_after * random.uniform(1, 1.1)
+            elif response.status_code >= 500:
+                delay = self._backoff(attempt)
+            else:
+                raise ExceptionTelegram(msg)
+            if attempt > self._retries:
+                raise ExceptionTelegram(msg, retry_after)
+            logger.warning("%s. Retrying %s in %.1f s", msg, endpoint, delay)
+            time.sleep(delay)
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        return min(2 ** (attempt - 1), 30) * random.uniform(0.5, 1)
+
+    @traced
     def _get(self, endpoint: str, params: dict = {}) -> dict:
         """Send a generic GET
 
@@ -182,14 +276,9 @@ class TelegramClient:
         dict
             Response from Telegram
         """
-        url = f"{self._url}/{endpoint}"
-        response = self._session.get(url, params=params)
-        if response.status_code != 200:
-            msg = f"Error HTTP {response.status_code}. {response.text}"
-            raise ExceptionTelegram(msg)
-        return response.json()
+        return self._request(endpoint, params=params)
 
-    @log.debug
+    @traced
     def _post(self, endpoint: str, data: dict = {}) -> dict:
         """Send a generic POST
 
@@ -205,9 +294,4 @@ class TelegramClient:
         dict
             Response from Telegram
         """
-        url = f"{self._url}/{endpoint}"
-        response = self._session.get(url, json=data)
-        if response.status_code != 200:
-            msg = f"Error HTTP {response.status_code}. {response.text}"
-            raise ExceptionTelegram(msg)
-        return response.json()
+        return self._request(endpoint, json=data)
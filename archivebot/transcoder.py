@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import heapq
+import itertools
+import logging
+import metrics
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+from contextlib import contextmanager
+from analysis import Analysis
+from converter import (REALTIME, SECONDS, Converter, ConverterException,
+                       EncodedStream)
+from profiles import DEFAULT, Profile
+from s3 import Checksum, Digest, checksum
+
+WAIT = metrics.histogram("transcode_wait_seconds",
+                         "Time a conversion waits in the transcode pool")
+TASKS = metrics.counter("transcode_tasks_total",
+                        "Conversions handled by the transcode pool",
+                        ("result",))
+
+# Outputs written to a pipe are given as SINK followed by their index in
+# the arguments, and become a pipe:N when ffmpeg starts
+SINK = "sink:"
+CHUNK = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class TranscodeTask:
+    """A conversion submitted to a `TranscodePool`"""
+
+    def __init__(self, arguments: list[str], result, duration: int,
+                 timeout: float, sinks: list[str] = [],
+                 descriptors: list[int] = []):
+        self.arguments = arguments
+        self.duration = duration
+        self.timeout = timeout
+        self.sinks = sinks
+        # Descriptors handed to ffmpeg, closed here once it has them
+        self.descriptors = list(descriptors)
+        self.checksums = {}
+        self.submitted_at = time.monotonic()
+        self.future = Future()
+        self._result = result
+        self._process = None
+        self._lock = threading.Lock()
+
+    def result(self, timeout: float | None = None):
+        return self.future.result(timeout)
+
+    def cancel(self) -> bool:
+        """Drop a pending conversion or kill a running one"""
+        with self._lock:
+            if self.future.cancel():
+                self._close()
+                return True
+            if self._process is not None and self._process.poll() is None:
+                self._process.kill()
+                return True
+        return False
+
+    def _start(self, arguments: list[str], errors,
+               pass_fds: list[int] = []) -> subprocess.Popen | None:
+        with self._lock:
+            if not self.future.set_running_or_notify_cancel():
+                self._close()
+                return None
+            try:
+                self._process = subprocess.Popen(
+                    arguments, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL, stderr=errors,
+                    pass_fds=pass_fds + self.descriptors)
+            finally:
+                self._close()
+            return self._process
+
+    def _close(self) -> None:
+        while self.descriptors:
+            os.close(self.descriptors.pop())
+
+
+def _drain(descriptor: int, path: str, digest: Digest) -> None:
+    """Write what ffmpeg sends to a pipe into a file, hashing it"""
+    with open(descriptor, "rb", buffering=0) as fr, open(path, "wb") as fw:
+        while chunk := fr.read(CHUNK):
+            digest.update(chunk)
+            fw.write(chunk)
+
+
+class TranscodePool:
+    """Run several ffmpeg conversions at once, shortest first
+
+    At most `budget` ffmpeg processes run at the same time, one CPU
+    each by default. Pending conversions are ordered by the duration of
+    their audio, so short voice notes never wait behind long recordings.
+    Conversions are killed when they exceed their timeout, and they run
+    with a lower CPU and I/O priority than the bot itself.
+    """
+
+    def __init__(self, budget: int = 0, timeout: float = 600,
+                 timeout_factor: float = 2, nice: int = 10,
+                 ionice: bool = True):
+        self._budget = budget or os.cpu_count() or 1
+        self._timeout = timeout
+        self._timeout_factor = timeout_factor
+        self._prefix = []
+        if nice and shutil.which("nice"):
+            self._prefix += ["nice", "-n", str(nice)]
+        if ionice and shutil.which("ionice"):
+            self._prefix += ["ionice", "-c", "3"]
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._threads = []
+
+    def _submit(self, arguments: list[str], result, duration: int,
+                timeout: float | None, sinks: list[str] = [],
+                descriptors: list[int] = []) -> TranscodeTask:
+        if timeout is None:
+            timeout = self._timeout + duration * self._timeout_factor
+        task = TranscodeTask(arguments, result, duration, timeout, sinks,
+                             descriptors)
+        with self._condition:
+            if self._stopping:
+                raise ConverterException("The transcode pool is stopped")
+            heapq.heappush(self._queue,
+                           (duration, next(self._sequence), task))
+            self._condition.notify()
+        return task
+
+    def submit(self, file_from: str, file_to: str, duration: int = 0,
+               timeout: float | None = None, profile: Profile = DEFAULT,
+               analysis: Analysis | None = None) -> TranscodeTask:
+        """Submit a conversion
+
+        Unless the profile needs a seekable output, ffmpeg writes to a
+        pipe and the file is written from it, computing its checksum.
+        """
+        if profile.seekable:
+            arguments = Converter.arguments(file_from, file_to, profile,
+                                            analysis=analysis)
+            return self._submit(arguments, file_to, duration, timeout)
+        arguments = Converter.arguments(file_from, f"{SINK}0", profile,
+                                        muxer=True, analysis=analysis)
+        return self._submit(arguments, file_to, duration, timeout,
+                            [file_to])
+
+    def submit_derivatives(self, file_from: str,
+                           outputs: list[tuple[str, Profile]],
+                           waveform: str = "", duration: int = 0,
+                           timeout: float | None = None,
+                           analysis: Analysis | None = None) -> TranscodeTask:
+        sinks = [file_to for file_to, profile in outputs
+                 if not profile.seekable]
+        piped = [(f"{SINK}{sinks.index(file_to)}" if file_to in sinks
+                  else file_to, profile) for file_to, profile in outputs]
+        arguments = Converter.derivatives_arguments(file_from, piped,
+                                                    waveform, analysis)
+        files = [file_to for file_to, _ in outputs]
+        if waveform:
+            files.append(waveform)
+        return self._submit(arguments, files, duration, timeout, sinks)
+
+    def convert(self, file_from: str, file_to: str, duration: int = 0,
+                profile: Profile = DEFAULT,
+                analysis: Analysis | None = None) -> Checksum:
+        """Convert through the pool and wait for the checksum"""
+        task = self.submit(file_from, file_to, duration, profile=profile,
+                           analysis=analysis)
+        task.result()
+        return task.checksums.get(file_to) or checksum(file_to)
+
+    def derivatives(self, file_from: str, outputs: list[tuple[str, Profile]],
+                    waveform: str = "", duration: int = 0,
+                    analysis: Analysis | None = None) -> dict[str, Checksum]:
+        """Encode several derivatives through the pool and wait for them
+
+        Returns the checksum of every file written.
+        """
+        task = self.submit_derivatives(file_from, outputs, waveform,
+                                       duration, analysis=analysis)
+        return {file: task.checksums.get(file) or checksum(file)
+                for file in task.result()}
+
+    def convert_segmented(self, file_from: str, file_to: str,
+                          duration: int, segment: int = 300,
+                          profile: Profile = DEFAULT,
+                          analysis: Analysis | None = None) -> Checksum:
+        """Convert a long audio through the pool decoding it in segments
+
+        Every segment and the final encode are conversions of the pool,
+        so they share its budget, priority and timeouts. See
+        `Converter.convert_segmented`.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            segments = Converter.segments(file_from, directory, duration,
+                                          segment, analysis)
+            length = duration // len(segments)
+            tasks = []
+            try:
+                for arguments in segments:
+                    tasks.append(self._submit(arguments, arguments[-1],
+                                              length, None))
+                for task in tasks:
+                    task.result()
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+            if profile.seekable:
+                arguments = Converter.join_arguments(
+                    directory, len(segments), file_to, profile)
+                task = self._submit(arguments, file_to, duration, None)
+            else:
+                arguments = Converter.join_arguments(
+                    directory, len(segments), f"{SINK}0", profile,
+                    muxer=True)
+                task = self._submit(arguments, file_to, duration, None,
+                                    [file_to])
+            task.result()
+        return task.checksums.get(file_to) or checksum(file_to)
+
+    @contextmanager
+    def stream(self, file_from: str, profile: Profile = DEFAULT,
+               duration: int = 0, analysis: Analysis | None = None):
+        """Convert through the pool to a pipe instead of a file
+
+        Yields an `EncodedStream` of the pipe where ffmpeg writes the
+        encoded audio. The conversion holds a slot of the pool while the
+        pipe is consumed.
+        """
+        read, write = os.pipe()
+        arguments = Converter.arguments(file_from, f"pipe:{write}", profile,
+                                        muxer=True, analysis=analysis)
+        try:
+            task = self._submit(arguments, None, duration, None,
+                                descriptors=[write])
+        except BaseException:
+            os.close(read)
+            os.close(write)
+            raise
+        with open(read, "rb") as pipe:
+            try:
+                yield EncodedStream(pipe, task.result)
+            except BaseException:
+                task.cancel()
+                raise
+        task.result()
+
+    def start(self) -> None:
+        self._stopping = False
+        for index in range(self._budget):
+            thread = threading.Thread(target=self._work,
+                                      name=f"transcode-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Cancel the pending conversions and wait for the running ones"""
+        with self._condition:
+            self._stopping = True
+            while self._queue:
+                _, _, task = heapq.heappop(self._queue)
+                task.cancel()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                _, _, task = heapq.heappop(self._queue)
+            self._run(task)
+
+    def _run(self, task: TranscodeTask) -> None:
+        pipes = [os.pipe() for _ in task.sinks]
+        arguments = [f"pipe:{pipes[int(argument[len(SINK):])][1]}"
+                     if argument.startswith(SINK) else argument
+                     for argument in task.arguments]
+        arguments = self._prefix + ["ffmpeg", "-v", "error"] + arguments
+        digests = [Digest() for _ in task.sinks]
+        drains = [threading.Thread(target=_drain, args=(read, path, digest),
+                                   daemon=True)
+                  for (read, _), path, digest
+                  in zip(pipes, task.sinks, digests)]
+        with tempfile.TemporaryFile() as errors:
+            try:
+                process = task._start(arguments, errors,
+                                      [write for _, write in pipes])
+            except Exception as exception:
+                for read, _ in pipes:
+                    os.close(read)
+                TASKS.inc(result="error")
+                task.future.set_exception(ConverterException(exception))
+                return
+            finally:
+                for _, write in pipes:
+                    os.close(write)
+            if process is None:
+                for read, _ in pipes:
+                    os.close(read)
+                TASKS.inc(result="cancelled")
+                return
+            for drain in drains:
+                drain.start()
+            WAIT.observe(time.monotonic() - task.submitted_at)
+            start = time.perf_counter()
+            try:
+                returncode = process.wait(task.timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+                for drain in drains:
+                    drain.join()
+                TASKS.inc(result="timeout")
+                task.future.set_exception(ConverterException(
+                    f"ffmpeg timed out after {task.timeout} s"))
+                return
+            for drain in drains:
+                drain.join()
+            elapsed = time.perf_counter() - start
+            if returncode < 0:
+                TASKS.inc(result="cancelled")
+                task.future.set_exception(CancelledError())
+            elif returncode > 0:
+                errors.seek(0)
+                message = errors.read().decode("utf-8", "replace")
+                TASKS.inc(result="error")
+                task.future.set_exception(ConverterException(
+                    f"ffmpeg exited with {returncode}: {message}"))
+            else:
+                SECONDS.observe(elapsed)
+                if task.duration and elapsed:
+                    REALTIME.observe(task.duration / elapsed)
+                TASKS.inc(result="done")
+                task.checksums = {path: digest.checksum() for path, digest
+                                  in zip(task.sinks, digests)}
+                task.future.set_result(task._result)
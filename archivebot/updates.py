@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import logging
+import time
+from register import Register
+
+STATE = """
+    CREATE TABLE IF NOT EXISTS state(
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+"""
+UPDATES = """
+    CREATE TABLE IF NOT EXISTS updates(
+        update_id INTEGER PRIMARY KEY,
+        processed_at REAL NOT NULL
+    )
+"""
+# Updates received by the webhook and not processed yet
+INBOX = """
+    CREATE TABLE IF NOT EXISTS inbox(
+        update_id INTEGER PRIMARY KEY,
+        payload TEXT NOT NULL,
+        received_at REAL NOT NULL
+    )
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateLedgerException(Exception):
+    pass
+
+
+class UpdateLedger:
+    """The Telegram update offset and the updates already processed
+
+    Both live in the Register database. Record an update inside the same
+    transaction as the changes it causes, so that an update is either
+    fully processed and never handled again, or not processed at all.
+    Updates pushed by a webhook are kept in an inbox until then.
+    """
+
+    def __init__(self, register: Register, remember: int = 10000):
+        self._register = register
+        self._remember = remember
+        self._recorded = 0
+        try:
+            self._register.migrate("updates", [[STATE, UPDATES], [INBOX]])
+        except Exception as e:
+            raise UpdateLedgerException(e)
+
+    @property
+    def offset(self) -> int:
+        sql = "SELECT value FROM state WHERE key = 'offset'"
+        try:
+            with self._register.reader() as connection:
+                row = connection.execute(sql).fetchone()
+        except Exception as e:
+            raise UpdateLedgerException(e)
+        return int(row[0]) if row else 0
+
+    def set_offset(self, offset: int) -> None:
+        sql = ("INSERT INTO state (key, value) VALUES ('offset', ?)"
+               " ON CONFLICT (key) DO UPDATE SET value = max(CAST(value AS"
+               " INTEGER), CAST(excluded.value AS INTEGER))")
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(sql, (offset,))
+        except Exception as e:
+            raise UpdateLedgerException(e)
+
+    def is_processed(self, update_id: int) -> bool:
+        sql = "SELECT 1 FROM updates WHERE update_id = ?"
+        try:
+            with self._register.reader() as connection:
+                row = connection.execute(sql, (update_id,)).fetchone()
+        except Exception as e:
+            raise UpdateLedgerException(e)
+        return row is not None
+
+    def receive(self, update_id: int, update: dict) -> bool:
+        """Keep an update in the inbox, False if it was already known"""
+        sql = ("INSERT OR IGNORE INTO inbox (update_id, payload,"
+               " received_at) VALUES (?, ?, ?)")
+        try:
+            with self._register.transaction() as connection:
+                if self.is_processed(update_id):
+                    return False
+                cursor = connection.execute(
+                    sql, (update_id, json.dumps(update), time.time()))
+                return cursor.rowcount == 1
+        except Exception as e:
+            raise UpdateLedgerException(e)
+
+    def pending(self, limit: int = 100) -> list[dict]:
+        """The updates of the inbox, oldest first"""
+        sql = ("SELECT payload FROM inbox i WHERE NOT EXISTS (SELECT 1"
+               " FROM updates u WHERE u.update_id = i.update_id)"
+               " ORDER BY update_id LIMIT ?")
+        try:
+            with self._register.reader() as connection:
+                rows = connection.execute(sql, (limit,)).fetchall()
+        except Exception as e:
+            raise UpdateLedgerException(e)
+        return [json.loads(payload) for payload, in rows]
+
+    def processed(self, update_id: int) -> None:
+        """Record an update, out of the inbox, and move the offset past it"""
+        sql = ("INSERT OR IGNORE INTO updates (update_id, processed_at)"
+               " VALUES (?, ?)")
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(sql, (update_id, time.time()))
+                connection.execute("DELETE FROM inbox WHERE update_id = ?",
+                                   (update_id,))
+                self.set_offset(update_id + 1)
+                self._recorded += 1
+                if self._recorded % 100 == 0:
+                    connection.execute(
+                        "DELETE FROM updates WHERE update_id < ?",
+                        (update_id - self._remember,))
+        except Exception as e:
+            raise UpdateLedgerException(e)
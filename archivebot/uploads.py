@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import math
+import metrics
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from outbound import TokenBucket
+from register import Register
+from s3 import PART_SIZE, S3Client, S3Exception
+
+UPLOADS = """
+    CREATE TABLE IF NOT EXISTS uploads(
+        identifier TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        upload_id TEXT NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        part_size INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (identifier, filename)
+    )
+"""
+PARTS = """
+    CREATE TABLE IF NOT EXISTS upload_parts(
+        upload_id TEXT NOT NULL,
+        number INTEGER NOT NULL,
+        etag TEXT NOT NULL,
+        PRIMARY KEY (upload_id, number)
+    ) WITHOUT ROWID
+"""
+MIGRATIONS = [[UPLOADS, PARTS]]
+
+PART_RESULTS = metrics.counter("s3_parts_total",
+                               "Parts of the multipart uploads",
+                               ("result",))
+
+logger = logging.getLogger(__name__)
+
+
+class UploadException(Exception):
+    pass
+
+
+class Bandwidth:
+    """A `TokenBucket` of bytes shared by the threads of the uploads"""
+
+    def __init__(self, rate: float):
+        self._bucket = TokenBucket(rate, rate)
+        self._lock = threading.Lock()
+
+    def __call__(self, amount: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            delay = self._bucket.ready_in(now, amount)
+            self._bucket.consume(now, amount)
+        if delay:
+            time.sleep(delay)
+
+
+class MultipartUploader:
+    """Upload files in parallel parts, resuming interrupted uploads
+
+    Every upload and the ETag of every finished part are kept in the
+    register. An upload of the same, unchanged file resumes where it
+    stopped, even after a restart, sending only the parts that the
+    server does not have. `workers` parts are sent at once and each
+    one is retried with a jittered backoff. With a `rate`, in bytes per
+    second, all the uploads together never exceed it. A `bandwidth`
+    shares the limit with other uploads.
+    """
+
+    def __init__(self, register: Register, client: S3Client,
+                 workers: int = 4, part_size: int = PART_SIZE,
+                 rate: float = 0, retries: int = 3,
+                 bandwidth: Bandwidth | None = None):
+        self._register = register
+        self._client = client
+        self._workers = workers
+        self._part_size = part_size
+        self._limit = bandwidth or (Bandwidth(rate) if rate else None)
+        self._retries = retries
+        try:
+            self._register.migrate("uploads", MIGRATIONS)
+        except Exception as e:
+            raise UploadException(e)
+
+    def upload(self, identifier: str, filename: str, path: str,
+               metadata: dict) -> None:
+        stat = os.stat(path)
+        upload_id, done = self._resume(identifier, filename, path, stat)
+        if upload_id is None:
+            upload_id = self._client.initiate(identifier, filename,
+                                              metadata)
+            self._save(identifier, filename, upload_id, path, stat)
+            done = {}
+        parts = max(1, math.ceil(stat.st_size / self._part_size))
+        todo = [number for number in range(1, parts + 1)
+                if number not in done]
+        PART_RESULTS.inc(len(done), result="resumed")
+        logger.debug("Upload %s of %s: %s parts, %s to send", upload_id,
+                     path, parts, len(todo))
+        etags = dict(done)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            with ThreadPoolExecutor(self._workers) as executor:
+                futures = {executor.submit(self._part, identifier, filename,
+                                           upload_id, fd, number): number
+                           for number in todo}
+                finished, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in futures:
+                    future.cancel()
+                for future in finished:
+                    etags[futures[future]] = future.result()
+        finally:
+            os.close(fd)
+        self._client.complete(identifier, filename, upload_id,
+                              [etags[number]
+                               for number in range(1, parts + 1)])
+        self._forget(identifier, filename, upload_id)
+
+    def _part(self, identifier: str, filename: str, upload_id: str,
+              fd: int, number: int) -> str:
+        chunk = os.pread(fd, self._part_size,
+                         (number - 1) * self._part_size)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                etag = self._client.upload_part(identifier, filename,
+                                                upload_id, number, chunk,
+                                                self._limit)
+                break
+            except Exception as exception:
+                if attempt > self._retries:
+                    PART_RESULTS.inc(result="failed")
+                    raise
+                PART_RESULTS.inc(result="retried")
+                delay = min(2 ** (attempt - 1), 30) * random.uniform(0.5, 1)
+                logger.warning("Part %s of %s failed: %s. Retrying in"
+                               " %.1f s", number, upload_id, exception, delay)
+                time.sleep(delay)
+        PART_RESULTS.inc(result="uploaded")
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO upload_parts (upload_id, number,"
+                    " etag) VALUES (?, ?, ?)", (upload_id, number, etag))
+        except Exception as e:
+            raise UploadException(e)
+        return etag
+
+    def _resume(self, identifier: str, filename: str, path: str,
+                stat: os.stat_result) -> tuple[str | None, dict[int, str]]:
+        """The upload to continue and its finished parts, if any"""
+        try:
+            with self._register.reader() as connection:
+                row = connection.execute(
+                    "SELECT upload_id, path, size, mtime, part_size FROM"
+                    " uploads WHERE identifier = ? AND filename = ?",
+                    (identifier, filename)).fetchone()
+                if row is None:
+                    return None, {}
+                recorded = dict(connection.execute(
+                    "SELECT number, etag FROM upload_parts"
+                    " WHERE upload_id = ?", (row[0],)).fetchall())
+        except Exception as e:
+            raise UploadException(e)
+        upload_id = row[0]
+        if tuple(row[1:]) != (path, stat.st_size, stat.st_mtime,
+                              self._part_size):
+            logger.info("File of upload %s changed, starting over",
+                        upload_id)
+            self._abandon(identifier, filename, upload_id)
+            return None, {}
+        try:
+            remote = self._client.list_parts(identifier, filename,
+                                             upload_id)
+        except S3Exception as exception:
+            if exception.status_code == 404:
+                logger.info("Upload %s expired, starting over", upload_id)
+                self._forget(identifier, filename, upload_id)
+                return None, {}
+            # Without the list of the server, trust the manifest
+            logger.warning("Can not list the parts of %s: %s", upload_id,
+                           exception)
+            return upload_id, recorded
+        return upload_id, {number: etag for number, etag in recorded.items()
+                           if remote.get(number) == etag}
+
+    def _abandon(self, identifier: str, filename: str,
+                 upload_id: str) -> None:
+        try:
+            self._client.abort(identifier, filename, upload_id)
+        except Exception as exception:
+            logger.warning("Abort of %s failed: %s", upload_id, exception)
+        self._forget(identifier, filename, upload_id)
+
+    def _save(self, identifier: str, filename: str, upload_id: str,
+              path: str, stat: os.stat_result) -> None:
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO uploads (identifier, filename,"
+                    " upload_id, path, size, mtime, part_size, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (identifier, filename, upload_id, path, stat.st_size,
+                     stat.st_mtime, self._part_size, time.time()))
+        except Exception as e:
+            raise UploadException(e)
+
+    def _forget(self, identifier: str, filename: str,
+                upload_id: str) -> None:
+        try:
+            with self._register.transaction() as connection:
+                connection.execute(
+                    "DELETE FROM upload_parts WHERE upload_id = ?",
+                    (upload_id,))
+                connection.execute(
+                    "DELETE FROM uploads WHERE identifier = ? AND"
+                    " filename = ?", (identifier, filename))
+        except Exception as e:
+            raise UploadException(e)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hmac
+import json
+import logging
+import metrics
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from updates import UpdateLedger
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Seconds to wait before dispatching again an update that failed
+RETRY = 5
+
+RECEIVED = metrics.counter("webhook_updates_total",
+                           "Updates received by the webhook",
+                           ("result",))
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """A small HTTP server that receives the Telegram updates
+
+    Every update is kept in the inbox of the `UpdateLedger` before it is
+    acknowledged, so a crash does not lose it, and then handed, in
+    order, to `dispatch` from a single thread. Updates that Telegram
+    delivers again are dropped by their `update_id`. When `dispatch`
+    returns False the update stays in the inbox and is dispatched again
+    after `RETRY` seconds.
+    """
+
+    def __init__(self, dispatch, ledger: UpdateLedger, host: str = "0.0.0.0",
+                 port: int = 8080, path: str = "/webhook",
+                 secret_token: str = ""):
+        self._dispatch = dispatch
+        self._ledger = ledger
+        self._path = path
+        self._secret_token = secret_token
+        self._wake = threading.Event()
+        self._stopping = False
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def _handler(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                if self.path != webhook._path:
+                    self.send_error(404)
+                    return
+                secret = self.headers.get(SECRET_HEADER, "")
+                if not hmac.compare_digest(secret, webhook._secret_token):
+                    RECEIVED.inc(result="forbidden")
+                    self.send_error(403)
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    update = json.loads(self.rfile.read(length))
+                    update_id = update["update_id"]
+                except (ValueError, KeyError, TypeError):
+                    RECEIVED.inc(result="invalid")
+                    self.send_error(400)
+                    return
+                try:
+                    webhook._receive(update_id, update)
+                except Exception as exception:
+                    # Telegram sends it again later
+                    logger.error("Can not keep update %s: %s", update_id,
+                                 exception)
+                    RECEIVED.inc(result="failed")
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return Handler
+
+    def _receive(self, update_id: int, update: dict) -> None:
+        if not self._ledger.receive(update_id, update):
+            RECEIVED.inc(result="duplicated")
+            return
+        RECEIVED.inc(result="accepted")
+        self._wake.set()
+
+    def _work(self) -> None:
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                updates = self._ledger.pending()
+            except Exception as exception:
+                logger.error(exception)
+                self._wake.wait(RETRY)
+                continue
+            if not updates:
+                self._wake.wait()
+                continue
+            for update in updates:
+                if self._stopping:
+                    return
+                try:
+                    dispatched = self._dispatch(update)
+                except Exception as exception:
+                    logger.error(exception)
+                    dispatched = False
+                if not dispatched:
+                    self._wake.wait(RETRY)
+                    break
+
+    def start(self) -> None:
+        self._stopping = False
+        self._thread = threading.Thread(target=self._work, name="webhook",
+                                        daemon=True)
+        self._thread.start()
+        threading.Thread(target=self._server.serve_forever,
+                         name="webhook-server", daemon=True).start()
+        logger.info("Listening for updates on port %s", self.port)
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
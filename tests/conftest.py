@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "archivebot"))
+
+from register import Register  # noqa: E402
+
+
+class FakeArchive:
+    """An in-process fake of the S3 and metadata APIs of Internet Archive
+
+    Keeps the finished objects by path, the parts of the open multipart
+    uploads and the metadata of the items, and records every request as
+    a (method, path, params) tuple. The part numbers in `fail_parts`
+    answer with an error once.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.items = {}
+        self.requests = []
+        self.fail_parts = set()
+        self._uploads = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        args=(0.05,), daemon=True)
+        self._thread.start()
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def sent(self, method: str, param: str = "") -> list[dict]:
+        """The params of the requests with that method, and that param"""
+        return [params for verb, _, params in self.requests
+                if verb == method and (not param or param in params)]
+
+    def _initiate(self) -> str:
+        with self._lock:
+            self._uploads += 1
+            upload_id = f"upload-{self._uploads}"
+        self.uploads[upload_id] = {}
+        return upload_id
+
+
+def _etag(body: bytes) -> str:
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+def _handler(fake: FakeArchive):
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def _request(self) -> tuple[str, dict, bytes]:
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values
+                      in parse_qs(url.query, keep_blank_values=True).items()}
+            body = self.rfile.read(int(self.headers.get("Content-Length",
+                                                        0)))
+            fake.requests.append((self.command, url.path, params))
+            return url.path, params, body
+
+        def _send(self, status: int, body: bytes = b"",
+                  headers: dict = {}) -> None:
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            path, params, body = self._request()
+            if path.startswith("/metadata/"):
+                return self._patch(path.split("/")[2], body)
+            if "uploads" in params:
+                upload_id = fake._initiate()
+                return self._send(200, (
+                    "<InitiateMultipartUploadResult><UploadId>"
+                    f"{upload_id}</UploadId>"
+                    "</InitiateMultipartUploadResult>").encode())
+            parts = fake.uploads.pop(params["uploadId"])
+            fake.objects[path] = b"".join(parts[number]
+                                          for number in sorted(parts))
+            self._send(200)
+
+        def _patch(self, identifier: str, body: bytes) -> None:
+            form = {key: values[0] for key, values
+                    in parse_qs(body.decode()).items()}
+            metadata = fake.items.setdefault(identifier, {})
+            changed = dict(metadata)
+            for operation in json.loads(form["-patch"]):
+                key = operation["path"].lstrip("/")
+                if operation["op"] == "remove":
+                    changed.pop(key, None)
+                elif operation["op"] in ("add", "replace"):
+                    changed[key] = operation["value"]
+                else:
+                    result = {"success": False,
+                              "error": f"Unsupported op {operation['op']}"}
+                    return self._send(400, json.dumps(result).encode())
+            if changed == metadata:
+                result = {"success": False,
+                          "error": "no changes made to metadata"}
+            else:
+                metadata.update(changed)
+                result = {"success": True}
+            self._send(200, json.dumps(result).encode())
+
+        def do_PUT(self):
+            path, params, body = self._request()
+            if "uploadId" not in params:
+                fake.objects[path] = body
+                return self._send(200)
+            number = int(params["partNumber"])
+            if number in fake.fail_parts:
+                fake.fail_parts.discard(number)
+                return self._send(500)
+            fake.uploads[params["uploadId"]][number] = body
+            self._send(200, headers={"ETag": _etag(body)})
+
+        def do_DELETE(self):
+            _, params, _ = self._request()
+            fake.uploads.pop(params["uploadId"], None)
+            self._send(204)
+
+        def do_GET(self):
+            path, params, _ = self._request()
+            if "uploadId" in params:
+                parts = fake.uploads.get(params["uploadId"])
+                if parts is None:
+                    return self._send(404)
+                listed = "".join(
+                    f"<Part><PartNumber>{number}</PartNumber>"
+                    f"<ETag>{_etag(body)}</ETag></Part>"
+                    for number, body in sorted(parts.items()))
+                return self._send(
+                    200, f"<ListPartsResult>{listed}</ListPartsResult>"
+                    .encode())
+            if path.startswith("/metadata/"):
+                metadata = fake.items.get(path.split("/")[2])
+                item = {} if metadata is None else {"metadata": metadata}
+                return self._send(200, json.dumps(item).encode())
+            if path == "/advancedsearch.php":
+                asked = params["q"].split("(", 1)[1].rstrip(")")
+                docs = [{"identifier": identifier}
+                        for identifier in asked.split(" OR ")
+                        if identifier in fake.items]
+                return self._send(200, json.dumps(
+                    {"response": {"docs": docs}}).encode())
+            self._send(404)
+
+    return Handler
+
+
+@pytest.fixture
+def archive():
+    fake = FakeArchive()
+    yield fake
+    fake.close()
+
+
+@pytest.fixture
+def register(tmp_path):
+    return Register(str(tmp_path / "archivebot.db"))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sqlite3
+import pytest
+from database import ConnectionPool
+
+TABLE = ["CREATE TABLE t(a INTEGER)"]
+
+
+def _columns(pool) -> list[str]:
+    with pool.reader() as connection:
+        return [row[1] for row in connection.execute(
+            "PRAGMA table_info(t)").fetchall()]
+
+
+def _version(pool, component: str) -> int:
+    with pool.reader() as connection:
+        return connection.execute(
+            "SELECT version FROM schema_migrations WHERE component = ?",
+            (component,)).fetchone()[0]
+
+
+def test_migrate_applies_the_pending_versions(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "db"))
+    assert pool.migrate("test", [TABLE]) == 1
+    assert pool.migrate("test", [TABLE, ["ALTER TABLE t ADD b"]]) == 2
+    assert _columns(pool) == ["a", "b"]
+    assert _version(pool, "test") == 2
+
+
+def test_failed_migration_is_rolled_back(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "db"))
+    pool.migrate("test", [TABLE])
+    failing = [TABLE, ["ALTER TABLE t ADD b",
+                       "INSERT INTO missing VALUES (1)"]]
+    with pytest.raises(sqlite3.OperationalError):
+        pool.migrate("test", failing)
+    assert _columns(pool) == ["a"]
+    assert _version(pool, "test") == 1
+    fixed = [TABLE, ["ALTER TABLE t ADD b", "INSERT INTO t VALUES (1, 2)"]]
+    assert pool.migrate("test", fixed) == 2
+    assert _columns(pool) == ["a", "b"]
+
+
+def test_failed_version_keeps_the_previous_ones(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "db"))
+    with pytest.raises(sqlite3.OperationalError):
+        pool.migrate("test", [TABLE, ["ALTER TABLE missing ADD b"]])
+    assert _columns(pool) == ["a"]
+    assert _version(pool, "test") == 1
+    with pool.transaction() as connection:
+        connection.execute("INSERT INTO t VALUES (1)")
+    with pool.reader() as connection:
+        assert connection.execute("SELECT a FROM t").fetchall() == [(1,)]
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+import pytest
+from iaclient import IAClient, IAClientException
+
+
+def _reads(archive, identifier: str) -> int:
+    return sum(1 for method, path, _ in archive.requests
+               if method == "GET" and path == f"/metadata/{identifier}")
+
+
+def test_item_is_cached_for_its_ttl(archive):
+    archive.items["item"] = {"title": "One"}
+    client = IAClient(host=archive.url, ttl=0.2)
+    assert client.item("item")["metadata"] == {"title": "One"}
+    archive.items["item"] = {"title": "Two"}
+    assert client.item("item")["metadata"] == {"title": "One"}
+    assert _reads(archive, "item") == 1
+    time.sleep(0.3)
+    assert client.item("item")["metadata"] == {"title": "Two"}
+    assert _reads(archive, "item") == 2
+
+
+def test_missing_item_is_cached_for_the_missing_ttl(archive):
+    client = IAClient(host=archive.url, ttl=60, missing_ttl=0.2)
+    assert client.item("item") is None
+    archive.items["item"] = {"title": "One"}
+    assert client.item("item") is None
+    assert _reads(archive, "item") == 1
+    time.sleep(0.3)
+    assert client.item("item")["metadata"] == {"title": "One"}
+    assert _reads(archive, "item") == 2
+
+
+def test_refresh_skips_the_cache(archive):
+    client = IAClient(host=archive.url)
+    assert client.item("item") is None
+    archive.items["item"] = {"title": "One"}
+    assert client.item("item", refresh=True)["metadata"] == {"title": "One"}
+    assert _reads(archive, "item") == 2
+
+
+def test_created_item_is_missing_without_asking(archive):
+    client = IAClient(host=archive.url)
+    client.created("item")
+    assert client.item("item") is None
+    assert client.files("item") == {}
+    assert archive.requests == []
+
+
+def test_invalidate_forgets_the_item(archive):
+    client = IAClient(host=archive.url)
+    client.created("item")
+    archive.items["item"] = {"title": "One"}
+    client.invalidate("item")
+    assert client.item("item")["metadata"] == {"title": "One"}
+    assert _reads(archive, "item") == 1
+
+
+def test_capacity_drops_the_least_recently_used(archive):
+    client = IAClient(host=archive.url, capacity=2)
+    for identifier in ("one", "two", "three"):
+        client.created(identifier)
+    client.item("two")
+    client.item("three")
+    client.item("one")
+    assert [path for _, path, _ in archive.requests] == ["/metadata/one"]
+
+
+def test_exists_asks_the_search_in_batches(archive):
+    archive.items.update({f"item{index}": {} for index in range(0, 150, 2)})
+    client = IAClient(host=archive.url)
+    identifiers = [f"item{index}" for index in range(150)]
+    assert client.exists(identifiers) == set(identifiers[::2])
+    assert len(archive.sent("GET", "q")) == 2
+
+
+def test_exists_answers_cached_items_from_the_cache(archive):
+    archive.items["item"] = {}
+    client = IAClient(host=archive.url)
+    client.created("new")
+    client.item("item")
+    archive.requests.clear()
+    assert client.exists(["item", "new"]) == {"item"}
+    assert archive.requests == []
+
+
+def test_patch_reports_no_changes(archive):
+    archive.items["item"] = {"title": "One"}
+    client = IAClient("access", "secret", host=archive.url)
+    patch = [{"op": "replace", "path": "/title", "value": "Two"}]
+    assert client.patch("item", patch) is True
+    assert archive.items["item"] == {"title": "Two"}
+    assert client.patch("item", patch) is False
+
+
+def test_patch_invalidates_the_item(archive):
+    archive.items["item"] = {"title": "One"}
+    client = IAClient("access", "secret", host=archive.url)
+    client.item("item")
+    client.patch("item", [{"op": "replace", "path": "/title",
+                           "value": "Two"}])
+    assert client.item("item")["metadata"] == {"title": "Two"}
+    assert _reads(archive, "item") == 2
+
+
+def test_patch_error_raises(archive):
+    client = IAClient("access", "secret", host=archive.url)
+    with pytest.raises(IAClientException):
+        client.patch("item", [{"op": "test", "path": "/title"}])
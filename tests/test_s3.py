@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import io
+import os
+import pytest
+from s3 import S3Client, S3Exception
+
+
+class EncodeFailed(Exception):
+    pass
+
+
+def _client(archive) -> S3Client:
+    return S3Client("access", "secret", archive.url)
+
+
+def test_upload_stream_completes_in_parts(archive):
+    data = os.urandom(2500)
+    checked = []
+    digest = _client(archive).upload_stream(
+        "item", "audio.mp3", io.BytesIO(data), {}, part_size=1000,
+        check=lambda: checked.append(True))
+    assert archive.objects["/item/audio.mp3"] == data
+    assert len(archive.sent("PUT", "partNumber")) == 3
+    assert digest.size == len(data)
+    assert checked == [True]
+
+
+def test_upload_stream_aborts_when_the_check_fails(archive):
+    def check():
+        raise EncodeFailed()
+    with pytest.raises(EncodeFailed):
+        _client(archive).upload_stream(
+            "item", "audio.mp3", io.BytesIO(os.urandom(1500)), {},
+            part_size=1000, check=check)
+    assert archive.objects == {}
+    assert len(archive.sent("DELETE", "uploadId")) == 1
+    assert archive.uploads == {}
+
+
+def test_upload_stream_aborts_an_empty_stream(archive):
+    with pytest.raises(S3Exception):
+        _client(archive).upload_stream("item", "audio.mp3", io.BytesIO(),
+                                       {})
+    assert archive.sent("PUT") == []
+    assert archive.objects == {}
+    assert len(archive.sent("DELETE", "uploadId")) == 1
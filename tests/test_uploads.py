@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import time
+import pytest
+from s3 import S3Client, S3Exception
+from uploads import MultipartUploader
+
+PART = 1000
+
+
+def _uploader(register, archive, **kwargs) -> MultipartUploader:
+    client = S3Client("access", "secret", archive.url)
+    return MultipartUploader(register, client, part_size=PART, **kwargs)
+
+
+def _file(tmp_path, size: int):
+    path = tmp_path / "audio.mp3"
+    path.write_bytes(os.urandom(size))
+    return path
+
+
+def _parts(archive) -> list[int]:
+    return sorted(int(params["partNumber"])
+                  for params in archive.sent("PUT", "partNumber"))
+
+
+def _manifest(register) -> set[int]:
+    with register.reader() as connection:
+        return {number for number, in connection.execute(
+            "SELECT number FROM upload_parts").fetchall()}
+
+
+def _interrupt(register, archive, path) -> set[int]:
+    """Upload with a failing third part, returns the parts recorded"""
+    archive.fail_parts = {3}
+    with pytest.raises(S3Exception):
+        _uploader(register, archive, workers=1, retries=0).upload(
+            "item", "audio.mp3", str(path), {})
+    archive.requests.clear()
+    return _manifest(register)
+
+
+def test_upload_sends_every_part(register, archive, tmp_path):
+    path = _file(tmp_path, 3500)
+    _uploader(register, archive).upload("item", "audio.mp3", str(path), {})
+    assert archive.objects["/item/audio.mp3"] == path.read_bytes()
+    assert _parts(archive) == [1, 2, 3, 4]
+    assert _manifest(register) == set()
+
+
+def test_resume_sends_only_the_missing_parts(register, archive, tmp_path):
+    path = _file(tmp_path, 4500)
+    done = _interrupt(register, archive, path)
+    assert {1, 2} <= done and 3 not in done
+    _uploader(register, archive).upload("item", "audio.mp3", str(path), {})
+    assert archive.sent("POST", "uploads") == []
+    assert _parts(archive) == sorted({1, 2, 3, 4, 5} - done)
+    assert archive.objects["/item/audio.mp3"] == path.read_bytes()
+    assert _manifest(register) == set()
+
+
+def test_resume_sends_again_the_parts_the_server_lost(register, archive,
+                                                      tmp_path):
+    path = _file(tmp_path, 3500)
+    done = _interrupt(register, archive, path)
+    del archive.uploads["upload-1"][1]
+    _uploader(register, archive).upload("item", "audio.mp3", str(path), {})
+    assert archive.sent("GET", "uploadId")
+    assert _parts(archive) == sorted({1, 2, 3, 4} - done | {1})
+    assert archive.objects["/item/audio.mp3"] == path.read_bytes()
+
+
+def test_changed_file_starts_over(register, archive, tmp_path):
+    path = _file(tmp_path, 3500)
+    _interrupt(register, archive, path)
+    path.write_bytes(os.urandom(2500))
+    _uploader(register, archive).upload("item", "audio.mp3", str(path), {})
+    assert [params["uploadId"] for params in archive.sent("DELETE")] == \
+        ["upload-1"]
+    assert len(archive.sent("POST", "uploads")) == 1
+    assert _parts(archive) == [1, 2, 3]
+    assert archive.objects["/item/audio.mp3"] == path.read_bytes()
+    assert archive.uploads == {}
+
+
+def test_rate_limits_the_bandwidth(register, archive, tmp_path):
+    path = _file(tmp_path, 6000)
+    uploader = _uploader(register, archive, workers=3, rate=4000)
+    start = time.monotonic()
+    uploader.upload("item", "audio.mp3", str(path), {})
+    # The bucket starts with a second of bytes, the rest waits for it
+    assert time.monotonic() - start >= 0.45
+    assert archive.objects["/item/audio.mp3"] == path.read_bytes()
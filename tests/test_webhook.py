@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Lorenzo Carbonell <a.k.a. atareao>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import threading
+import pytest
+import requests
+import webhook
+from updates import UpdateLedger
+from webhook import SECRET_HEADER, WebhookServer
+
+
+class Dispatcher:
+    """Process the updates like the bot, failing the first `failures`"""
+
+    def __init__(self, ledger: UpdateLedger, failures: int = 0):
+        self.ledger = ledger
+        self.failures = failures
+        self.dispatched = []
+        self.done = threading.Event()
+
+    def __call__(self, update: dict) -> bool:
+        self.dispatched.append(update["update_id"])
+        if self.failures:
+            self.failures -= 1
+            return False
+        self.ledger.processed(update["update_id"])
+        self.done.set()
+        return True
+
+
+@pytest.fixture
+def ledger(register):
+    return UpdateLedger(register)
+
+
+def _post(server: WebhookServer, update: dict,
+          secret: str = "secret") -> int:
+    return requests.post(
+        f"http://127.0.0.1:{server.port}/webhook", data=json.dumps(update),
+        headers={SECRET_HEADER: secret}).status_code
+
+
+def test_update_is_kept_before_it_is_acknowledged(ledger):
+    server = WebhookServer(Dispatcher(ledger), ledger, "127.0.0.1", 0,
+                           secret_token="secret")
+    threading.Thread(target=server._server.serve_forever,
+                     daemon=True).start()
+    try:
+        assert _post(server, {"update_id": 7, "message": {}}) == 200
+        assert _post(server, {"update_id": 7, "message": {}}) == 200
+    finally:
+        server._server.shutdown()
+    assert ledger.pending() == [{"update_id": 7, "message": {}}]
+
+
+def test_pending_updates_are_dispatched_on_start(ledger):
+    ledger.receive(3, {"update_id": 3})
+    dispatcher = Dispatcher(ledger)
+    server = WebhookServer(dispatcher, ledger, "127.0.0.1", 0)
+    server.start()
+    try:
+        assert dispatcher.done.wait(5)
+    finally:
+        server.stop()
+    assert dispatcher.dispatched == [3]
+    assert ledger.pending() == []
+    assert not ledger.receive(3, {"update_id": 3})
+
+
+def test_failed_update_is_dispatched_again(ledger, monkeypatch):
+    monkeypatch.setattr(webhook, "RETRY", 0.05)
+    dispatcher = Dispatcher(ledger, failures=2)
+    server = WebhookServer(dispatcher, ledger, "127.0.0.1", 0,
+                           secret_token="secret")
+    server.start()
+    try:
+        assert _post(server, {"update_id": 1}) == 200
+        assert dispatcher.done.wait(5)
+    finally:
+        server.stop()
+    assert dispatcher.dispatched == [1, 1, 1]
+    assert ledger.is_processed(1)
+
+
+def test_wrong_secret_is_forbidden(ledger):
+    server = WebhookServer(Dispatcher(ledger), ledger, "127.0.0.1", 0,
+                           secret_token="secret")
+    server.start()
+    try:
+        assert _post(server, {"update_id": 1}, "wrong") == 403
+    finally:
+        server.stop()
+    assert ledger.pending() == []